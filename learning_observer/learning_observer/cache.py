@@ -1,17 +1,93 @@
+'''
+Memoization
+
+`async_memoization` caches the results of slow coroutines (calls to
+GPT, LanguageTool, Google APIs, rosters) in two tiers:
+
+1. An in-process LRU, bounded in size (`memoization.local_cache_size`)
+   and by each entry's time-to-live.
+2. The `memoization` KVS, if one is configured, so results are shared
+   between processes and survive restarts (for persistent stores):
+
+```yaml
+kvs:
+  memoization:
+    type: redis_ephemeral
+    expiry: 600
+```
+
+Concurrent identical calls in a process share one call (see
+`learning_observer.single_flight`). With `stale_ttl`, a result which
+has expired is still returned for that much longer, while a fresh one
+is computed in the background (stale-while-revalidate).
+
+Keys are a hash of the function's fully-qualified name and all of its
+arguments, bound to its signature (so `f(1)` and `f(x=1)` share a
+result). Closures should pass anything which affects the result as
+arguments, rather than capturing it. Calls with arguments which can't
+be serialized to JSON are not cached.
+
+Results must be JSON-serializable, and each caller gets its own copy.
+`stats()` returns hit and miss counts per function.
+'''
+
+import asyncio
+import collections
+import copy
 import functools
+import hashlib
+import inspect
 import json
+import time
+
+import pmss
 
 import learning_observer.kvs
 import learning_observer.prestartup
+import learning_observer.settings
+import learning_observer.single_flight
 from learning_observer.log_event import debug_log
 
+pmss.register_field(
+    name='local_cache_size',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='How many memoized results each process keeps in memory, '
+                'in front of the `memoization` KVS.',
+    default=1024
+)
+pmss.register_field(
+    name='default_ttl',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='How many seconds memoized results are used for, unless '
+                'the memoized function sets its own `ttl`. 0 keeps them '
+                'until they are evicted.',
+    default=0
+)
+
+DEFAULT_LOCAL_CACHE_SIZE = 1024
+DEFAULT_TTL = 0
+
 cache_backend = None
 
+# Key to `_Entry`, least recently used first
+_LOCAL = collections.OrderedDict()
+
+# Concurrent calls (and background refreshes) with the same key share
+# a single call
+_FLIGHTS = learning_observer.single_flight.SingleFlight()
+
+# Background refreshes, so they aren't garbage collected while running
+_REFRESHES = set()
+
+# (function name, outcome) to count. Outcomes are `hit` (in process),
+# `kvs_hit`, `stale` (served while refreshing), `miss`, and
+# `uncacheable` (arguments we can't hash).
+STATS = collections.Counter()
+
+# When an entry stops being fresh, and when it stops being usable at
+# all. `None` means never.
+_Entry = collections.namedtuple('_Entry', ['value', 'fresh_until', 'stale_until'])
 
-def create_key_from_args(func, *args, **kwargs):
-    key_dict = {'func': str(func.__name__), 'args': args, 'kwargs': kwargs}
-    key_str = json.dumps(key_dict, sort_keys=True)
-    return key_str
 
 @learning_observer.prestartup.register_startup_check
 def connect_to_memoization_kvs():
@@ -28,20 +104,203 @@ def connect_to_memoization_kvs():
         # raise learning_observer.prestartup.StartupCheck("KVS: "+error_text)
 
 
-def async_memoization():
+def _setting(name, default):
+    '''
+    A `memoization` setting, or `default` if settings are not loaded
+    (e.g. in doctests).
+    '''
+    if learning_observer.settings.pmss_settings is None:
+        return default
+    return getattr(learning_observer.settings.pmss_settings, name)(types=['memoization'])
+
+
+def function_name(func):
+    '''
+    The name we use for `func` in keys and statistics.
+
+    >>> function_name(json.dumps)
+    'json.dumps'
+    '''
+    return '{}.{}'.format(func.__module__, func.__qualname__)
+
+
+def create_key_from_args(func, args, kwargs):
+    '''
+    A stable key for calling `func` with `args` and `kwargs`. Raises
+    `TypeError` if the arguments can't be serialized.
+
+    >>> def example(a, b=2):
+    ...     pass
+    >>> create_key_from_args(example, (1,), {}) == create_key_from_args(example, (), {'a': 1, 'b': 2})
+    True
+    >>> create_key_from_args(example, (1,), {}) == create_key_from_args(example, (2,), {})
+    False
+    >>> create_key_from_args(example, (1,), {}).split(',')[:2]
+    ['memoization', 'learning_observer.cache.example']
+    '''
+    try:
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+    except (TypeError, ValueError):
+        arguments = {'args': args, 'kwargs': kwargs}
+    serialized = json.dumps(arguments, sort_keys=True, separators=(',', ':'))
+    return 'memoization,{name},{digest}'.format(
+        name=function_name(func),
+        digest=hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+    )
+
+
+def _local_get(key):
+    entry = _LOCAL.get(key)
+    if entry is not None:
+        _LOCAL.move_to_end(key)
+    return entry
+
+
+def _local_set(key, entry):
+    _LOCAL[key] = entry
+    _LOCAL.move_to_end(key)
+    size = _setting('local_cache_size', DEFAULT_LOCAL_CACHE_SIZE)
+    while len(_LOCAL) > size:
+        _LOCAL.popitem(last=False)
+
+
+def _is_fresh(entry, now):
+    return entry.fresh_until is None or now < entry.fresh_until
+
+
+def _is_usable(entry, now):
+    return entry.stale_until is None or now < entry.stale_until
+
+
+async def _kvs_get(key):
+    '''
+    Look `key` up in the memoization KVS. We store an envelope with the
+    value, so a missing key (`None`) is distinct from a `None` result.
+    '''
+    if cache_backend is None:
+        return None
+    envelope = await cache_backend[key]
+    if not isinstance(envelope, dict) or 'value' not in envelope:
+        return None
+    return _Entry(envelope['value'], envelope.get('fresh_until'), envelope.get('stale_until'))
+
+
+async def _store(key, value, ttl, stale_ttl):
+    now = time.time()
+    fresh_until = now + ttl if ttl else None
+    stale_until = fresh_until + stale_ttl if fresh_until is not None else None
+    entry = _Entry(value, fresh_until, stale_until)
+    _local_set(key, entry)
+    if cache_backend is not None:
+        await cache_backend.set(key, entry._asdict())
+
+
+def clear():
+    '''
+    Drop everything in the in-process tier, and reset the statistics.
+    '''
+    _LOCAL.clear()
+    STATS.clear()
+
+
+def stats():
+    '''
+    Hit and miss counts, by function name.
+    '''
+    result = {}
+    for (name, outcome), count in STATS.items():
+        result.setdefault(name, {})[outcome] = count
+    return result
+
+
+def async_memoization(ttl=None, stale_ttl=0):
+    '''
+    Memoize a coroutine function. Results are fresh for `ttl` seconds
+    (default `memoization.default_ttl`; 0 for no expiry), and may be
+    served for a further `stale_ttl` seconds while being recomputed.
+
+    >>> clear()
+    >>> calls = []
+    >>> @async_memoization(ttl=60)
+    ... async def square(x):
+    ...     calls.append(x)
+    ...     await asyncio.sleep(0.01)
+    ...     return {'square': x * x}
+    >>> async def example():
+    ...     results = await asyncio.gather(*[square(3) for i in range(3)])
+    ...     results.append(await square(x=3))
+    ...     results.append(await square(4))
+    ...     return results
+    >>> asyncio.run(example())
+    [{'square': 9}, {'square': 9}, {'square': 9}, {'square': 9}, {'square': 16}]
+    >>> calls
+    [3, 4]
+    >>> stats()['learning_observer.cache.square']
+    {'miss': 4, 'hit': 1}
+    '''
     def decorator(func):
+        name = function_name(func)
+
+        def entry_ttl():
+            return _setting('default_ttl', DEFAULT_TTL) if ttl is None else ttl
+
+        async def compute(key, args, kwargs):
+            value = await func(*args, **kwargs)
+            await _store(key, value, entry_ttl(), stale_ttl)
+            return value
+
+        async def revalidate(key, args, kwargs):
+            # Another process may have refreshed it already
+            entry = await _kvs_get(key)
+            if entry is not None and _is_fresh(entry, time.time()):
+                _local_set(key, entry)
+                return entry.value
+            return await compute(key, args, kwargs)
+
+        async def refresh(key, args, kwargs):
+            try:
+                await _FLIGHTS.run(('refresh', key), revalidate, key, args, kwargs)
+            except Exception as e:
+                debug_log('Memoization: refreshing {} failed: {}'.format(name, e))
+
+        def serve_stale(key, entry, args, kwargs):
+            STATS[(name, 'stale')] += 1
+            task = asyncio.ensure_future(refresh(key, args, kwargs))
+            _REFRESHES.add(task)
+            task.add_done_callback(_REFRESHES.discard)
+            return entry.value
+
+        async def load(key, args, kwargs):
+            entry = await _kvs_get(key)
+            now = time.time()
+            if entry is not None and _is_usable(entry, now):
+                _local_set(key, entry)
+                if _is_fresh(entry, now):
+                    STATS[(name, 'kvs_hit')] += 1
+                    return entry.value
+                return serve_stale(key, entry, args, kwargs)
+            return await compute(key, args, kwargs)
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            # if the memoization cache is absent, just run the function
-            if cache_backend is None:
+            try:
+                key = create_key_from_args(func, args, kwargs)
+            except TypeError:
+                STATS[(name, 'uncacheable')] += 1
                 return await func(*args, **kwargs)
 
-            # process item if the cache is present
-            key = create_key_from_args(func, args, kwargs)
-            if key in await cache_backend.keys():
-                return await cache_backend[key]
-            result = await func(*args, **kwargs)
-            await cache_backend.set(key, result)
-            return result
+            entry = _local_get(key)
+            now = time.time()
+            if entry is not None and _is_usable(entry, now):
+                if _is_fresh(entry, now):
+                    STATS[(name, 'hit')] += 1
+                    return copy.deepcopy(entry.value)
+                return copy.deepcopy(serve_stale(key, entry, args, kwargs))
+
+            STATS[(name, 'miss')] += 1
+            value = await _FLIGHTS.run(key, load, key, args, kwargs)
+            return copy.deepcopy(value)
         return wrapper
     return decorator
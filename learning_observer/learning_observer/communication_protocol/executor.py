@@ -6,11 +6,15 @@ The executor processes the `execution_dag` portion of our request.
 '''
 import asyncio
 import collections
-import concurrent.futures
+import contextvars
+import copy
 import functools
 import inspect
+import json
 import weakref
 
+import pmss
+
 import learning_observer.communication_protocol.query
 import learning_observer.communication_protocol.util
 import learning_observer.kvs
@@ -18,11 +22,132 @@ import learning_observer.module_loader
 import learning_observer.settings
 import learning_observer.stream_analytics.fields
 import learning_observer.stream_analytics.helpers
+import learning_observer.worker_pools
 from learning_observer.log_event import debug_log
-from learning_observer.util import get_nested_dict_value, clean_json, ensure_async_generator, async_zip
+from learning_observer.util import get_nested_dict_value, clean_json, ensure_async_generator, ensure_async_chunks, async_batched, async_zip, DEFAULT_CHUNK_SIZE
 from learning_observer.communication_protocol.exception import DAGExecutionException
 
 
+pmss.register_field(
+    name='dag_max_concurrency',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='The most DAG nodes one execution runs at once. Independent '
+                'branches of a DAG (e.g. several calls which each need the '
+                'roster) run concurrently, up to this limit. 1 runs nodes one '
+                'at a time.',
+    default=8
+)
+pmss.register_field(
+    name='dag_chunk_size',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='How many items `keys`, `select`, and `join` nodes pass to '
+                'the next node at once. Larger chunks cut per-item overhead '
+                'on big rosters; 1 passes items one at a time.',
+    default=DEFAULT_CHUNK_SIZE
+)
+pmss.register_field(
+    name='map_max_concurrency',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='The most calls one parallel `map` node runs at once. '
+                'Published functions may set lower, process-wide limits '
+                '(see `learning_observer.worker_pools`).',
+    default=16
+)
+pmss.parser('dag_provenance', parent='string', choices=['auto', 'full', 'compact'], transform=None)
+pmss.register_field(
+    name='dag_provenance',
+    type='dag_provenance',
+    description='How much provenance DAG nodes attach to the records they produce.\n'\
+                '`full`: copy each record a scope value came from (e.g. the '
+                'whole roster entry) into the provenance, for debugging\n'\
+                '`compact`: only keep the values used to build keys, which is '
+                'all dashboards and joins need\n'\
+                '`auto`: `compact` when deployed, `full` otherwise',
+    default='auto'
+)
+
+
+# If set, a `learning_observer.kvs.KeyWatch`, and `select` nodes add
+# the keys they read to it. This lets callers (e.g. the dashboard)
+# rerun a DAG only when data it read changes.
+SELECTED_KEYS_WATCH = contextvars.ContextVar('selected_keys_watch', default=None)
+
+
+class _ChunkedAsyncIterable:
+    """An async iterable which produces its items a chunk (list) at a time.
+
+    Handlers for the busiest nodes (`keys`, `select`, `join`) return these,
+    so each hop between them costs one step per chunk rather than per item.
+    `chunks()` gives the chunks; iterating gives one item at a time, so
+    code which has not opted in (e.g. published functions) is unchanged.
+    See `learning_observer.util.ensure_async_chunks`.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def chunks(self):
+        return self._chunks
+
+    async def __aiter__(self):
+        async for chunk in self._chunks:
+            for item in chunk:
+                yield item
+
+
+def _chunked(generator_function):
+    """
+    Decorate an async generator function which yields lists (chunks) of
+    items, so calling it returns a `_ChunkedAsyncIterable`.
+    """
+    @functools.wraps(generator_function)
+    def wrapper(*args, **kwargs):
+        return _ChunkedAsyncIterable(generator_function(*args, **kwargs))
+    return wrapper
+
+
+def _dag_max_concurrency():
+    """
+    The most nodes one execution runs at once. We fall back to the
+    default if settings are not loaded (e.g. in doctests).
+    """
+    if learning_observer.settings.pmss_settings is None:
+        return 8
+    return learning_observer.settings.pmss_settings.dag_max_concurrency(types=['communication_protocol'])
+
+
+def _dag_chunk_size():
+    """
+    How many items nodes pass to each other at once. We fall back to
+    the default if settings are not loaded (e.g. in doctests).
+    """
+    if learning_observer.settings.pmss_settings is None:
+        return DEFAULT_CHUNK_SIZE
+    return learning_observer.settings.pmss_settings.dag_chunk_size(types=['communication_protocol'])
+
+
+def _map_max_concurrency():
+    """
+    The most calls a parallel map runs at once. We fall back to the
+    default if settings are not loaded (e.g. in doctests).
+    """
+    if learning_observer.settings.pmss_settings is None:
+        return 16
+    return learning_observer.settings.pmss_settings.map_max_concurrency(types=['communication_protocol'])
+
+
+def _compact_provenance():
+    """
+    Whether to attach compact provenance (see `dag_provenance`). We keep
+    full provenance if settings are not loaded (e.g. in doctests).
+    """
+    if learning_observer.settings.pmss_settings is None:
+        return False
+    mode = learning_observer.settings.pmss_settings.dag_provenance(types=['communication_protocol'])
+    if mode == 'auto':
+        return learning_observer.settings.RUN_MODE == learning_observer.settings.RUN_MODES.DEPLOY
+    return mode == 'compact'
+
+
 class _SharedAsyncIterable:
     """Fan out one async iterable to multiple consumers without runaway memory use.
 
@@ -31,10 +156,19 @@ class _SharedAsyncIterable:
     defeats backpressure and retains every item indefinitely. This wrapper only
     pulls items when a consumer needs them and discards items once every consumer
     has advanced past them.
+
+    The buffer holds chunks of items. A `_ChunkedAsyncIterable` source gives
+    us whole chunks, so consumers only coordinate once per chunk; other
+    sources give one-item chunks. Consumers can iterate items, or opt in
+    to chunks with `chunks()`.
     """
     def __init__(self, source):
         self._source = source
-        self._source_iter = source.__aiter__()
+        self._chunked = isinstance(source, _ChunkedAsyncIterable)
+        if self._chunked:
+            self._source_iter = source.chunks().__aiter__()
+        else:
+            self._source_iter = source.__aiter__()
         self._buffer = []
         self._start_index = 0
         self._done = False
@@ -50,7 +184,7 @@ class _SharedAsyncIterable:
                     return
                 if target_index < self._start_index + len(self._buffer):
                     return
-            # Only fetch when a consumer needs a new item to avoid eager draining.
+            # Only fetch when a consumer needs a new chunk to avoid eager draining.
             try:
                 item = await self._source_iter.__anext__()
             except StopAsyncIteration:
@@ -65,7 +199,7 @@ class _SharedAsyncIterable:
                     self._condition.notify_all()
                 raise
             async with self._condition:
-                self._buffer.append(item)
+                self._buffer.append(item if self._chunked else [item])
                 self._condition.notify_all()
 
     async def _trim_buffer(self):
@@ -75,7 +209,7 @@ class _SharedAsyncIterable:
                 self._start_index += len(self._buffer)
                 self._buffer.clear()
                 return
-            # Drop any buffered items that all active consumers have passed.
+            # Drop any buffered chunks that all active consumers have passed.
             min_index = min(iterator._index for iterator in self._iterators)
             trim_count = min_index - self._start_index
             if trim_count > 0:
@@ -93,24 +227,51 @@ class _SharedAsyncIterable:
         # Schedule trimming outside of __del__ to avoid blocking finalization.
         loop.create_task(self._trim_buffer())
 
-    def __aiter__(self):
-        iterator = _SharedAsyncIterator(self)
+    def _iterator(self, items):
+        iterator = _SharedAsyncIterator(self, items)
         self._iterators.add(iterator)
         return iterator
 
+    def __aiter__(self):
+        return self._iterator(items=True)
+
+    def chunks(self):
+        return self._iterator(items=False)
+
 
 class _SharedAsyncIterator:
-    """Advance through the shared buffer and coordinate with other consumers."""
-    def __init__(self, shared):
+    """Advance through the shared buffer and coordinate with other consumers.
+
+    We step through the buffer a chunk at a time. If `items` is set, we
+    hand out the items of the current chunk one by one, which needs no
+    coordination.
+    """
+    def __init__(self, shared, items):
         self._shared = shared
         self._index = shared._start_index
+        self._items = items
+        self._chunk = []
+        self._position = 0
+
+    def __aiter__(self):
+        return self
 
     async def __anext__(self):
+        if not self._items:
+            return await self._next_chunk()
+        while self._position >= len(self._chunk):
+            self._chunk = await self._next_chunk()
+            self._position = 0
+        item = self._chunk[self._position]
+        self._position += 1
+        return item
+
+    async def _next_chunk(self):
         while True:
             async with self._shared._condition:
                 buffer_offset = self._index - self._shared._start_index
                 if buffer_offset < len(self._shared._buffer):
-                    item = self._shared._buffer[buffer_offset]
+                    chunk = self._shared._buffer[buffer_offset]
                     self._index += 1
                     break
                 if self._shared._exception is not None:
@@ -120,7 +281,7 @@ class _SharedAsyncIterator:
             # Trigger a fetch if we are caught up with the shared buffer.
             await self._shared._fetch_next(self._index)
         await self._shared._trim_buffer()
-        return item
+        return chunk
 
     def __del__(self):
         self._shared._discard_iterator(self)
@@ -173,7 +334,9 @@ async def call_dispatch(functions, function_name, args, kwargs):
     * `process_document_data(text)`
 
     We run the function, `function_name`, in `functions` with any `args` or
-    `kwargs` and return the result.
+    `kwargs` and return the result, within the limits it was published
+    with (see `learning_observer.worker_pools.call`). Plain functions
+    run in the event loop, unless they were published with a worker pool.
 
     Generic double function for testing
     >>> def double(x):
@@ -203,7 +366,10 @@ async def call_dispatch(functions, function_name, args, kwargs):
     provenance = {'function_name': function_name, 'args': args, 'kwargs': kwargs}
     try:
         function = functions[function_name]
-        result = function(*args, **kwargs)
+        result = await learning_observer.worker_pools.call(
+            function_name, functools.partial(function, *args, **kwargs),
+            is_coroutine=inspect.iscoroutinefunction(function), in_pool=False
+        )
         if inspect.isawaitable(result):
             result = await result
     except Exception as e:
@@ -250,6 +416,7 @@ def substitute_parameter(parameter_name, parameters, required, default):
 
 
 @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.JOIN)
+@_chunked
 async def handle_join(left, right, left_on, right_on):
     """
     We dispatch this function whenever we process a DISPATCH_MODES.JOIN node.
@@ -289,106 +456,94 @@ async def handle_join(left, right, left_on, right_on):
     ... )))
     [{'left': True}, {'lid': 2, 'left': True, 'rid': 2, 'right': True}]
     """
+    chunk_size = _dag_chunk_size()
     right_dict = {}
-    async for d in ensure_async_generator(right):
-        try:
-            nested_value = get_nested_dict_value(d, right_on)
-            right_dict[nested_value] = d
-        except KeyError as e:
-            pass
-    async for left_dict in ensure_async_generator(left):
-        try:
-            lookup_key = get_nested_dict_value(left_dict, left_on)
-            right_dict_match = right_dict.get(lookup_key)
-            if right_dict_match:
-                merged_dict = {**left_dict, **right_dict_match}
-            else:
-                # defaults to left_dict if not match isn't found
-                merged_dict = left_dict
-            yield merged_dict
-        except KeyError as e:
-            # TODO should we throw an error if we can't find a match in
-            # right or should we just yield left as is?
-            yield left_dict
-            # result.append(DAGExecutionException(
-            #     f'KeyError: key `{left_on}` not found in `{left_dict.keys()}`',
-            #     inspect.currentframe().f_code.co_name,
-            #     {'target': left_dict, 'key': left_on, 'exception': e}
-            # ).to_dict())
-
-
-async def map_coroutine_serial(func, values, value_path):
+    async for chunk in ensure_async_chunks(right, chunk_size):
+        for d in chunk:
+            try:
+                nested_value = get_nested_dict_value(d, right_on)
+                right_dict[nested_value] = d
+            except KeyError as e:
+                pass
+    async for chunk in ensure_async_chunks(left, chunk_size):
+        merged_chunk = []
+        for left_dict in chunk:
+            try:
+                lookup_key = get_nested_dict_value(left_dict, left_on)
+                right_dict_match = right_dict.get(lookup_key)
+                if right_dict_match:
+                    merged_dict = {**left_dict, **right_dict_match}
+                else:
+                    # defaults to left_dict if not match isn't found
+                    merged_dict = left_dict
+                merged_chunk.append(merged_dict)
+            except KeyError as e:
+                # TODO should we throw an error if we can't find a match in
+                # right or should we just yield left as is?
+                merged_chunk.append(left_dict)
+                # result.append(DAGExecutionException(
+                #     f'KeyError: key `{left_on}` not found in `{left_dict.keys()}`',
+                #     inspect.currentframe().f_code.co_name,
+                #     {'target': left_dict, 'key': left_on, 'exception': e}
+                # ).to_dict())
+        yield merged_chunk
+
+
+async def _call_with_value(call, v, value_path):
     """
-    We call map for coroutine functions operating in serial.
-    See the `handle_map` function for more details regarding parameters.
+    Call `call` on the value at `value_path` in `v`. We return the result
+    (or the exception) along with `v`, which is used to annotate the
+    result's metadata.
     """
-    async for v in ensure_async_generator(values):
-        try:
-            yield await func(get_nested_dict_value(v, value_path)), v
-        except Exception as e:
-            yield e, v
+    try:
+        result = await call(get_nested_dict_value(v, value_path))
+    except Exception as e:
+        result = e
+    return result, v
 
 
-async def map_coroutine_parallel(func, values, value_path):
+async def map_serial(call, values, value_path):
     """
-    We call map for coroutine functions operating in parallel.
+    We call map for functions operating in serial.
     See the `handle_map` function for more details regarding parameters.
     """
-    async def _return_result_and_value(v):
-        '''Wrapper for the function to return both the result and
-        the value passed in. The value is yielded to annotate the
-        results metadata.
-        '''
-        try:
-            result = await func(get_nested_dict_value(v, value_path))
-        except Exception as e:
-            result = e
-        return result, v
-
-    tasks = []
     async for v in ensure_async_generator(values):
-        tasks.append(_return_result_and_value(v))
-    for task in asyncio.as_completed(tasks):
-        task_result, task_value = await task
-        yield task_result, task_value
+        yield await _call_with_value(call, v, value_path)
 
 
-async def map_parallel(func, values, value_path):
+async def map_parallel(call, values, value_path):
     """
-    We call map for synchronous functions operating in parallel.
+    We call map for functions operating in parallel, with at most
+    `map_max_concurrency` calls running at once. Results are yielded
+    as they finish (calls which finish together, in the order they
+    were started).
+
+    If we are cancelled or closed early (e.g. the dashboard
+    disconnected), we cancel the calls still running.
     See the `handle_map` function for more details regarding parameters.
     """
-    def _return_result_and_value(v):
-        '''Wrapper for the function to return both the result and
-        the value passed in. The value is yielded to annotate the
-        results metadata.
-        '''
-        try:
-            result = func(get_nested_dict_value(v, value_path))
-        except Exception as e:
-            result = e
-        return result, v
-
-    loop = asyncio.get_event_loop()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        async for v in ensure_async_generator(values):
-            futures.append(loop.run_in_executor(executor, _return_result_and_value, v))
-        for future in asyncio.as_completed(futures):
-            future_result, future_value = await future
-            yield future_result, future_value
+    limit = _map_max_concurrency()
+    # Task to the order it was started in
+    pending = {}
 
+    async def finished():
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        return [(pending.pop(task), task) for task in done]
 
-async def map_serial(func, values, value_path):
-    """
-    We call map for synchronous functions operating in serial.
-    See the `handle_map` function for more details regarding parameters.
-    """
-    async for v in ensure_async_generator(values):
-        try:
-            yield func(get_nested_dict_value(v, value_path)), v
-        except Exception as e:
-            yield e, v
+    try:
+        started = 0
+        async for v in ensure_async_generator(values):
+            if len(pending) >= limit:
+                for _, task in sorted(await finished(), key=lambda t: t[0]):
+                    yield task.result()
+            pending[asyncio.ensure_future(_call_with_value(call, v, value_path))] = started
+            started += 1
+        while pending:
+            for _, task in sorted(await finished(), key=lambda t: t[0]):
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
 
 
 async def _annotate_map_results_with_metadata(function, results, value_path, func_kwargs):
@@ -401,13 +556,19 @@ async def _annotate_map_results_with_metadata(function, results, value_path, fun
     If the result is an Exception, we wrap it in a DAGExecutionException and
     use that as our result. This allows for some items to fail while others
     were processed just fine.
-    Lastly, the provenance is added to our result.
+    Lastly, the provenance is added to our result. With compact provenance,
+    we only copy the value into it if it has no provenance of its own.
     """
+    compact = _compact_provenance()
     async for map_result, item in results:
+        if compact and 'provenance' in item:
+            value = None
+        else:
+            value = {k: v for k, v in item.items() if k != 'provenance'}
         provenance = {
             'function': function,
             'func_kwargs': func_kwargs,
-            'value': {k: v for k, v in item.items() if k != 'provenance'},
+            'value': value,
             'value_path': value_path,
             'provenance': item['provenance'] if 'provenance' in item else {}
         }
@@ -428,14 +589,6 @@ async def _annotate_map_results_with_metadata(function, results, value_path, fun
         yield out
 
 
-MAPS = {
-    'map_parallel': map_parallel,
-    'map_serial': map_serial,
-    'map_coroutine_parallel': map_coroutine_parallel,
-    'map_coroutine_serial': map_coroutine_serial
-}
-
-
 @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.MAP)
 async def handle_map(functions, function_name, values, value_path, func_kwargs=None, parallel=False):
     """
@@ -488,17 +641,24 @@ async def handle_map(functions, function_name, values, value_path, func_kwargs=N
         return ensure_async_generator(exception)
     func_with_kwargs = functools.partial(func, **func_kwargs)
     is_coroutine = inspect.iscoroutinefunction(func)
-    map_function = MAPS[f'map{"_coroutine" if is_coroutine else ""}_{"parallel" if parallel else "serial"}']
 
-    results = map_function(func_with_kwargs, values, value_path)
-    if inspect.isawaitable(results):
-        results = await results
+    async def call(value):
+        # Serial maps of plain functions run in the event loop, unless
+        # the function asked for a worker pool
+        return await learning_observer.worker_pools.call(
+            function_name, func_with_kwargs, value,
+            is_coroutine=is_coroutine, in_pool=parallel
+        )
+
+    map_function = map_parallel if parallel else map_serial
+    results = map_function(call, values, value_path)
 
     output = _annotate_map_results_with_metadata(function_name, results, value_path, func_kwargs)
     return output
 
 
 @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.SELECT)
+@_chunked
 async def handle_select(keys, fields=learning_observer.communication_protocol.query.SelectFields.Missing):
     """
     We dispatch this function whenever we process a DISPATCH_MODES.SELECT node.
@@ -513,61 +673,80 @@ async def handle_select(keys, fields=learning_observer.communication_protocol.qu
     where the keys are the dot notation you are looking for and the values are
     the key they are returned under.
 
+    We fetch keys a chunk at a time, with one `multiget` per chunk. When
+    specific fields are requested, we only ask the KVS for the top-level
+    fields they live under (see `multiget_fields`), so stores which keep
+    values field-by-field can skip the rest.
+
     TODO add in test cases once we pass kvs as a parameter
     """
     fields_to_keep = fields
     if fields is None or fields == learning_observer.communication_protocol.query.SelectFields.Missing:
         fields_to_keep = {}
 
-    # Collect all keys from the async generator
-    keys_list = []
-    async for k in ensure_async_generator(keys):
-        if isinstance(k, dict) and 'key' in k:
-            keys_list.append(k)
-        else:
-            raise DAGExecutionException(
-                f'Key not formatted correctly for select: {k}',
-                inspect.currentframe().f_code.co_name,
-                {'keys': keys, 'fields': fields}
-            )
+    # The top-level fields to read, or `None` for the whole value
+    projection = None
+    if fields != learning_observer.communication_protocol.query.SelectFields.All:
+        projection = sorted({str(f).split('.')[0] for f in fields_to_keep})
 
-    # Batch fetch all values from KVS
     kvs = learning_observer.kvs.KVS()
-    kvs_keys = [k['key'] for k in keys_list]
-    resulting_values = await kvs.multiget(kvs_keys)
-
-    # Process each key and its corresponding value
-    for k, resulting_value in zip(keys_list, resulting_values):
-        query_response_element = {
-            'provenance': {
-                'key': k['key'],
-                'provenance': k['provenance']
+    selected_keys_watch = SELECTED_KEYS_WATCH.get()
+    async for chunk in ensure_async_chunks(keys, _dag_chunk_size()):
+        for k in chunk:
+            if not isinstance(k, dict) or 'key' not in k:
+                raise DAGExecutionException(
+                    f'Key not formatted correctly for select: {k}',
+                    inspect.currentframe().f_code.co_name,
+                    {'keys': keys, 'fields': fields}
+                )
+
+        # Batch fetch this chunk's values from KVS
+        kvs_keys = [k['key'] for k in chunk]
+        # Watch before reading, so we don't miss a change in between
+        if selected_keys_watch is not None:
+            selected_keys_watch.watch(kvs_keys)
+        if projection is None:
+            resulting_values = await kvs.multiget(kvs_keys)
+        elif projection:
+            resulting_values = await kvs.multiget_fields(kvs_keys, projection)
+        else:
+            # No fields, so we only need the provenance
+            resulting_values = [None] * len(kvs_keys)
+
+        # Process each key and its corresponding value
+        query_response_chunk = []
+        for k, resulting_value in zip(chunk, resulting_values):
+            query_response_element = {
+                'provenance': {
+                    'key': k['key'],
+                    'provenance': k['provenance']
+                }
             }
-        }
 
-        # Use default value if KVS returned None
-        if resulting_value is None:
-            resulting_value = k.get('default', None)
+            # Use default value if KVS returned None
+            if resulting_value is None:
+                resulting_value = k.get('default', None)
 
-        # Determine fields to keep based on the current resulting_value if fields is All
-        if fields == learning_observer.communication_protocol.query.SelectFields.All:
-            current_fields_to_keep = {key: key for key in resulting_value.keys() if key != 'provenance'} if resulting_value else {}
-        else:
-            current_fields_to_keep = fields_to_keep
+            # Determine fields to keep based on the current resulting_value if fields is All
+            if fields == learning_observer.communication_protocol.query.SelectFields.All:
+                current_fields_to_keep = {key: key for key in resulting_value.keys() if key != 'provenance'} if resulting_value else {}
+            else:
+                current_fields_to_keep = fields_to_keep
 
-        # Populate the query response element with the specified fields
-        for f in current_fields_to_keep:
-            try:
-                value = get_nested_dict_value(resulting_value, f)
-            except KeyError as e:
-                value = DAGExecutionException(
-                    f'KeyError: key `{f}` not found in `{resulting_value.keys()}`',
-                    inspect.currentframe().f_code.co_name,
-                    {'target': resulting_value, 'key': f, 'exception': e}
-                ).to_dict()
-            query_response_element[current_fields_to_keep[f]] = value
+            # Populate the query response element with the specified fields
+            for f in current_fields_to_keep:
+                try:
+                    value = get_nested_dict_value(resulting_value, f)
+                except KeyError as e:
+                    value = DAGExecutionException(
+                        f'KeyError: key `{f}` not found in `{resulting_value.keys()}`',
+                        inspect.currentframe().f_code.co_name,
+                        {'target': resulting_value, 'key': f, 'exception': e}
+                    ).to_dict()
+                query_response_element[current_fields_to_keep[f]] = value
 
-        yield query_response_element
+            query_response_chunk.append(query_response_element)
+        yield query_response_chunk
 
 
 def _normalize_scope_field_key(key):
@@ -638,6 +817,12 @@ def _is_single_value(value):
     return isinstance(value, SingleValue)
 
 
+def _is_streamed(value):
+    """Check if a scope value is an async iterable whose items may arrive
+    slowly (i.e. not in memory, and not already chunked)."""
+    return isinstance(value, collections.abc.AsyncIterable) and not hasattr(value, 'chunks')
+
+
 def _normalize_scope_value(value):
     """Normalize a scope field value for consistent handling.
 
@@ -746,40 +931,84 @@ async def _async_zip_many(iterables):
         return
 
 
-async def _extract_fields_with_provenance(scope_specs):
-    """Prepare the key field dictionary and provenance for each scope tuple."""
+def _fields_with_provenance(scope_specs, items, interned=None):
+    """Build the key field dictionary and provenance for one scope tuple.
+
+    If `interned` is a dictionary, we build compact provenance, which
+    records the values used in the key rather than the items they came
+    from, and share identical entries through `interned`.
+
+    >>> scope_specs = [(learning_observer.stream_analytics.fields.KeyField.STUDENT, None, 'user_id')]
+    >>> _fields_with_provenance(scope_specs, [{'user_id': 'bob', 'name': 'Bob'}])[1]
+    {'STUDENT': {'value': {'user_id': 'bob', 'name': 'Bob'}, 'user_id': 'bob'}}
+    >>> _fields_with_provenance(scope_specs, [{'user_id': 'bob', 'name': 'Bob'}], interned={})[1]
+    {'STUDENT': {'value': {'user_id': 'bob'}, 'user_id': 'bob'}}
+    """
+    fields = {}
+    provenance = {}
+    for (field, _, path), item in zip(scope_specs, items):
+        field_value = get_nested_dict_value(item, path or '', '')
+        fields[field] = field_value
+        if interned is not None:
+            item_provenance = _compact_item_provenance(item, path, field_value, interned)
+        else:
+            item_provenance = item.get('provenance', {'value': item}) if isinstance(item, dict) else {'value': item}
+            if path:
+                item_provenance[path] = field_value
+        provenance[_provenance_key_for_field(field)] = item_provenance
+    return fields, provenance
+
+
+def _compact_item_provenance(item, path, field_value, interned):
+    """
+    Compact provenance for one scope value. Items with their own provenance
+    keep it, and otherwise we record just `{'value': {path: field_value}}`.
+    Both keep `path` alongside, as full provenance does, so joins on e.g.
+    `provenance.provenance.STUDENT.value.user_id` work either way.
+    """
+    if isinstance(item, dict) and 'provenance' in item:
+        if not path:
+            return item['provenance']
+        return {**item['provenance'], path: field_value}
+    if not path:
+        return {'value': item}
+    try:
+        entry = interned.get((path, field_value))
+    except TypeError:
+        # Unhashable values aren't worth interning
+        return {'value': {path: field_value}, path: field_value}
+    if entry is None:
+        entry = {'value': {path: field_value}, path: field_value}
+        interned[(path, field_value)] = entry
+    return entry
+
+
+async def _extract_fields_with_provenance(scope_specs, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Prepare the key field dictionary and provenance for each scope tuple,
+    yielding lists of up to `chunk_size` of them."""
     if not scope_specs:
         return
+    interned = {} if _compact_provenance() else None
 
     if len(scope_specs) == 1:
         # Single dimension: simple iteration
-        field, values, path = scope_specs[0]
-        async for item in ensure_async_generator(_expand_scope_value(values, broadcast=False)):
-            field_value = get_nested_dict_value(item, path or '', '')
-            fields = {field: field_value}
-            item_provenance = item.get('provenance', {'value': item}) if isinstance(item, dict) else {'value': item}
-            if path:
-                item_provenance[path] = field_value
-            provenance = {_provenance_key_for_field(field): item_provenance}
-            yield fields, provenance
+        _, values, _ = scope_specs[0]
+        scope_tuples = ensure_async_chunks(_expand_scope_value(values, broadcast=False), chunk_size)
+        async for chunk in scope_tuples:
+            yield [_fields_with_provenance(scope_specs, (item,), interned) for item in chunk]
         return
 
     # Multiple dimensions: zip with broadcasting for single values
     # Avoid infinite iteration when all dimensions are single values.
     broadcast = not all(_is_single_value(values) for _, values, _ in scope_specs)
     iterables = [_expand_scope_value(values, broadcast=broadcast) for _, values, _ in scope_specs]
+    zipped = _async_zip_many(iterables)
+    if not any(_is_streamed(values) for _, values, _ in scope_specs):
+        # Nothing waits between items, so we can fill chunks
+        zipped = _ChunkedAsyncIterable(async_batched(zipped, chunk_size))
 
-    async for items in _async_zip_many(iterables):
-        fields = {}
-        provenance = {}
-        for (field, _, path), item in zip(scope_specs, items):
-            field_value = get_nested_dict_value(item, path or '', '')
-            fields[field] = field_value
-            item_provenance = item.get('provenance', {'value': item}) if isinstance(item, dict) else {'value': item}
-            if path:
-                item_provenance[path] = field_value
-            provenance[_provenance_key_for_field(field)] = item_provenance
-        yield fields, provenance
+    async for chunk in ensure_async_chunks(zipped, chunk_size):
+        yield [_fields_with_provenance(scope_specs, items, interned) for items in chunk]
 
 
 def _resolve_scope_specs(scope, kwargs):
@@ -845,13 +1074,11 @@ def _resolve_scope_specs(scope, kwargs):
 
 
 def _find_reducer_by_key(function):
-    for reducer in learning_observer.module_loader.reducers():
-        if reducer.get('id') == function or reducer.get('string_id') == function:
-            return reducer
-    return None
+    return learning_observer.module_loader.find_reducer(function)
 
 
 @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.KEYS)
+@_chunked
 async def handle_keys(function, **kwargs):
     """
     This function is a HACK that is being used instead of `handle_keys` for any
@@ -863,7 +1090,8 @@ async def handle_keys(function, **kwargs):
 
     This function supports creation of keys based on the reducer scope.
     We create a list of fields needed for the `make_key()` function as well as the provenance
-    associated with each. These are zipped together and returned to the user.
+    associated with each. These are zipped together and returned to the user,
+    a chunk at a time.
     """
     # TODO do something if `func` is not found
     func = _find_reducer_by_key(function)
@@ -872,22 +1100,35 @@ async def handle_keys(function, **kwargs):
     scope_specs = _resolve_scope_specs(func.get('scope', []), kwargs)
     if scope_specs is None:
         return
-    fields_and_provenances = _extract_fields_with_provenance(scope_specs)
+    fields_and_provenances = _extract_fields_with_provenance(scope_specs, _dag_chunk_size())
+    key_template = learning_observer.stream_analytics.helpers.key_template(
+        func['function'],
+        learning_observer.stream_analytics.fields.Scope(field for field, values, path in scope_specs),
+        learning_observer.stream_analytics.fields.KeyStateType.INTERNAL
+    )
 
-    if fields_and_provenances is None:
-        return
-    async for f, p in fields_and_provenances:
-        key = learning_observer.stream_analytics.helpers.make_key(
-            func['function'],
-            f,
-            learning_observer.stream_analytics.fields.KeyStateType.INTERNAL
-        )
-        key_wrapper = {
-            'key': key,
-            'provenance': p,
-            'default': func['default']
-        }
-        yield key_wrapper
+    async for chunk in fields_and_provenances:
+        key_wrappers = []
+        for f, p in chunk:
+            key = key_template.make_key(f)
+            key_wrappers.append({
+                'key': key,
+                'provenance': p,
+                'default': func['default']
+            })
+        yield key_wrappers
+
+
+@handler(learning_observer.communication_protocol.query.DISPATCH_MODES.SELECT_BY_SCOPE)
+def handle_select_by_scope(function, fields=learning_observer.communication_protocol.query.SelectFields.Missing, **kwargs):
+    """
+    We dispatch this function whenever we process a DISPATCH_MODES.SELECT_BY_SCOPE
+    node. This is `select(keys(function, **kwargs), fields)` in one node: keys
+    go straight from `handle_keys` to `handle_select`, a chunk at a time,
+    without passing through the DAG. `ExecutionPlan` rewrites `select(keys(...))`
+    pairs into these.
+    """
+    return handle_select(handle_keys(function, **kwargs), fields)
 
 
 def _has_error(node):
@@ -975,10 +1216,183 @@ def strip_provenance(variable):
 
 
 async def _clean_json_via_generator(iterator):
+    if isinstance(iterator, _SharedAsyncIterable):
+        # Take whole chunks, to skip per-item coordination
+        async for chunk in iterator.chunks():
+            for item in chunk:
+                yield clean_json(item)
+        return
     async for item in ensure_async_generator(iterator):
         yield clean_json(item)
 
 
+def _is_variable(value):
+    return isinstance(value, dict) and value.get(dispatch) == learning_observer.communication_protocol.query.DISPATCH_MODES.VARIABLE
+
+
+def _variable_references(node_dict, references):
+    '''
+    Collect the names of the nodes `node_dict` refers to, in the order
+    we'd visit them.
+    '''
+    for child_value in node_dict.values():
+        if _is_variable(child_value):
+            if child_value['variable_name'] not in references:
+                references.append(child_value['variable_name'])
+        elif isinstance(child_value, dict):
+            _variable_references(child_value, references)
+    return references
+
+
+def _bind(node_dict, results):
+    '''
+    Build a node for execution from its (unchanging) definition in a
+    plan, substituting the results of the nodes it refers to. We copy
+    the definition, since the functions we call may modify their
+    arguments.
+    '''
+    bound = {}
+    for child_key, child_value in node_dict.items():
+        if _is_variable(child_value):
+            bound[child_key] = results[child_value['variable_name']]
+        elif isinstance(child_value, dict):
+            bound[child_key] = _bind(child_value, results)
+        elif isinstance(child_value, (list, set)):
+            bound[child_key] = copy.deepcopy(child_value)
+        else:
+            bound[child_key] = child_value
+    return bound
+
+
+class ExecutionPlan:
+    '''
+    An execution DAG, prepared for running many times.
+
+    We flatten the DAG, and work out which nodes each node refers to,
+    once. Executing the plan only binds parameters, and never modifies
+    the plan, so one plan can be shared between dashboards and reruns.
+
+    Use `compile_dag` to create (or reuse) plans.
+    '''
+    def __init__(self, flat_endpoint):
+        self.exports = flat_endpoint.get('exports', {})
+        self.nodes = self._fuse_selects(flat_endpoint.get('execution_dag', {}))
+        self.references = {
+            node_name: _variable_references(node, []) if isinstance(node, dict) else []
+            for node_name, node in self.nodes.items()
+        }
+        self.circular = self._find_circular_nodes()
+
+    def _fuse_selects(self, nodes):
+        '''
+        Rewrite each `select` of a `keys` node into one `select_by_scope`
+        node, if nothing else uses the `keys` node. We return a new
+        dictionary, and don't modify `nodes`.
+        '''
+        modes = learning_observer.communication_protocol.query.DISPATCH_MODES
+        uses = collections.Counter()
+        for node in nodes.values():
+            if isinstance(node, dict):
+                uses.update(_variable_references(node, []))
+        exported = {export.get('returns') for export in self.exports.values()}
+
+        fused = dict(nodes)
+        for node_name, node in nodes.items():
+            if not isinstance(node, dict) or node.get(dispatch) != modes.SELECT:
+                continue
+            keys = node.get('keys')
+            if not _is_variable(keys):
+                continue
+            keys_name = keys['variable_name']
+            keys_node = nodes.get(keys_name)
+            if not isinstance(keys_node, dict) or keys_node.get(dispatch) != modes.KEYS:
+                continue
+            if uses[keys_name] != 1 or keys_name in exported:
+                continue
+            fused[node_name] = {**keys_node, dispatch: modes.SELECT_BY_SCOPE, 'fields': node.get('fields')}
+            del fused[keys_name]
+        return fused
+
+    def _find_circular_nodes(self):
+        '''
+        Return the nodes which (indirectly) refer to themselves. We can't
+        run these, and since we run branches concurrently, we'd deadlock
+        waiting for them if we tried.
+        '''
+        circular = set()
+        for start in self.nodes:
+            stack = list(self.references[start])
+            seen = set()
+            while stack:
+                node_name = stack.pop()
+                if node_name == start:
+                    circular.add(start)
+                    break
+                if node_name in seen or node_name not in self.nodes:
+                    continue
+                seen.add(node_name)
+                stack.extend(self.references[node_name])
+        return circular
+
+    def resolve_targets(self, target_exports):
+        '''
+        Return the nodes to run for `target_exports`, and errors for any
+        which can't be found.
+        '''
+        target_nodes = []
+        target_errors = {}  # maps target node name -> error dict
+
+        for key in target_exports:
+            if key not in self.exports:
+                # Unknown export requested
+                target_name = f'__missing_export__:{key}'
+                target_nodes.append(target_name)
+                target_errors[target_name] = DAGExecutionException(
+                    f'Export `{key}` not found in endpoint.exports.',
+                    'execute_dag',
+                    {'requested_export': key, 'available_exports': list(self.exports.keys())}
+                ).to_dict()
+                continue
+
+            target_node = self.exports[key].get('returns')
+            if target_node not in self.nodes:
+                # Export exists, but its `returns` node is missing from the DAG
+                target_name = f'__missing_export__:{key}'
+                target_nodes.append(target_name)
+                target_errors[target_name] = DAGExecutionException(
+                    f'Target DAG node `{target_node}` not found in execution_dag.',
+                    'execute_dag',
+                    {'target_node': target_node, 'available_nodes': list(self.nodes.keys())}
+                ).to_dict()
+                continue
+
+            target_nodes.append(target_node)
+        return target_nodes, target_errors
+
+
+# Compiled plans, by DAG. Most DAGs are named DAGs from modules, so
+# this stays small.
+_PLAN_CACHE = collections.OrderedDict()
+PLAN_CACHE_SIZE = 128
+
+
+def compile_dag(endpoint):
+    '''
+    Return an `ExecutionPlan` for an (unflattened) endpoint, reusing a
+    cached one if we've seen the same DAG before.
+    '''
+    cache_key = json.dumps(endpoint, sort_keys=True, default=repr)
+    plan = _PLAN_CACHE.get(cache_key)
+    if plan is None:
+        plan = ExecutionPlan(learning_observer.communication_protocol.util.flatten(copy.deepcopy(endpoint)))
+        _PLAN_CACHE[cache_key] = plan
+        if len(_PLAN_CACHE) > PLAN_CACHE_SIZE:
+            _PLAN_CACHE.popitem(last=False)
+    else:
+        _PLAN_CACHE.move_to_end(cache_key)
+    return plan
+
+
 async def execute_dag(endpoint, parameters, functions, target_exports):
     """
     This is the primary way to execute a DAG.
@@ -986,41 +1400,29 @@ async def execute_dag(endpoint, parameters, functions, target_exports):
     a dictionary of available functions, and a list of exports they wish to
     receive data back for.
 
+    The endpoint should already be flattened (see `util.flatten`). To run
+    the same DAG repeatedly, use `compile_dag` and `execute_plan`.
+
     See `learning_observer/communication_protocol/test_cases.py` for usage examples.
     """
-    exports = endpoint.get('exports', {})
-    nodes = endpoint.get('execution_dag', {})
-    visited = set()
-
-    # --- Resolve targets and collect any obvious errors early ---
-    target_nodes = []
-    target_errors = {}  # maps target node name -> error dict
-
-    for key in target_exports:
-        if key not in exports:
-            # Unknown export requested
-            target_name = f'__missing_export__:{key}'
-            target_nodes.append(target_name)
-            target_errors[target_name] = DAGExecutionException(
-                f'Export `{key}` not found in endpoint.exports.',
-                inspect.currentframe().f_code.co_name,
-                {'requested_export': key, 'available_exports': list(exports.keys())}
-            ).to_dict()
-            continue
+    return await execute_plan(ExecutionPlan(endpoint), parameters, functions, target_exports)
 
-        target_node = exports[key].get('returns')
-        if target_node not in nodes:
-            # Export exists, but its `returns` node is missing from the DAG
-            target_name = f'__missing_export__:{key}'
-            target_nodes.append(target_name)
-            target_errors[target_name] = DAGExecutionException(
-                f'Target DAG node `{target_node}` not found in execution_dag.',
-                inspect.currentframe().f_code.co_name,
-                {'target_node': target_node, 'available_nodes': list(nodes.keys())}
-            ).to_dict()
-            continue
 
-        target_nodes.append(target_node)
+async def execute_plan(plan, parameters, functions, target_exports):
+    """
+    Execute a compiled `ExecutionPlan`. See `execute_dag`.
+
+    Nodes whose inputs are ready run concurrently, up to
+    `dag_max_concurrency` at once. Each node runs at most once, however
+    many nodes refer to it.
+    """
+    nodes = plan.nodes
+    # Node name to the task computing its result, for this execution
+    tasks = {}
+    max_concurrency = _dag_max_concurrency()
+    semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+    target_nodes, target_errors = plan.resolve_targets(target_exports)
 
     async def dispatch_node(node):
         """
@@ -1048,54 +1450,72 @@ async def execute_dag(endpoint, parameters, functions, target_exports):
         except DAGExecutionException as e:
             return e.to_dict()
 
-    async def walk_dict(node_dict):
-        """
-        We walk through the execution DAG backwards. We visit any variable nodes
-        we find and cache their stored value.
-        """
-        for child_key, child_value in list(node_dict.items()):
-            if isinstance(child_value, dict) and dispatch in child_value and child_value[dispatch] == learning_observer.communication_protocol.query.DISPATCH_MODES.VARIABLE:
-                node_dict[child_key] = await visit(child_value['variable_name'])
-            elif isinstance(child_value, dict):
-                await walk_dict(child_value)
-
-    async def visit(node_name):
+    def visit(node_name):
         """
         When executing the DAG, we `visit()` nodes that we want output from.
         These will either be specified as target_nodes or be any descendents
         of the target_nodes.
 
-        If we've already visited a node, we return the result.
-        If any of the child nodes return errors, we return them.
+        Returns an awaitable for the node's result. If we've already
+        visited a node (or are visiting it), we share that.
+        """
+        if node_name not in tasks:
+            if node_name not in nodes:
+                raise KeyError(node_name)
+            tasks[node_name] = asyncio.ensure_future(evaluate(node_name))
+        return tasks[node_name]
+
+    async def evaluate(node_name):
         """
-        # We've already done this one.
-        if node_name in visited:
-            return nodes[node_name]
+        Run one node, once the nodes it depends on have run. If any of
+        them returned errors, we return those instead.
+        """
+        if node_name in plan.circular:
+            return DAGExecutionException(
+                f'Circular reference to `{node_name}` in execution_dag.',
+                inspect.currentframe().f_code.co_name,
+                {'node': node_name}
+            ).to_dict()
+        definition = nodes[node_name]
+        if not isinstance(definition, dict):
+            return definition
+
         # Execute all the child nodes
-        await walk_dict(nodes[node_name])
+        child_names = plan.references[node_name]
+        child_values = await asyncio.gather(*[visit(child_name) for child_name in child_names])
+        node = _bind(definition, dict(zip(child_names, child_values)))
 
         # Check for any errors, then dispatch the node
         # if errors are present, we bubble them up the DAG
-        error, error_path = _has_error(nodes[node_name])
+        error, error_path = _has_error(node)
         if error is not None:
-            nodes[node_name] = {
+            result = {
                 'error': error,
-                'dispatch': nodes[node_name]['dispatch'],
+                'dispatch': node['dispatch'],
                 'error_path': error_path
             }
             error_texts = '\n'.join((f'  {e}' for e in _find_error_messages(error)))
-            tb = nodes[node_name]["error"].get("traceback", 'No traceback available')
+            tb = result["error"].get("traceback", 'No traceback available')
             debug_log('ERROR:: Error occured within execution dag at '\
                       f'{node_name}\n{tb}\n'\
                       f'{error_texts}')
         else:
-            nodes[node_name] = await dispatch_node(nodes[node_name])
-            if isinstance(nodes[node_name], collections.abc.AsyncIterable) and not isinstance(nodes[node_name], _SharedAsyncIterable):
-                nodes[node_name] = _SharedAsyncIterable(nodes[node_name])
-
+            async with semaphore:
+                result = await dispatch_node(node)
+            if isinstance(result, collections.abc.AsyncIterable) and not isinstance(result, _SharedAsyncIterable):
+                result = _SharedAsyncIterable(result)
+        return result
 
-        visited.add(node_name)
-        return nodes[node_name]
+    runnable_targets = [e for e in target_nodes if e not in target_errors]
+    try:
+        target_results = dict(zip(
+            runnable_targets,
+            await asyncio.gather(*[visit(e) for e in runnable_targets])
+        ))
+    finally:
+        # If a node failed, don't leave its siblings running
+        for task in tasks.values():
+            task.cancel()
 
     out = {}
     async_iterable_cache = {}
@@ -1104,7 +1524,7 @@ async def execute_dag(endpoint, parameters, functions, target_exports):
             out[e] = _clean_json_via_generator(target_errors[e])
             continue
 
-        node_result = await visit(e)
+        node_result = target_results[e]
         if isinstance(node_result, collections.abc.AsyncIterable):
             shared_iterable = async_iterable_cache.get(id(node_result))
             if shared_iterable is None:
@@ -1117,23 +1537,3 @@ async def execute_dag(endpoint, parameters, functions, target_exports):
 
 
     return out
-
-    # Include execution history in output if operating in development settings
-    if learning_observer.settings.RUN_MODE == learning_observer.settings.RUN_MODES.DEV:
-        return {e: _clean_json_via_generator(await visit(e)) for e in target_nodes}
-    # HACK currently `dashboard.py` relies on the provenance to tell users which
-    # items need updating, such as John Doe's history essay. This ought to be
-    # handled by the communication protocol during execution. Once that occurs,
-    # we can go back to stripping the provenance out.
-    return {e: _clean_json_via_generator(await visit(e)) for e in target_nodes}
-    # TODO test this code to make sure it works with async generators
-    # Remove execution history if in deployed settings, with data flowing back to teacher dashboards
-    return {e: _clean_json_via_generator(strip_provenance(await visit(e))) for e in target_nodes}
-
-
-if __name__ == "__main__":
-    import doctest
-    # This function is used by doctests
-    from learning_observer.util import async_generator_to_list
-
-    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -4,10 +4,9 @@ Learning Observer platform and publishing functions from
 the Learning Observer platform into the communications
 protocol.
 '''
-import copy
-
 import learning_observer.communication_protocol.executor
 import learning_observer.communication_protocol.util
+import learning_observer.worker_pools
 
 FUNCTIONS = {}
 DUPLICATE_FUNCTION_FOUND = """Duplicate function name found: {name}.
@@ -18,12 +17,19 @@ any duplicates.
 """
 
 
-def publish_function(name):
+def publish_function(name, worker_pool=None, max_concurrency=None, timeout=None):
     """
     To expose functions to the communications protocol, we have to
     pass in a dictionary of functions to the DAG executor. The Learning
     Observer system will pass the `FUNCTIONS` dictionary to the executor.
     This decorator adds a function to FUNCTIONS.
+
+    `worker_pool`, `max_concurrency`, and `timeout` limit how `call`
+    and `map` nodes call the function (see
+    `learning_observer.worker_pools`). E.g. a function calling a
+    rate-limited service might set `max_concurrency`, and a CPU-bound
+    one might use a process pool. For functions which return an async
+    generator, the limits only cover starting it, not iterating over it.
     """
     def decorator(f):
         if name in FUNCTIONS:
@@ -31,6 +37,13 @@ def publish_function(name):
             # use case: we may want to overwrite the roster function for a specific system
             raise KeyError(DUPLICATE_FUNCTION_FOUND.format(name=name))
         FUNCTIONS[name] = f
+        if worker_pool is not None or max_concurrency is not None or timeout is not None:
+            learning_observer.worker_pools.set_function_limits(
+                name,
+                worker_pool=worker_pool,
+                max_concurrency=max_concurrency,
+                timeout=timeout
+            )
         return f
     return decorator
 
@@ -60,8 +73,8 @@ def add_exports_to_module(execution_dag, module):
     for query_name in execution_dag['exports']:
         def set_query_with_name(name):
             async def query_func(**kwargs):  # create new function
-                flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(execution_dag))
-                output = await learning_observer.communication_protocol.executor.execute_dag(flat, parameters=kwargs, functions=FUNCTIONS, target_exports=[query_name])
+                plan = learning_observer.communication_protocol.executor.compile_dag(execution_dag)
+                output = await learning_observer.communication_protocol.executor.execute_plan(plan, parameters=kwargs, functions=FUNCTIONS, target_exports=[name])
                 return output
             if hasattr(module, name):
                 raise AttributeError(f'Attibute, {name}, already exists under {module}')
@@ -80,8 +93,9 @@ def prepare_dag_execution(query, targets):
         query_function = prepare_dag_execution(query_obj)
         result = await query_function(param1=value1, param2=value2)
     '''
+    plan = learning_observer.communication_protocol.executor.compile_dag(query)
+
     async def query_func(**kwargs):
-        flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(query))
-        output = await learning_observer.communication_protocol.executor.execute_dag(flat, parameters=kwargs, functions=FUNCTIONS, target_exports=targets)
+        output = await learning_observer.communication_protocol.executor.execute_plan(plan, parameters=kwargs, functions=FUNCTIONS, target_exports=targets)
         return output
     return query_func
@@ -1,5 +1,5 @@
 const DISPATCH_MODES = {}
-const dispatchModes = ['parameter', 'variable', 'call', 'select', 'join', 'map', 'keys']
+const dispatchModes = ['parameter', 'variable', 'call', 'select', 'join', 'map', 'keys', 'select_by_scope']
 dispatchModes.forEach((mode) => {
   DISPATCH_MODES[mode.toUpperCase()] = mode
 })
@@ -71,6 +71,15 @@ function keys (func, { ...kwargs } = {}) {
   }
 }
 
+function selectByScope (func, fields = null, { ...kwargs } = {}) {
+  return {
+    dispatch: DISPATCH_MODES.SELECT_BY_SCOPE,
+    function: func,
+    fields,
+    ...kwargs
+  }
+}
+
 export {
   parameter,
   call,
@@ -78,5 +87,6 @@ export {
   select,
   join,
   map,
-  keys
+  keys,
+  selectByScope
 }
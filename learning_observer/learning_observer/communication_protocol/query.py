@@ -26,7 +26,7 @@ class DISPATCH_MODES:
     pass
 
 
-dispatch_modes = ['parameter', 'variable', 'call', 'select', 'join', 'map', 'keys']
+dispatch_modes = ['parameter', 'variable', 'call', 'select', 'join', 'map', 'keys', 'select_by_scope']
 [setattr(DISPATCH_MODES, d.upper(), d) for d in dispatch_modes]
 
 
@@ -121,3 +121,17 @@ def keys(func, **kwargs):
         "function": func,
         **kwargs
     }
+
+
+def select_by_scope(func, fields=None, **kwargs):
+    """
+    Select by scope is `select(keys(func, **kwargs), fields)` in a single
+    node: it collects data from the KVS for each item in the scope. The
+    executor does this rewrite itself where it can.
+    """
+    return {
+        dispatch: DISPATCH_MODES.SELECT_BY_SCOPE,
+        "function": func,
+        "fields": fields,
+        **kwargs
+    }
@@ -10,6 +10,7 @@ place than we started.
 import asyncio
 import copy
 import datetime
+import hashlib
 import inspect
 import json
 import aiohttp.client_exceptions
@@ -45,6 +46,7 @@ import learning_observer.communication_protocol.integration
 import learning_observer.communication_protocol.query
 import learning_observer.communication_protocol.schema
 import learning_observer.settings
+import learning_observer.single_flight
 
 pmss.register_field(
     name='dangerously_allow_insecure_dags',
@@ -64,6 +66,61 @@ pmss.register_field(
     default=False
 )
 
+pmss.register_field(
+    name='rerun_dags_on_change',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Rerun dashboard execution DAGs when the data they selected '\
+                'changes, rather than every `rerun_dag_delay` seconds. This '\
+                'needs a KVS with change notifications (in-memory, filesystem, '\
+                'or redis with `change_notifications` turned on).',
+    default=False
+)
+
+pmss.register_field(
+    name='rerun_dag_debounce_ms',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `rerun_dags_on_change`, how long (in milliseconds) to '\
+                'wait after a change before rerunning, so a burst of changes '\
+                'causes one rerun.',
+    default=250
+)
+
+pmss.register_field(
+    name='rerun_dag_max_delay',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `rerun_dags_on_change`, rerun a DAG after this many '\
+                'seconds even if nothing it selected changed, to pick up data '\
+                'from outside the KVS (e.g. rosters). 0 means never.',
+    default=300
+)
+
+pmss.register_field(
+    name='share_dag_executions',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Run identical dashboard queries from the same user (e.g. in '\
+                'several tabs, or on a projector) once, and share the results. '\
+                'Results are never shared between users.',
+    default=False
+)
+
+pmss.register_field(
+    name='shared_dag_result_ttl_ms',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `share_dag_executions`, how long (in milliseconds) a '\
+                'finished execution\'s results are reused for.',
+    default=1000
+)
+
+pmss.register_field(
+    name='send_partial_updates',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Send dashboards only the top-level fields of each value '\
+                'which changed since the last update, rather than the whole '\
+                'value. Clients merge updates into what they have, so this '\
+                'is safe for clients which follow the protocol.',
+    default=False
+)
+
 
 def timelist_to_seconds(timelist):
     '''
@@ -261,7 +318,8 @@ def fetch_student_state(
                     sa_module,
                     {sa_helpers.KeyField.STUDENT: student_id},
                     sa_helpers.KeyStateType.EXTERNAL)
-                data = await teacherkvs[key]
+                # Cleaners modify what they are given
+                data = await teacherkvs.get(key, mutable=True)
                 # debug_log(key, data)  # <-- Useful, but a lot of stuff is spit out.
                 if data is not None:
                     student_state[sa_helpers.fully_qualified_function_name(sa_module)] = data
@@ -584,6 +642,71 @@ async def _create_dag_generators(client_query, targets, request):
     return await _prepare_dag_as_generators(client_query, query, targets, request)
 
 
+class _SelectedKeys(set):
+    '''
+    Collects the keys `select` nodes read, for a shared execution (see
+    `executor.SELECTED_KEYS_WATCH`). Each dashboard watches them itself.
+    '''
+    def watch(self, keys):
+        self.update(keys)
+
+
+async def _collect_dag_results(client_query, targets, request):
+    '''
+    Run a DAG to completion, so the results can be shared between
+    dashboards. Returns a list of (targets, items) and the keys the DAG
+    selected, or `None` if the DAG could not run.
+    '''
+    selected_keys = _SelectedKeys()
+    learning_observer.communication_protocol.executor.SELECTED_KEYS_WATCH.set(selected_keys)
+    generators = await _create_dag_generators(client_query, targets, request)
+    if generators is None:
+        return None
+
+    async def _drain(generator):
+        return [item async for item in generator]
+
+    items = await asyncio.gather(*[_drain(generator) for target_group, generator in generators])
+    return [(target_group, target_items) for (target_group, generator), target_items in zip(generators, items)], selected_keys
+
+
+# Query arguments which change how often we run a DAG, but not what it returns
+_SCHEDULING_KWARGS = ['rerun_dag_delay']
+
+
+def _shared_dag_key(client_query, targets, user_context):
+    '''
+    What identifies a DAG execution for sharing: the DAG, targets, and
+    arguments, and who is asking. Since rosters and data access are per
+    user, we never share results between users.
+    '''
+    kwargs = {
+        key: value for key, value in client_query.get('kwargs', {}).items()
+        if key not in _SCHEDULING_KWARGS
+    }
+    return json.dumps({
+        'execution_dag': client_query['execution_dag'],
+        'targets': sorted(targets),
+        'kwargs': kwargs,
+        'user_id': user_context.get('user_id'),
+        'user_role': user_context.get('user_role')
+    }, sort_keys=True, default=str)
+
+
+SHARED_DAG_EXECUTIONS = None
+
+
+def _shared_dag_executions():
+    '''
+    The process-wide `SingleFlight` for dashboard DAG executions.
+    '''
+    global SHARED_DAG_EXECUTIONS
+    if SHARED_DAG_EXECUTIONS is None:
+        ttl = learning_observer.settings.pmss_settings.shared_dag_result_ttl_ms(types=['dashboard_settings'])
+        SHARED_DAG_EXECUTIONS = learning_observer.single_flight.SingleFlight(ttl=ttl / 1000)
+    return SHARED_DAG_EXECUTIONS
+
+
 def _scope_segment_for_provenance_key(key):
     if key == 'RESOURCE':
         return 'documents'
@@ -626,12 +749,7 @@ def _find_reducer_from_provenance_key(key):
     parts = key.split(',')
     if len(parts) < 2:
         return None
-    reducer_name = parts[1]
-    for reducer in learning_observer.module_loader.reducers():
-        function_name = sa_helpers.fully_qualified_function_name(reducer['function'])
-        if function_name == reducer_name:
-            return reducer
-    return None
+    return learning_observer.module_loader.find_reducer_by_key_name(parts[1])
 
 
 def _value_from_provenance_entry(key, entry):
@@ -718,6 +836,106 @@ def _find_student_or_resource(d):
     return []
 
 
+def _content_hash(value):
+    '''
+    A hash of a JSON value, to tell if it changed.
+    '''
+    encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+
+class DashboardUpdates:
+    '''
+    Updates waiting to be sent to one dashboard connection.
+
+    We rerun DAGs regularly, and most of what they return is the same
+    as last time. We remember a hash of what we sent for each path (and
+    export), and drop updates which would not change anything. Updates
+    to the same path which arrive before we send are coalesced, keeping
+    the latest.
+
+    Clients shallow-merge each update's value into what they have for
+    the path. With `partial`, we use this to only send the top-level
+    fields which changed. If the set of fields changes (e.g. an error
+    appears or clears), we send the whole value. Clients treat an update
+    without an `error` field as clearing the error, so partial updates
+    always include `error` if the value has one.
+
+    >>> updates = DashboardUpdates(partial=True)
+    >>> updates.add('students.s1', {'text': 'Hello', 'count': 1})
+    {'op': 'update', 'path': 'students.s1', 'value': {'text': 'Hello', 'count': 1}}
+    >>> updates.add('students.s1', {'text': 'Hello', 'count': 1}) is None
+    True
+    >>> updates.add('students.s1', {'text': 'Hello', 'count': 2})
+    {'op': 'update', 'path': 'students.s1', 'value': {'count': 2}}
+    >>> updates.take()
+    [{'op': 'update', 'path': 'students.s1', 'value': {'text': 'Hello', 'count': 2}}]
+    >>> updates.take()
+    []
+    >>> updates.add('students.s2', {'error': 'Timed out', 'count': 1})
+    {'op': 'update', 'path': 'students.s2', 'value': {'error': 'Timed out', 'count': 1}}
+    >>> updates.add('students.s2', {'error': 'Timed out', 'count': 2})
+    {'op': 'update', 'path': 'students.s2', 'value': {'count': 2, 'error': 'Timed out'}}
+    '''
+    def __init__(self, partial=False):
+        self.partial = partial
+        # (path, target) to update, in the order we should send them
+        self.pending = {}
+        # (path, target) to the hash of the value the client will have
+        # (or, with `partial`, a dictionary of field hashes)
+        self.sent = {}
+
+    def reset(self):
+        '''
+        Forget what we've sent, so every path is sent again in full
+        (e.g. when the client changes its query).
+        '''
+        self.sent.clear()
+
+    def add(self, path, value, target=None):
+        '''
+        Queue an update to `path`. Returns the update we queued (which
+        may only include changed fields), or `None` if nothing changed.
+        '''
+        slot = (path, target)
+        previous = self.sent.get(slot)
+        partial_update = False
+        if self.partial and isinstance(value, dict):
+            full_value = value
+            hashes = {field: _content_hash(field_value) for field, field_value in value.items()}
+            if isinstance(previous, dict) and previous.keys() == hashes.keys():
+                value = {field: field_value for field, field_value in value.items() if previous[field] != hashes[field]}
+                if not value:
+                    return None
+                if 'error' in hashes:
+                    value['error'] = full_value['error']
+                partial_update = True
+        else:
+            hashes = _content_hash(value)
+            if previous == hashes:
+                return None
+        self.sent[slot] = hashes
+
+        update = {'op': 'update', 'path': path, 'value': value}
+        queued = self.pending.pop(slot, None)
+        if partial_update and queued is not None:
+            # The client hasn't seen the queued update yet, so we fold
+            # ours into it
+            queued['value'] = {**queued['value'], **value}
+            self.pending[slot] = queued
+        else:
+            self.pending[slot] = dict(update)
+        return update
+
+    def take(self):
+        '''
+        Return the updates to send, and clear them.
+        '''
+        updates = list(self.pending.values())
+        self.pending.clear()
+        return updates
+
+
 # We track protocol log creation per-process so that concurrent websocket
 # connections produce unique filenames even when they open at the same time.
 DASHBOARD_PROTOCOL_LOG_COUNTER = 0
@@ -847,15 +1065,18 @@ async def websocket_dashboard_handler(request):
     await ws.prepare(request)
     client_query = None
     previous_client_query = None
-    pending_updates = []
+    pending_updates = DashboardUpdates(
+        partial=learning_observer.settings.pmss_settings.send_partial_updates(types=['dashboard_settings'])
+    )
     pending_updates_lock = asyncio.Lock()
     background_tasks = set()
 
-    async def _queue_update(update):
-        '''Send an update to our batch
+    async def _queue_update(path, value, target=None):
+        '''Send an update to our batch. Returns the update, or `None`
+        if the client already has this value.
         '''
         async with pending_updates_lock:
-            pending_updates.append(update)
+            return pending_updates.add(path, value, target)
 
     async def _send_pending_updates_to_client():
         '''If our queue has any items, send them to the client, clear
@@ -863,10 +1084,9 @@ async def websocket_dashboard_handler(request):
         '''
         while True:
             async with pending_updates_lock:
-                if pending_updates:
+                if pending_updates.pending:
                     try:
-                        await ws.send_json(pending_updates)
-                        pending_updates.clear()
+                        await ws.send_json(pending_updates.take())
                     except aiohttp.web_ws.WebSocketError:
                         break
                     except aiohttp.client_exceptions.ClientConnectionResetError:
@@ -876,35 +1096,90 @@ async def websocket_dashboard_handler(request):
             # TODO this ought to be pulled from somewhere
             await asyncio.sleep(1)
 
+    rerun_on_change = (
+        learning_observer.settings.pmss_settings.rerun_dags_on_change(types=['dashboard_settings'])
+        and kvs.KVS().change_notifications
+    )
+    share_executions = learning_observer.settings.pmss_settings.share_dag_executions(types=['dashboard_settings'])
+
+    async def _wait_for_changes(watch):
+        '''Wait until data a DAG selected changes (or for the
+        fallback delay), then a little longer, so a burst of changes
+        causes one rerun. Returns the keys which changed.
+        '''
+        max_delay = learning_observer.settings.pmss_settings.rerun_dag_max_delay(types=['dashboard_settings'])
+        changed = await watch.wait(timeout=max_delay or None)
+        if changed:
+            debounce = learning_observer.settings.pmss_settings.rerun_dag_debounce_ms(types=['dashboard_settings'])
+            await asyncio.sleep(debounce / 1000)
+        return changed
+
     async def _execute_dag(dag_query, targets, params):
         '''This method creates the DAG generator and drives it.
         Once finished, we wait until rescheduling it. If the parameters
         change, we exit before creating and driving the generator.
-        '''
-        if params != client_query:
-            # the params are different and we should stop this generator
-            return
 
-        # Create DAG generator and drive
-        generators = await _create_dag_generators(dag_query, targets, request)
-        if generators is None:
-            return
-        drive_tasks = []
-        for target_group, generator in generators:
-            drive_tasks.append(asyncio.create_task(
-                _drive_generator(generator, dag_query['kwargs'], targets=target_group)
-            ))
-        if drive_tasks:
-            await asyncio.gather(*drive_tasks)
-
-        # Handle rescheduling the execution of the DAG for fresh data
-        # TODO add some way to specify specific endpoint delays
-        dag_delay = dag_query['kwargs'].get('rerun_dag_delay', 10)
-        if dag_delay < 0:
-            # if dag_delay is negative, we skip repeated execution
-            return
-        await asyncio.sleep(dag_delay)
-        await _execute_dag(dag_query, targets, params)
+        By default, we rerun every `rerun_dag_delay` seconds. With
+        `rerun_dags_on_change`, we instead rerun when data the DAG
+        selected changes.
+
+        With `share_dag_executions`, identical queries from the same
+        user (e.g. several tabs) share one execution.
+        '''
+        watch = None
+        if rerun_on_change:
+            # `select` nodes add the keys they read to this. Tasks
+            # we create below inherit it. We keep it for the life of
+            # the query, so we also see changes made while we run.
+            watch = kvs.KVS().watch()
+            learning_observer.communication_protocol.executor.SELECTED_KEYS_WATCH.set(watch)
+        shared_key = None
+        if share_executions:
+            shared_key = _shared_dag_key(dag_query, targets, user_context)
+        try:
+            while params == client_query:
+                if shared_key is not None:
+                    shared = await _shared_dag_executions().run(
+                        shared_key, _collect_dag_results, dag_query, targets, request
+                    )
+                    if shared is None:
+                        return
+                    results, selected_keys = shared
+                    if watch is not None:
+                        watch.watch(selected_keys)
+                    generators = [
+                        (target_group, learning_observer.util.ensure_async_generator(items))
+                        for target_group, items in results
+                    ]
+                else:
+                    # Create DAG generator and drive
+                    generators = await _create_dag_generators(dag_query, targets, request)
+                    if generators is None:
+                        return
+                drive_tasks = []
+                for target_group, generator in generators:
+                    drive_tasks.append(asyncio.create_task(
+                        _drive_generator(generator, dag_query['kwargs'], targets=target_group)
+                    ))
+                if drive_tasks:
+                    await asyncio.gather(*drive_tasks)
+
+                # Handle rescheduling the execution of the DAG for fresh data
+                # TODO add some way to specify specific endpoint delays
+                dag_delay = dag_query['kwargs'].get('rerun_dag_delay', 10)
+                if dag_delay < 0:
+                    # if dag_delay is negative, we skip repeated execution
+                    return
+                if watch is not None:
+                    changed = await _wait_for_changes(watch)
+                    if changed and shared_key is not None:
+                        # Don't reuse a result from before the change
+                        _shared_dag_executions().forget(shared_key)
+                else:
+                    await asyncio.sleep(dag_delay)
+        finally:
+            if watch is not None:
+                watch.close()
 
     async def _drive_generator(generator, dag_kwargs, targets=None):
         '''For each item in the generator, this method creates
@@ -921,13 +1196,15 @@ async def websocket_dashboard_handler(request):
                     item_payload[f'option_hash_{target}'] = dag_kwargs['option_hash']
                 # TODO this ought to be flag - we might want to see the provenance in some settings
                 item_without_provenance = learning_observer.communication_protocol.executor.strip_provenance(item_payload)
-                update_payload = {'op': 'update', 'path': update_path, 'value': item_without_provenance}
+                update_payload = await _queue_update(update_path, item_without_provenance, target)
+                if update_payload is None:
+                    # The client already has this
+                    continue
                 _log_protocol_event(
                     'update_enqueued',
                     payload=update_payload,
                     target_export=target
                 )
-                await _queue_update(update_payload)
 
     send_batches_task = asyncio.create_task(_send_pending_updates_to_client())
     background_tasks.add(send_batches_task)
@@ -973,6 +1250,8 @@ async def websocket_dashboard_handler(request):
 
             if client_query != previous_client_query:
                 previous_client_query = copy.deepcopy(client_query)
+                async with pending_updates_lock:
+                    pending_updates.reset()
                 for k, v in client_query.items():
                     targets = v.get('target_exports', [])
                     execute_dag_task = asyncio.create_task(_execute_dag(v, targets, client_query))
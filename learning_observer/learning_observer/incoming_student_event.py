@@ -88,6 +88,11 @@ async def student_event_pipeline(metadata):
     #   https://stackoverflow.com/questions/57263090/async-list-comprehensions-in-python
     # * We should create cached modules for each key, rather than this partial evaluation
     #   kludge
+    # All reducers on this connection share one KVS, so that their writes
+    # for an event go out together (and, with write-behind enabled, their
+    # state is cached across events).
+    reducer_kvs = learning_observer.stream_analytics.helpers.reducer_kvs()
+
     async def prepare_reducer(analytics_module):
         '''
         Prepare a reducer for the analytics module. Note that this is in-place (the
@@ -102,11 +107,28 @@ async def student_event_pipeline(metadata):
             debug_log("Not a coroutine", analytics_module)
             raise AttributeError("The reducer {} should be a co-routine".format(analytics_module))
 
-        analytics_module['reducer_partial'] = await analytics_module['reducer'](metadata)
+        analytics_module['reducer_partial'] = await analytics_module['reducer'](metadata, kvs=reducer_kvs)
         return analytics_module
 
     analytics_modules = await asyncio.gather(*[prepare_reducer(am) for am in analytics_modules])
 
+    # Reducers may declare which event types they act on (see
+    # `kvs_pipeline`). We index them by event type, so that for each
+    # event, we only visit reducers which might act on it. The index
+    # is filled in as we see new event types.
+    dispatch_index = {}
+
+    def reducers_for_event_type(event_type):
+        '''
+        Return the analytics modules which accept `event_type`, in order.
+        '''
+        if event_type not in dispatch_index:
+            dispatch_index[event_type] = [
+                am for am in analytics_modules
+                if am.get('event_types') is None or event_type in am['event_types']
+            ]
+        return dispatch_index[event_type]
+
     async def pipeline(parsed_message):
         '''
         And this is the pipeline itself. It takes messages, processes them,
@@ -130,8 +152,10 @@ async def student_event_pipeline(metadata):
         # don't even run through the remaining processors.
         try:
             processed_analytics = []
-            # Go through all the analytics modules
-            for am in analytics_modules:
+            # Go through the analytics modules which handle this event
+            for am in reducers_for_event_type(parsed_message['client']['event']):
+                if am.get('event_filter') is not None and not am['event_filter'](parsed_message):
+                    continue
                 debug_log("Scope", am['scope'])
                 event_fields = {}
                 skip = False
@@ -147,6 +171,10 @@ async def student_event_pipeline(metadata):
                 if not skip:
                     debug_log("args", event_fields)
                     processed_analytics.append(await am['reducer_partial'](parsed_message, event_fields))
+            # Unless we are caching state across events, write out
+            # everything the reducers updated in one round trip.
+            if reducer_kvs.max_staleness is None:
+                await reducer_kvs.flush()
         except Exception as e:
             traceback.print_exc()
             filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
@@ -161,6 +189,15 @@ async def student_event_pipeline(metadata):
             if settings.RUN_MODE == settings.RUN_MODES.DEV:
                 raise
         return processed_analytics
+
+    async def flush():
+        '''
+        Write any cached reducer state back to the KVS. This should be
+        called when the connection closes.
+        '''
+        await reducer_kvs.close()
+
+    pipeline.flush = flush
     return pipeline
 
 COUNTER = 0
@@ -207,23 +244,36 @@ async def handle_incoming_client_event(metadata):
             "metadata": metadata
         }
 
+        # Encode once (this is expensive for large events, such as
+        # `document_history`), and share the bytes between logs.
+        encoded_event = log_event.encode_json_line(event).encode('utf-8')
         # Log to the main event log file
-        log_event.log_event(event)
+        log_event.log_event(encoded_event, preencoded=True)
         # Log the same thing to our study log file. This isn't a good final format, since we
         # mix data with auth, but we want this for now.
-        log_event.log_event(
-            json.dumps(event, sort_keys=True),
-            filename, preencoded=True, timestamp=True)
+        log_event.log_event(encoded_event, filename, preencoded=True, timestamp=True)
         if client_event.get("event") == "terminate":
             debug_log("Terminate event received; closing handler log file")
             close_handler_log()
             return []
         await pipeline(event)
 
+    def flush_on_collect():
+        '''
+        If we are garbage collected without an explicit flush, make a
+        best effort to write out cached reducer state.
+        '''
+        try:
+            asyncio.get_running_loop().create_task(pipeline.flush())
+        except RuntimeError:
+            debug_log("No event loop; could not flush reducer state")
+
     # when the handler garbage collected (no more events are being passed through),
     # close the log file associated with this connection
     weakref.finalize(handler, close_handler_log)
+    weakref.finalize(handler, flush_on_collect)
     handler.close = close_handler_log
+    handler.flush = pipeline.flush
 
     return handler
 
@@ -231,6 +281,24 @@ async def handle_incoming_client_event(metadata):
 COUNT = 0
 
 
+def raw_log_line(data, event):
+    '''
+    Return what to log for a websocket message: the message itself, as
+    the client sent it, so we don't pay to encode it again. If it spans
+    several lines, we re-encode `event` instead, since logs are one
+    event per line.
+
+    >>> raw_log_line('{"b": 1, "a": 2}', {'b': 1, 'a': 2})
+    '{"b": 1, "a": 2}'
+    >>> raw_log_line('{"b": 1,\\n"a": 2}', {'b': 1, 'a': 2})
+    '{"a": 2, "b": 1}'
+    '''
+    newline, carriage_return = (b"\n", b"\r") if isinstance(data, bytes) else ("\n", "\r")
+    if newline in data or carriage_return in data:
+        return log_event.encode_json_line(event)
+    return data
+
+
 def event_decoder_and_logger(
     request,
     headers=None,
@@ -321,9 +389,12 @@ def event_decoder_and_logger(
             async for msg in events:
                 if isinstance(msg, dict):
                     json_event = msg
+                    log_event.log_event(json_event, filename=filename)
                 else:
                     json_event = json.loads(msg.data)
-                log_event.log_event(json_event, filename=filename)
+                    log_event.log_event(
+                        raw_log_line(msg.data, json_event),
+                        filename=filename, preencoded=True)
                 yield json_event
         finally:
             # done processing events, can close logfile now
@@ -375,6 +446,14 @@ async def incoming_websocket_handler(request):
         if ws.closed:
             debug_log(f'ws connection closed for reason {ws.close_code}')
 
+    async def flush_event_handler():
+        '''Write out any reducer state the current `event_handler`
+        is holding on to.
+        '''
+        handler_flush = getattr(event_handler, 'flush', None)
+        if callable(handler_flush):
+            await handler_flush()
+
     async def update_event_handler(event):
         '''We need source and auth ready before we can
         set up the `event_handler` and be ready to process
@@ -390,6 +469,7 @@ async def incoming_websocket_handler(request):
         else:
             metadata = event
         metadata['auth'] = authenticated
+        await flush_event_handler()
         event_handler = await handle_incoming_client_event(metadata=metadata)
         reducers_last_updated = learning_observer.stream_analytics.LAST_UPDATED
         return True
@@ -464,6 +544,7 @@ async def incoming_websocket_handler(request):
         async for event in events:
             if event.get('event') == 'terminate':
                 debug_log('Terminate event received; shutting down connection and cleaning up logs.')
+                await flush_event_handler()
                 handler_close = getattr(event_handler, 'close', None)
                 if callable(handler_close):
                     handler_close()
@@ -555,8 +636,11 @@ async def incoming_websocket_handler(request):
         events = check_for_reducer_update(events)
         events = pass_through_reducers(events)
         # empty loop to start the generator pipeline
-        async for event in events:
-            pass
+        try:
+            async for event in events:
+                pass
+        finally:
+            await flush_event_handler()
         debug_log('We are done passing events through the pipeline.')
 
     # process websocket messages and begin executing events from the queue
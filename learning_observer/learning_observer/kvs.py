@@ -18,7 +18,10 @@ import functools
 import json
 import os
 import os.path
+import time
 
+import learning_observer.kvs_codec
+import learning_observer.log_event
 import learning_observer.paths
 import learning_observer.prestartup
 import learning_observer.redis_connection
@@ -27,8 +30,161 @@ import learning_observer.util
 
 OBJECT_STORE = dict()
 
+# Redis pub/sub channel on which writers announce changed keys
+CHANGES_CHANNEL = 'learning_observer:kvs_changes'
+
+
+class KeyWatch:
+    '''
+    Watches a set of keys for changes, so (for example) a dashboard can
+    wait until data it displays changes instead of polling.
+
+    Keys are added with `watch()`, and may be added as we go. `wait()`
+    returns the keys which changed since the last `wait()`, or since
+    the keys were added. Call `close()` when done.
+
+    Notifications only cover changes made through the KVS (by this
+    process for in-memory and filesystem stores, or by any process for
+    redis stores with `change_notifications` turned on).
+
+    >>> import asyncio
+    >>> async def example():
+    ...     kvs = InMemoryKVS()
+    ...     watch = kvs.watch(['watched'])
+    ...     await kvs.set('unwatched', 1)
+    ...     print(await watch.wait(timeout=0.01))
+    ...     await kvs.multiset({'watched': 1, 'unwatched': 2})
+    ...     print(await watch.wait(timeout=0.01))
+    ...     watch.close()
+    >>> asyncio.run(example())
+    set()
+    {'watched'}
+    '''
+    def __init__(self, keys=()):
+        self.keys = set()
+        self.changed = set()
+        self._event = asyncio.Event()
+        self.watch(keys)
+
+    def watch(self, keys):
+        '''
+        Add keys to watch.
+        '''
+        for key in keys:
+            if key not in self.keys:
+                self.keys.add(key)
+                _WATCHES.setdefault(key, set()).add(self)
+
+    def _changed(self, key):
+        self.changed.add(key)
+        self._event.set()
+
+    async def wait(self, timeout=None):
+        '''
+        Wait for any watched key to change, and return the set of keys
+        which changed. Returns an empty set on timeout.
+        '''
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        changed, self.changed = self.changed, set()
+        self._event.clear()
+        return changed
+
+    def close(self):
+        '''
+        Stop watching.
+        '''
+        for key in self.keys:
+            watches = _WATCHES.get(key)
+            if watches is not None:
+                watches.discard(self)
+                if not watches:
+                    del _WATCHES[key]
+        self.keys = set()
+
+
+# Key to the set of `KeyWatch`es on it
+_WATCHES = dict()
+
+
+def notify_changes(keys):
+    '''
+    Tell anyone watching `keys` that they changed. This is cheap if no
+    one is watching.
+    '''
+    if not _WATCHES:
+        return
+    for key in keys:
+        for watch in _WATCHES.get(key, ()):
+            watch._changed(key)
+
+
+_REDIS_LISTENER = None
+
+
+async def _listen_for_redis_changes():
+    '''
+    Relay changes announced on redis to local watches.
+    '''
+    global _REDIS_LISTENER
+    try:
+        pubsub = await learning_observer.redis_connection.subscribe(CHANGES_CHANNEL)
+        async for message in pubsub.listen():
+            if message.get('type') == 'message':
+                notify_changes(json.loads(message['data']))
+    except Exception as e:
+        learning_observer.log_event.debug_log("KVS change listener failed:", repr(e))
+    finally:
+        # The next `watch()` starts a new listener
+        _REDIS_LISTENER = None
+
+
+def project(value, fields):
+    '''
+    Keep only the top-level `fields` of a value. Values which aren't
+    dictionaries (including `None`, for missing keys) are unchanged.
+
+    >>> project({'text': 'Hello', 'edit_metadata': {}}, ['text', 'position'])
+    {'text': 'Hello'}
+    >>> project(None, ['text']) is None
+    True
+    '''
+    if not isinstance(value, dict):
+        return value
+    return {field: value[field] for field in fields if field in value}
+
+
+# Prefixes of keys whose values stores may keep one field at a time
+# (see `register_field_layout`)
+_FIELD_LAYOUT_PREFIXES = ()
+
+
+def register_field_layout(prefix):
+    '''
+    Allow stores to keep values of keys starting with `prefix` one
+    top-level field at a time, so `multiget_fields` can read just the
+    fields it needs. This only changes how values are stored, not what
+    reads return. `kvs_pipeline(field_layout=True)` calls this for a
+    reducer's keys. Redis stores need `field_layout: true` to use it.
+    '''
+    global _FIELD_LAYOUT_PREFIXES
+    if prefix not in _FIELD_LAYOUT_PREFIXES:
+        _FIELD_LAYOUT_PREFIXES = _FIELD_LAYOUT_PREFIXES + (prefix,)
+
+
+def uses_field_layout(key):
+    '''
+    Whether `key` was registered with `register_field_layout`.
+    '''
+    return bool(_FIELD_LAYOUT_PREFIXES) and key.startswith(_FIELD_LAYOUT_PREFIXES)
+
 
 class _KVS:
+    # Whether `watch()` will see changes to this store
+    change_notifications = True
+
     async def dump(self, filename=None):
         '''
         Dumps the entire contents of the KVS to a JSON object.
@@ -58,6 +214,15 @@ class _KVS:
                 json.dump(data, f, indent=4)
         return data
 
+    async def get(self, key, mutable=False):
+        '''
+        Read an item. This is the same as `await kvs[key]`, except that
+        callers which intend to modify the value they get back should
+        pass `mutable=True`. Backends which share values between callers
+        (see `InMemoryKVS`) then hand back something safe to change.
+        '''
+        return await self[key]
+
     async def multiget(self, keys):
         '''
         Multiget. It's not fast, but it means we can use appropriate
@@ -65,6 +230,31 @@ class _KVS:
         '''
         return [await self[key] for key in keys]
 
+    async def multiget_fields(self, keys, fields):
+        '''
+        Like `multiget`, but only return the top-level `fields` of each
+        value (see `project`). Backends which can read part of a value
+        override this; this version reads everything.
+        '''
+        return [project(value, fields) for value in await self.multiget(keys)]
+
+    def watch(self, keys=()):
+        '''
+        Return a `KeyWatch` on `keys`. Check `change_notifications`
+        first: if it is `False`, the watch will never fire.
+        '''
+        return KeyWatch(keys)
+
+    async def multiset(self, items):
+        '''
+        Set multiple items. `items` is a dictionary of keys to values.
+
+        Backends which can write several items in one operation (such as
+        redis) override this. This version is a fallback.
+        '''
+        for key, value in items.items():
+            await self.set(key, value)
+
     async def load(self, filename):
         '''
         Loads the contents of a JSON object into the KVS.
@@ -79,17 +269,152 @@ class _KVS:
             await self.set(key, value)
 
 
+class _FrozenDict(dict):
+    '''
+    A read-only `dict`, as returned by `InMemoryKVS` in `frozen` mode.
+    It is still a `dict`, so it serializes and type-checks like one.
+    A `copy.deepcopy` gives back an ordinary, mutable `dict`.
+    '''
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "Values read from the KVS are read-only. Use "
+            "`await kvs.get(key, mutable=True)` for a copy you can change."
+        )
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (thaw(self),))
+
+
+class _FrozenList(list):
+    '''
+    A read-only `list`. See `_FrozenDict`.
+    '''
+    _read_only = _FrozenDict._read_only
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = clear = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (list, (thaw(self),))
+
+
+def freeze(value, memo=None):
+    '''
+    Return a read-only copy of a JSON object. Values which are already
+    frozen are returned as they are.
+
+    >>> frozen = freeze({'a': [1, {'b': 2}]})
+    >>> frozen['a'][1]['b']
+    2
+    >>> frozen['a'].append(3)
+    Traceback (most recent call last):
+        ...
+    TypeError: Values read from the KVS are read-only. Use `await kvs.get(key, mutable=True)` for a copy you can change.
+    >>> thawed = copy.deepcopy(frozen)
+    >>> thawed['a'].append(3)
+    >>> thawed
+    {'a': [1, {'b': 2}, 3]}
+    '''
+    if isinstance(value, (_FrozenDict, _FrozenList)):
+        return value
+    if memo is None:
+        memo = {}
+    if id(value) in memo:
+        return memo[id(value)]
+    if isinstance(value, dict):
+        frozen = _FrozenDict((k, freeze(v, memo)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        frozen = _FrozenList(freeze(v, memo) for v in value)
+    else:
+        return value
+    memo[id(value)] = frozen
+    return frozen
+
+
+def thaw(value):
+    '''
+    Return an ordinary, mutable copy of a (possibly frozen) JSON object.
+    '''
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    return value
+
+
+READ_MODES = ['copy', 'shared', 'frozen']
+
+
 class InMemoryKVS(_KVS):
     '''
     Stores items in-memory. Items expire on system restart.
+
+    We store Python objects, so the codec is only used to check values
+    are serializable, as they would be with other backends.
+
+    Since there is no serialization, callers would otherwise share
+    objects with the store. `read_mode` decides how we handle that:
+
+    * `copy` (default): every read returns a deep copy. Safe, but for
+      large values (e.g. reconstructed documents), copying dominates.
+    * `frozen`: values are frozen when set (see `freeze`), and reads
+      return them as they are. Reads are free, and modifying a value
+      raises an exception. Callers which need to modify a value use
+      `get(key, mutable=True)`, which returns a mutable copy.
+    * `shared`: reads return the stored objects, with no copying at all,
+      even for `mutable=True`. This is only safe if callers which modify
+      a value `set()` it straight back, as `kvs_pipeline` does. Module
+      cleaners and aggregators (e.g. via `dashboard.fetch_student_state`)
+      modify what they read, so this is only for scripts which just run
+      reducers.
     '''
+    def __init__(self, codec=None, read_mode='copy'):
+        if read_mode not in READ_MODES:
+            raise ValueError("Unknown in-memory KVS read mode: {}".format(read_mode))
+        self.codec = codec or learning_observer.kvs_codec.DEFAULT_CODEC
+        self.read_mode = read_mode
+
     async def __getitem__(self, key):
         '''
         Syntax:
 
         >> await kvs['item']
         '''
-        return copy.deepcopy(OBJECT_STORE.get(key, None))
+        if self.read_mode == 'copy':
+            return copy.deepcopy(OBJECT_STORE.get(key, None))
+        return OBJECT_STORE.get(key, None)
+
+    async def get(self, key, mutable=False):
+        '''
+        Read an item. In `frozen` mode, `mutable` gives a mutable copy.
+        '''
+        if mutable and self.read_mode == 'frozen':
+            return thaw(OBJECT_STORE.get(key, None))
+        return await self[key]
+
+    async def multiget_fields(self, keys, fields):
+        '''
+        Project before copying, so we only copy the fields asked for.
+        '''
+        values = [project(OBJECT_STORE.get(key, None), fields) for key in keys]
+        if self.read_mode == 'copy':
+            return copy.deepcopy(values)
+        return values
 
     async def set(self, key, value):
         '''
@@ -104,9 +429,32 @@ class InMemoryKVS(_KVS):
 
         So we use an explict set function.
         '''
-        json.dumps(value)  # Fail early if we're not JSON
+        self.codec.validate(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
+        if self.read_mode == 'frozen':
+            value = freeze(value)
         OBJECT_STORE[key] = value
+        notify_changes([key])
+
+    async def multiset(self, items):
+        '''
+        Set multiple items. We check everything before writing anything, so
+        a bad value does not leave a partial update.
+        '''
+        validated = set()
+        for key, value in items.items():
+            assert isinstance(key, str), "KVS keys must be strings"
+            # Internal and external state are often the same object
+            if id(value) not in validated:
+                self.codec.validate(value)
+                validated.add(id(value))
+        if self.read_mode == 'frozen':
+            # Reducers often set the same object as internal and external
+            # state, so we share a memo to only freeze it once.
+            memo = {}
+            items = {key: freeze(value, memo) for key, value in items.items()}
+        OBJECT_STORE.update(items)
+        notify_changes(items)
 
     async def keys(self):
         '''
@@ -125,15 +473,65 @@ class InMemoryKVS(_KVS):
         too easy to accidentally lose data.
         '''
         global OBJECT_STORE
+        keys = list(OBJECT_STORE)
         OBJECT_STORE = dict()
+        notify_changes(keys)
 
 
 class _RedisKVS(_KVS):
     '''
     Stores items in redis.
+
+    With `change_notifications`, writes also publish the changed keys
+    (in the same round trip), so `watch()` works across processes.
+    Every process writing the store needs this turned on.
+
+    With `field_layout`, keys registered with `register_field_layout`
+    are stored as redis hashes, one (encoded) top-level field per hash
+    field, so `multiget_fields` only transfers the fields asked for.
+    Reads handle either layout, so this can be turned on (or off) with
+    data in place; values are converted as they are next written.
     '''
-    def __init__(self, expire):
+    def __init__(self, expire, codec=None, change_notifications=False, field_layout=False):
         self.expire = expire
+        self.codec = codec or learning_observer.kvs_codec.DEFAULT_CODEC
+        self.change_notifications = change_notifications
+        self._notify_channel = CHANGES_CHANNEL if change_notifications else None
+        self.field_layout = field_layout
+
+    def _hashed(self, key):
+        '''
+        Whether we store `key` as a hash.
+        '''
+        return self.field_layout and uses_field_layout(key)
+
+    def _encode_items(self, items):
+        '''
+        Encode `items` for `redis_connection.mset`, as plain values and
+        hashes. Only non-empty dictionaries with string keys can be
+        stored as hashes.
+        '''
+        plain = {}
+        hashes = {}
+        for key, value in items.items():
+            assert isinstance(key, str), "KVS keys must be strings"
+            if (self._hashed(key) and isinstance(value, dict) and value
+                    and all(isinstance(field, str) for field in value)):
+                hashes[key] = {field: self.codec.encode(field_value) for field, field_value in value.items()}
+            else:
+                plain[key] = self.codec.encode(value)
+        return plain, hashes
+
+    def _decode(self, item):
+        '''
+        Decode a value read from redis: `None`, a plain value, or a
+        dictionary of fields from `mget_hashes`.
+        '''
+        if item is None:
+            return None
+        if isinstance(item, dict):
+            return {field: self.codec.decode(value) for field, value in item.items()}
+        return self.codec.decode(item)
 
     async def connect(self):
         '''
@@ -149,10 +547,11 @@ class _RedisKVS(_KVS):
         >> await kvs['item']
         '''
         await self.connect()
-        item = await learning_observer.redis_connection.get(key)
-        if item is not None:
-            return json.loads(item)
-        return None
+        if self._hashed(key):
+            item = (await learning_observer.redis_connection.mget_hashes([key]))[0]
+        else:
+            item = await learning_observer.redis_connection.get(key)
+        return self._decode(item)
 
     async def set(self, key, value):
         '''
@@ -167,11 +566,37 @@ class _RedisKVS(_KVS):
 
         So we use an explict set function.
         '''
+        if self._hashed(key):
+            return await self.multiset({key: value})
         await self.connect()
-        value = json.dumps(value)  # Fail early if we're not JSON
+        value = self.codec.encode(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
+        if self._notify_channel is not None:
+            return (await learning_observer.redis_connection.mset(
+                {key: value}, expiry=self.expire, notify_channel=self._notify_channel))[0]
         return await learning_observer.redis_connection.set(key, value, expiry=self.expire)
 
+    async def multiset(self, items):
+        '''
+        Set multiple items in a single round trip to redis.
+        '''
+        if not items:
+            return
+        await self.connect()
+        plain, hashes = self._encode_items(items)
+        return await learning_observer.redis_connection.mset(
+            plain, expiry=self.expire, notify_channel=self._notify_channel, hashes=hashes)
+
+    def watch(self, keys=()):
+        '''
+        Return a `KeyWatch` on `keys`, starting a listener for changes
+        published by other processes if we haven't yet.
+        '''
+        global _REDIS_LISTENER
+        if self.change_notifications and _REDIS_LISTENER is None:
+            _REDIS_LISTENER = asyncio.ensure_future(_listen_for_redis_changes())
+        return KeyWatch(keys)
+
     async def keys(self):
         '''
         Return all the keys in the KVS.
@@ -205,20 +630,266 @@ class _RedisKVS(_KVS):
         '''
         Fetch multiple items from the KVS via `mget`
         '''
+        return await self._multiget(keys, None)
+
+    async def multiget_fields(self, keys, fields):
+        '''
+        Fetch the top-level `fields` of multiple items. For hashes, only
+        those fields leave redis.
+        '''
+        return await self._multiget(keys, fields)
+
+    async def _multiget(self, keys, fields):
+        '''
+        Fetch plain values with `mget`, and hashes with `mget_hashes`,
+        projecting to `fields` unless it is `None`.
+        '''
         await self.connect()
-        items = await learning_observer.redis_connection.mget(keys)
-        return [json.loads(item) if item is not None else None for item in items]
+        hashed = [key for key in keys if self._hashed(key)]
+        if not hashed:
+            items = await learning_observer.redis_connection.mget(keys)
+        else:
+            plain = [key for key in keys if not self._hashed(key)]
+            fetched = dict(zip(hashed, await learning_observer.redis_connection.mget_hashes(hashed, fields)))
+            if plain:
+                fetched.update(zip(plain, await learning_observer.redis_connection.mget(plain)))
+            items = [fetched[key] for key in keys]
+        values = [self._decode(item) for item in items]
+        if fields is None:
+            return values
+        return [project(value, fields) for value in values]
+
+
+class WriteBehindKVS(_KVS):
+    '''
+    Wraps another KVS and holds values in process, deferring writes.
+
+    Reducers read their internal state, update it, and write it back on
+    every event. With a remote store, each of those is a round trip. This
+    wrapper is intended to live for one websocket session: writes are
+    coalesced and pushed to the backend with a single `multiset` when
+    either:
+
+    * `max_staleness` seconds have passed since the first unflushed write
+    * `max_pending` distinct keys are waiting to be written
+    * `flush()` or `close()` is called (e.g. at the end of an event, or
+      on disconnect)
+
+    Dashboards reading the backend will therefore see data which is at
+    most `max_staleness` seconds old. A `max_staleness` of 0 makes this
+    write-through. A `max_staleness` of `None` never flushes on its own;
+    the caller is responsible for calling `flush()`.
+
+    Values which have not been written yet are always served locally.
+    If `cache_reads` is set, values read from the backend are also
+    reused, for up to `max_staleness` seconds. Otherwise, everything
+    else goes to the backend, so we behave like the backend with
+    batched writes. Once values are flushed, we drop our copies, so the
+    next read of a key fetches it again, including changes other
+    connections (e.g. a student's second tab) or other writers (e.g.
+    `update_reconstruct_reducer_with_google_api`) made. Updates can
+    still be lost if two writers change the same key within
+    `max_staleness` of each other: the last flush wins.
+
+    >>> async def example():
+    ...     backend = InMemoryKVS()
+    ...     await backend.set('count', 1)
+    ...     tab_1 = WriteBehindKVS(backend, max_staleness=None)
+    ...     tab_2 = WriteBehindKVS(backend, max_staleness=None)
+    ...     await tab_1.set('count', await tab_1['count'] + 1)
+    ...     await tab_1.flush()
+    ...     await tab_2.set('count', await tab_2['count'] + 1)
+    ...     await tab_2.flush()
+    ...     await tab_1.set('count', await tab_1['count'] + 1)
+    ...     await tab_1.flush()
+    ...     return await backend['count']
+    >>> asyncio.run(example())
+    4
+
+    Values handed out by the cache are shared, not copied. This is fine
+    for `kvs_pipeline`, which always writes back what it changes, but
+    other callers should not mutate values they do not `set()`.
+    '''
+    def __init__(self, backend, max_staleness=1.0, max_pending=100, cache_reads=True):
+        self.backend = backend
+        self.max_staleness = max_staleness
+        self.max_pending = max_pending
+        self.cache_reads = cache_reads
+        self._cache = {}
+        # Key to when we read it from the backend, for values we haven't
+        # written
+        self._fetched = {}
+        # Dictionaries preserve insertion order, so we use one as an ordered set
+        self._dirty = {}
+        self._flush_handle = None
+        self._flush_tasks = set()
+
+    async def __getitem__(self, key):
+        '''
+        Syntax:
+
+        >> await kvs['item']
+        '''
+        return await self.get(key)
+
+    async def get(self, key, mutable=False):
+        '''
+        Read an item, from the local copy if we have a current one.
+        '''
+        if self._is_local(key):
+            return self._cache[key]
+        value = await self.backend.get(key, mutable=mutable)
+        self._remember(key, value)
+        return value
+
+    def _is_local(self, key):
+        '''
+        Whether we serve `key` from our copy: if we haven't written it
+        to the backend yet, or we read it recently enough.
+        '''
+        if key not in self._cache:
+            return False
+        fetched = self._fetched.get(key)
+        if fetched is None or self.max_staleness is None:
+            return True
+        if time.monotonic() - fetched < self.max_staleness:
+            return True
+        del self._cache[key]
+        del self._fetched[key]
+        return False
+
+    def _remember(self, key, value):
+        '''
+        Keep a value we read from the backend, if we cache reads.
+        '''
+        if self.cache_reads:
+            self._cache[key] = value
+            self._fetched[key] = time.monotonic()
+
+    async def set(self, key, value):
+        '''
+        Syntax:
+        >> await set('key', value)
+
+        The value is stored locally and written to the backend later.
+        '''
+        await self.multiset({key: value})
+
+    async def multiset(self, items):
+        '''
+        Set multiple items. These are stored locally and written to the
+        backend later.
+        '''
+        for key, value in items.items():
+            assert isinstance(key, str), "KVS keys must be strings"
+            self._cache[key] = value
+            self._fetched.pop(key, None)
+            self._dirty[key] = True
+        if self.max_staleness is None:
+            return
+        if self.max_staleness <= 0 or len(self._dirty) >= self.max_pending:
+            await self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.max_staleness, self._schedule_flush)
+
+    def _schedule_flush(self):
+        '''
+        Timer callback. We can't await from `call_later`, so we spawn a
+        task, and keep a reference so it is not garbage collected early.
+        '''
+        self._flush_handle = None
+        task = asyncio.ensure_future(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            learning_observer.log_event.debug_log("Write-behind flush failed:", repr(task.exception()))
+
+    async def flush(self):
+        '''
+        Write all pending values to the backend in one `multiset`. If the
+        backend fails, the keys stay pending so a later flush can retry them.
+        '''
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        pending = self._dirty
+        self._dirty = {}
+        try:
+            await self.backend.multiset({key: self._cache[key] for key in pending})
+        except Exception:
+            self._dirty = {**pending, **self._dirty}
+            raise
+        # The backend has these now, and may get newer values from
+        # other writers, so we read them again next time
+        for key in pending:
+            if key not in self._dirty:
+                del self._cache[key]
+
+    async def close(self):
+        '''
+        Flush everything. Called when the session ends.
+        '''
+        await self.flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    async def keys(self):
+        '''
+        Return all keys in the backend, after writing out anything pending.
+        '''
+        await self.flush()
+        return await self.backend.keys()
+
+    async def multiget(self, keys):
+        '''
+        Serve what we can locally, and fetch the rest from the backend.
+        '''
+        missing = [key for key in keys if not self._is_local(key)]
+        fetched = {}
+        if missing:
+            fetched = dict(zip(missing, await self.backend.multiget(missing)))
+            for key, value in fetched.items():
+                self._remember(key, value)
+        return [fetched[key] if key in fetched else self._cache[key] for key in keys]
+
+    async def multiget_fields(self, keys, fields):
+        '''
+        Serve what we can locally, and fetch fields for the rest from the
+        backend. We don't cache partial values.
+        '''
+        missing = [key for key in keys if not self._is_local(key)]
+        fetched = {}
+        if missing:
+            fetched = dict(zip(missing, await self.backend.multiget_fields(missing, fields)))
+        return [fetched[key] if key in fetched else project(self._cache[key], fields) for key in keys]
+
+    @property
+    def change_notifications(self):
+        return self.backend.change_notifications
+
+    def watch(self, keys=()):
+        '''
+        Watch the backend. Changes are seen when they are flushed.
+        '''
+        return self.backend.watch(keys)
 
 
 class EphemeralRedisKVS(_RedisKVS):
     '''
     For testing: redis drops data quickly.
     '''
-    def __init__(self, expire=30):
+    def __init__(self, expire=30, codec=None, change_notifications=False, field_layout=False):
         '''
         We're just a `_RedisKVS` with expiration set
         '''
-        super().__init__(expire=expire)
+        super().__init__(expire=expire, codec=codec, change_notifications=change_notifications,
+                         field_layout=field_layout)
 
 
 class PersistentRedisKVS(_RedisKVS):
@@ -226,11 +897,12 @@ class PersistentRedisKVS(_RedisKVS):
 
     For deployment: Data lives forever.
     '''
-    def __init__(self):
+    def __init__(self, codec=None, change_notifications=False, field_layout=False):
         '''
         We're just a `_RedisKVS` with expiration unset
         '''
-        super().__init__(expire=None)
+        super().__init__(expire=None, codec=codec, change_notifications=change_notifications,
+                         field_layout=field_layout)
 
 
 class FilesystemKVS(_KVS):
@@ -242,15 +914,18 @@ class FilesystemKVS(_KVS):
 
     It's not a bad solution for caching some files in small-scale deploys.
     '''
-    def __init__(self, path=None, subdirs=False):
+    def __init__(self, path=None, subdirs=False, codec=None):
         '''
         path: Where to store the kvs. Default: kvs
         subdirs: If set, keys with slashes will result in the creation of
         subdirs. For example, self.set("foo/bar", "hello") would create the
         directory foo (if it doesn't exist) and store "hello" in the file "bar"
+        codec: How to encode values. By default, we write indented JSON,
+        which is easy to read when debugging.
         '''
         self.path = path or learning_observer.paths.data('kvs')
         self.subdirs = subdirs
+        self.codec = codec or learning_observer.kvs_codec.DEFAULT_CODEC
         if not os.path.exists(path):
             os.mkdir(path)
 
@@ -276,19 +951,26 @@ class FilesystemKVS(_KVS):
         path = self.key_to_safe_filename(key)
         if not os.path.exists(path):
             return None
-        with open(path) as f:
-            return json.load(f)
+        with open(path, 'rb') as f:
+            return self.codec.decode(f.read())
 
     async def set(self, key, value):
         path = self.key_to_safe_filename(key)
         if self.subdirs:
             os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w') as f:
-            json.dump(value, f, indent=4)
+        if self.codec.plain:
+            with open(path, 'w') as f:
+                json.dump(value, f, indent=4)
+        else:
+            data = self.codec.encode(value)
+            with open(path, 'wb') as f:
+                f.write(data)
+        notify_changes([key])
 
     async def __delitem__(self, key):
         path = self.key_to_safe_filename(key)
         os.remove(path)
+        notify_changes([key])
 
     async def keys(self):
         '''
@@ -312,6 +994,7 @@ class FilesystemKVS(_KVS):
         The base directory is preserved, but all contained files (and
         directories when ``subdirs`` is enabled) are removed.
         '''
+        notify_changes(await self.keys())
         if self.subdirs:
             for root, dirs, files in os.walk(self.path, topdown=False):
                 for f in files:
@@ -363,7 +1046,18 @@ class KVSRouter:
                 kvs_type = kvs_item['type']
                 if kvs_type not in KVS_MAP:
                     raise KeyError(f"Invalid KVS type '{kvs_type}'")
-                kvs_class = KVS_MAP[kvs_type]
+                kvs_class = functools.partial(
+                    KVS_MAP[kvs_type],
+                    codec=learning_observer.kvs_codec.codec_from_settings(kvs_item)
+                )
+                if kvs_type == 'stub':
+                    kvs_class = functools.partial(kvs_class, read_mode=kvs_item.get('read_mode', 'copy'))
+                elif kvs_type in ('redis', 'redis_ephemeral'):
+                    kvs_class = functools.partial(
+                        kvs_class,
+                        change_notifications=kvs_item.get('change_notifications', False),
+                        field_layout=kvs_item.get('field_layout', False)
+                    )
                 if kvs_type == 'redis_ephemeral':
                     if 'expiry' not in kvs_item:
                         raise MissingKVSParameters(key, kvs_type, 'expiry')
@@ -410,6 +1104,10 @@ def kvs_startup_check():
     try:
         KVS = KVSRouter(items=learning_observer.settings.settings['kvs'].items())
 
+    except ValueError as e:
+        raise learning_observer.prestartup.StartupCheck(
+            "KVS incorrectly configured: {}".format(e)
+        )
     except KeyError:
         if 'kvs' not in learning_observer.settings.settings:
             raise learning_observer.prestartup.StartupCheck(
@@ -0,0 +1,201 @@
+'''
+Codecs for KVS values
+
+KVS values are JSON objects. Historically, every backend stored them as
+JSON text, encoded with the standard library. For large values
+(reconstructed documents, NLP results), encoding and decoding shows up
+in profiles, and the values take a lot of space. A codec lets a KVS
+item choose, in `creds.yaml`:
+
+```yaml
+kvs:
+  default:
+    type: redis
+    codec: orjson              # json (default), orjson, or msgpack
+    compression: zlib          # none (default), zlib, or zstd
+    compression_threshold: 1024
+```
+
+`orjson`, `msgpack`, and `zstandard` are optional dependencies, and
+are only imported if configured.
+
+Encoded values carry a short tag, so a store can hold a mix of old
+(plain JSON) and new values while we migrate. The tag is a control
+character which can't start JSON text, followed by one character for
+the serializer and one for compression:
+
+    \\x1e <serializer: j, o, m> <compression: -, z, s> <payload>
+
+`j` is JSON written by the standard library and `o` is JSON written by
+`orjson`. The `orjson` codec falls back to the standard library for
+values `orjson` can't encode (such as integers beyond 64 bits), and
+`orjson` would read those back as floats, so only `o` payloads are
+decoded with `orjson`.
+
+The default codec (`json`, no compression) writes plain, untagged JSON,
+exactly as before. Any codec can read any tagged or untagged value, as
+long as the library it needs is installed.
+'''
+
+import importlib
+import json
+import zlib
+
+import learning_observer.prestartup
+
+
+TAG = b'\x1e'
+
+SERIALIZERS = ['json', 'orjson', 'msgpack']
+COMPRESSIONS = ['none', 'zlib', 'zstd']
+
+# Where each optional library comes from, for error messages
+_LIBRARIES = {
+    'orjson': 'orjson',
+    'msgpack': 'msgpack',
+    'zstd': 'zstandard'
+}
+
+
+def _import(name):
+    '''
+    Import an optional library, with a helpful message if it is missing.
+    '''
+    try:
+        return importlib.import_module(_LIBRARIES[name])
+    except ImportError:
+        raise learning_observer.prestartup.StartupCheck(
+            "KVS codec: `{name}` is configured, but the `{library}` package "
+            "is not installed. Please `pip install {library}`, or change the "
+            "KVS settings.".format(name=name, library=_LIBRARIES[name])
+        )
+
+
+class Codec:
+    '''
+    Converts JSON objects to and from what a backend stores.
+
+    `encode` returns `str` for the default codec (so the stored data is
+    unchanged from before codecs), and `bytes` otherwise. `decode`
+    accepts either.
+
+    >>> codec = Codec()
+    >>> codec.encode({'a': [1, 2]})
+    '{"a": [1, 2]}'
+    >>> codec.decode(codec.encode({'a': [1, 2]}))
+    {'a': [1, 2]}
+    >>> compressed = Codec(compression='zlib', compression_threshold=10)
+    >>> encoded = compressed.encode({'text': 'a' * 100})
+    >>> encoded[:3]
+    b'\\x1ejz'
+    >>> codec.decode(encoded) == {'text': 'a' * 100}
+    True
+    >>> compressed.decode('{"old": "data"}')
+    {'old': 'data'}
+    >>> big = Codec('orjson')
+    >>> big.decode(big.encode({'x': 2 ** 70}))
+    {'x': 1180591620717411303424}
+    '''
+    def __init__(self, serializer='json', compression='none', compression_threshold=1024):
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unknown KVS serializer: {}".format(serializer))
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown KVS compression: {}".format(compression))
+        self.serializer = serializer
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.plain = serializer == 'json' and compression == 'none'
+
+        if serializer == 'orjson':
+            self._orjson = _import('orjson')
+        if serializer == 'msgpack':
+            self._msgpack = _import('msgpack')
+        if compression == 'zstd':
+            self._zstd = _import('zstd')
+
+    def _serialize(self, value):
+        '''
+        Return the serializer tag and the serialized value, as bytes.
+        '''
+        if self.serializer == 'msgpack':
+            return b'm', self._msgpack.packb(value, use_bin_type=True)
+        if self.serializer == 'orjson':
+            try:
+                return b'o', self._orjson.dumps(value, option=self._orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                # e.g. integers too large for orjson. The standard library
+                # handles these.
+                pass
+        return b'j', json.dumps(value).encode('utf-8')
+
+    def encode(self, value):
+        '''
+        Encode a JSON object for storage. Raises an exception if it is not
+        serializable, so this also serves as validation.
+        '''
+        if self.plain:
+            return json.dumps(value)
+        serializer_tag, data = self._serialize(value)
+        compression_tag = b'-'
+        if len(data) >= self.compression_threshold:
+            if self.compression == 'zlib':
+                compression_tag, data = b'z', zlib.compress(data)
+            elif self.compression == 'zstd':
+                compression_tag, data = b's', self._zstd.ZstdCompressor().compress(data)
+        return TAG + serializer_tag + compression_tag + data
+
+    def validate(self, value):
+        '''
+        Raise an exception if `value` can't be stored. This is cheaper
+        than `encode`, since we skip compression.
+        '''
+        if self.plain:
+            json.dumps(value)
+        else:
+            self._serialize(value)
+
+    def decode(self, data):
+        '''
+        Decode a stored value, whichever codec wrote it.
+        '''
+        if isinstance(data, str):
+            if not data.startswith('\x1e'):
+                return json.loads(data)
+            data = data.encode('utf-8')
+        if not data.startswith(TAG):
+            return json.loads(data)
+
+        serializer_tag = data[1:2]
+        compression_tag = data[2:3]
+        payload = data[3:]
+        if compression_tag == b'z':
+            payload = zlib.decompress(payload)
+        elif compression_tag == b's':
+            zstd = getattr(self, '_zstd', None) or _import('zstd')
+            payload = zstd.ZstdDecompressor().decompress(payload)
+
+        if serializer_tag == b'm':
+            msgpack = getattr(self, '_msgpack', None) or _import('msgpack')
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        if serializer_tag == b'o' and getattr(self, '_orjson', None) is not None:
+            return self._orjson.loads(payload)
+        return json.loads(payload)
+
+
+DEFAULT_CODEC = Codec()
+
+
+def codec_from_settings(kvs_item):
+    '''
+    Create a codec from the settings for one KVS item. Items without
+    codec settings get the default (plain JSON) codec.
+    '''
+    serializer = kvs_item.get('codec', 'json')
+    compression = kvs_item.get('compression', 'none')
+    if serializer == 'json' and compression == 'none':
+        return DEFAULT_CODEC
+    return Codec(
+        serializer=serializer,
+        compression=compression,
+        compression_threshold=kvs_item.get('compression_threshold', 1024)
+    )
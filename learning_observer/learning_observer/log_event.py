@@ -48,6 +48,8 @@ were, but we might not keep terabytes of data around (just enough to
 redo those analyses).
 '''
 
+import atexit
+import collections
 import datetime
 from enum import Enum
 import inspect
@@ -56,6 +58,9 @@ import json
 import hashlib
 import os
 import os.path
+import queue
+import threading
+import time
 import pmss
 
 import learning_observer.constants
@@ -81,7 +86,6 @@ if not os.path.exists(paths.logs("startup")):
     os.mkdir(paths.logs("startup"))
 
 mainlog = open(paths.logs("main_log.json"), "ab", 0)
-files = {}
 startup_state = {}
 
 
@@ -115,6 +119,55 @@ pmss.register_field(
                 '`EXTENDED`: print debug message with stack trace and timestamp'
 )
 
+pmss.parser('log_writer', parent='string', choices=['sync', 'background'], transform=None)
+pmss.register_field(
+    name='log_writer',
+    type='log_writer',
+    description='How we write event logs.\n'\
+                '`sync`: write and flush each event as it comes in\n'\
+                '`background`: queue events for a writer thread, which writes '
+                'them in batches, so the event loop never waits on the disk',
+    default='sync'
+)
+pmss.register_field(
+    name='max_open_logs',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='The most per-session log files (study, decoder, dashboard) we '
+                'keep open at once. Beyond this, we close the least recently '
+                'used, and reopen them as needed. 0 means no limit.',
+    default=1024
+)
+pmss.register_field(
+    name='log_flush_interval_ms',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With the `background` log writer, the longest (in milliseconds) '
+                'an event may wait before being written to disk.',
+    default=100
+)
+pmss.register_field(
+    name='log_flush_events',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With the `background` log writer, the number of queued events '
+                'which triggers an immediate write.',
+    default=256
+)
+pmss.register_field(
+    name='log_fsync',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='With the `background` log writer, `fsync` log files after each '
+                'write, so events survive a machine (not just a process) crash.',
+    default=False
+)
+pmss.register_field(
+    name='log_queue_size',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With the `background` log writer, the most events we queue. '
+                'If the disk falls this far behind, logging blocks until it '
+                'catches up.',
+    default=10000
+)
+
+
 class LogDestination(Enum):
     '''
     Where we log events? We can log to a file, or to the console.
@@ -161,6 +214,17 @@ def initialize_logging_framework():
     debug_log("DEBUG_LOG_LEVEL:", DEBUG_LOG_LEVEL)
     debug_log("DEBUG_DESTINATIONS:", DEBUG_LOG_DESTINATIONS)
 
+    files.max_open = settings.pmss_settings.max_open_logs(types=['logging'])
+    if settings.pmss_settings.log_writer(types=['logging']) == 'background':
+        start_background_writer(
+            flush_interval=settings.pmss_settings.log_flush_interval_ms(types=['logging']) / 1000,
+            flush_events=settings.pmss_settings.log_flush_events(types=['logging']),
+            fsync=settings.pmss_settings.log_fsync(types=['logging']),
+            queue_size=settings.pmss_settings.log_queue_size(types=['logging']),
+            max_open=files.max_open
+        )
+        debug_log("Event logs written in the background")
+
     # We're going to save the state of the filesystem on application startup
     # This way, event logs can refer uniquely to running version
     # Do we want the full 512 bit hash? Cut it back? Use a more efficient encoding than
@@ -205,25 +269,255 @@ def encode_json_block(block):
     return json.dumps(block, sort_keys=True, indent=3)
 
 
+EMPTY_LOG_PLACEHOLDER = "[Empty log file -- no events captured]"
+
+
+class LogFilePool:
+    '''
+    The open files for per-session logs (study, decoder, dashboard).
+
+    We have one log per connection, and on a busy server, thousands of
+    connections. Rather than hold a file descriptor for each, we keep
+    up to `max_open` files open, closing the least-recently used, and
+    transparently reopen them (in append mode) on the next write.
+    `max_open` of `None` (or 0) means no limit.
+
+    `None` is the main log, which always stays open.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> pool = LogFilePool(max_open=2, path=lambda name: os.path.join(directory, name))
+    >>> for name in ['a', 'b', 'a', 'c', 'b']:
+    ...     _ = pool.get(name).write(name.encode('utf-8'))
+    >>> list(pool.handles)
+    ['c', 'b']
+    >>> pool.close('a'); pool.close('b'); pool.close('never-written')
+    >>> open(os.path.join(directory, 'a.log')).read()
+    'aa'
+    >>> open(os.path.join(directory, 'never-written.log')).read()
+    '[Empty log file -- no events captured]\\n'
+    >>> pool.close_all()
+    '''
+    def __init__(self, max_open=None, path=paths.logs):
+        self.max_open = max_open
+        self.path = path
+        self.handles = collections.OrderedDict()
+        # Logs we've written to and not closed, whether or not the file
+        # is open right now
+        self.active = set()
+
+    def get(self, filename):
+        '''
+        Return the open file for a log, opening it if needed.
+        '''
+        if filename is None:
+            return mainlog
+        if filename in self.handles:
+            self.handles.move_to_end(filename)
+            return self.handles[filename]
+        if self.max_open and len(self.handles) >= self.max_open:
+            self.handles.popitem(last=False)[1].close()
+        log_file_fp = open(self.path("" + filename + ".log"), "ab", 0)
+        self.handles[filename] = log_file_fp
+        self.active.add(filename)
+        return log_file_fp
+
+    def close(self, filename):
+        '''
+        Close a log, and forget it.
+        '''
+        if filename not in self.active:
+            # If we logged no events, the file was never created. This
+            # forces the file to be created, and marked as empty, which
+            # also gives some logging of something having happened.
+            #
+            # I don't know if this is the right sentinel to use. Empty file? A
+            # single event of some kind?
+            self.get(filename).write(EMPTY_LOG_PLACEHOLDER.encode('utf-8') + b"\n")
+        self.active.discard(filename)
+        log_file_fp = self.handles.pop(filename, None)
+        if log_file_fp is not None:
+            log_file_fp.close()
+
+    def close_all(self):
+        '''
+        Close every open file (e.g. on shutdown). These aren't marked as
+        empty, and are reopened if written to again.
+        '''
+        while self.handles:
+            self.handles.popitem()[1].close()
+
+
+files = LogFilePool()
+
+
+class _BackgroundLogWriter:
+    '''
+    Writes event logs from a thread, so the event loop never waits on
+    the disk.
+
+    Events go onto a bounded queue. The writer thread takes everything
+    queued (up to `flush_events` lines, or whatever arrives within
+    `flush_interval` seconds), and writes it out with one `write` per
+    file (group commit). With `fsync`, it also `fsync`s each file it
+    wrote to.
+
+    If the queue fills up, `write` blocks until the disk catches up.
+    We'd rather slow down than lose events or run out of memory.
+
+    The writer owns its files, including opening and closing them, so
+    none of that happens on the event loop either.
+    '''
+    def __init__(self, flush_interval=0.1, flush_events=256, fsync=False, queue_size=10000, max_open=None):
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handles = LogFilePool(max_open)
+        self.thread = threading.Thread(target=self._run, name="log_writer", daemon=True)
+        self.thread.start()
+
+    def write(self, filename, parts):
+        '''
+        Queue an encoded line for a log, as a sequence of `bytes` which
+        end in a newline.
+        '''
+        self.queue.put(('write', filename, parts))
+
+    def close_logfile(self, filename):
+        '''
+        Queue closing a log, once everything before it is written.
+        '''
+        self.queue.put(('close', filename, None))
+
+    def flush(self, timeout=None):
+        '''
+        Block until everything queued so far is on disk (or, at least,
+        handed to the operating system). Returns `False` on timeout.
+
+        This is for shutdown and tests; don't call it from the event loop.
+        '''
+        done = threading.Event()
+        self.queue.put(('barrier', None, done))
+        return done.wait(timeout)
+
+    def stop(self, timeout=None):
+        '''
+        Write everything queued, and stop the writer thread.
+        '''
+        if self.thread.is_alive():
+            self.queue.put(('stop', None, None))
+            self.thread.join(timeout)
+
+    def _batch(self):
+        '''
+        Wait for an operation, and then collect whatever else arrives
+        before the batch is full or the flush interval is up.
+        '''
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_events and batch[-1][0] == 'write':
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, pending):
+        '''
+        Write out pending lines, one `write` per file.
+        '''
+        for filename, lines in pending.items():
+            log_file_fp = self.handles.get(filename)
+            log_file_fp.write(b"".join(lines))
+            log_file_fp.flush()
+            if self.fsync:
+                os.fsync(log_file_fp.fileno())
+        pending.clear()
+
+    def _run(self):
+        running = True
+        while running:
+            pending = {}
+            for operation, filename, payload in self._batch():
+                try:
+                    if operation == 'write':
+                        pending.setdefault(filename, []).extend(payload)
+                        continue
+                    # Everything else applies after the writes before it
+                    self._commit(pending)
+                    if operation == 'close':
+                        self.handles.close(filename)
+                    elif operation == 'barrier':
+                        payload.set()
+                    elif operation == 'stop':
+                        running = False
+                except Exception as e:
+                    # A bad file shouldn't stop us logging everything else
+                    pending.clear()
+                    print("Error writing event logs:", e)
+            try:
+                self._commit(pending)
+            except Exception as e:
+                print("Error writing event logs:", e)
+
+
+background_writer = None
+
+
+def start_background_writer(**kwargs):
+    '''
+    Write event logs from a background thread from here on. See
+    `_BackgroundLogWriter` for arguments.
+    '''
+    global background_writer
+    if background_writer is None:
+        background_writer = _BackgroundLogWriter(**kwargs)
+        atexit.register(stop_background_writer)
+    return background_writer
+
+
+def stop_background_writer():
+    '''
+    Write out any queued events, and go back to writing them directly.
+    '''
+    global background_writer
+    writer, background_writer = background_writer, None
+    if writer is not None:
+        writer.stop()
+        writer.handles.close_all()
+
+
 def log_event(event, filename=None, preencoded=False, timestamp=False):
     '''
     This isn't done, but it's how we log events for now.
-    '''
-    if filename is None:
-        log_file_fp = mainlog
-    elif filename in files:
-        log_file_fp = files[filename]
-    else:
-        log_file_fp = open(paths.logs("" + filename + ".log"), "ab", 0)
-        files[filename] = log_file_fp
 
+    If `preencoded`, `event` is already-encoded JSON, as `str` or (to
+    skip re-encoding when one event goes to several logs) `bytes`.
+
+    We build the whole line, and write it in one go. With the
+    background writer, we just queue its parts, and the writer thread
+    joins them.
+    '''
     if not preencoded:
         event = encode_json_line(event)
-    log_file_fp.write(event.encode('utf-8'))
+    if not isinstance(event, bytes):
+        event = event.encode('utf-8')
     if timestamp:
-        log_file_fp.write("\t".encode('utf-8'))
-        log_file_fp.write(datetime.datetime.utcnow().isoformat().encode('utf-8'))
-    log_file_fp.write("\n".encode('utf-8'))
+        parts = (event, b"\t" + datetime.datetime.utcnow().isoformat().encode('utf-8') + b"\n")
+    else:
+        parts = (event, b"\n")
+
+    if background_writer is not None:
+        background_writer.write(filename, parts)
+        return
+
+    log_file_fp = files.get(filename)
+    log_file_fp.write(b"".join(parts))
     log_file_fp.flush()
 
 
@@ -335,15 +629,11 @@ def log_lms_integration(payload):
 
 
 def close_logfile(filename):
-    # remove the file from the dict storing open log files and close it
-    if filename not in files:
-        # If we logged no events, the file was never created, so the code
-        # below fails. This forces the file to be created, and marked
-        # as empty, which also gives some logging of something having
-        # happened.
-        #
-        # I don't know if this is the right sentinel to use. Empty file? A
-        # single event of some kind?
-        log_event("[Empty log file -- no events captured]", preencoded=True, filename=filename)
-    old_file = files.pop(filename)
-    old_file.close()
+    '''
+    Close a log file (e.g. at the end of a websocket connection). If
+    we logged no events to it, we create it with a placeholder line.
+    '''
+    if background_writer is not None:
+        background_writer.close_logfile(filename)
+        return
+    files.close(filename)
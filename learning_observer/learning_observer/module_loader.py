@@ -110,6 +110,48 @@ def reducers():
     return REDUCERS
 
 
+# `reducers()` by id, string_id, and key name (see `_reducer_index`)
+_REDUCER_INDEX = None
+
+
+def _reducer_index():
+    '''
+    Index `reducers()` by `id` and `string_id`, and by the name they use
+    in KVS keys (the fully-qualified name of the function). We rebuild
+    the index when the list of reducers changes. If several reducers
+    share a name, the first wins, as it would in a scan of `reducers()`.
+    '''
+    global _REDUCER_INDEX
+    all_reducers = reducers()
+    if _REDUCER_INDEX is not None and _REDUCER_INDEX[0] is all_reducers and _REDUCER_INDEX[1] == len(all_reducers):
+        return _REDUCER_INDEX
+    by_id = {}
+    by_key_name = {}
+    for reducer in all_reducers:
+        for reducer_id in (reducer.get('id'), reducer.get('string_id')):
+            if reducer_id is not None:
+                by_id.setdefault(reducer_id, reducer)
+        by_key_name.setdefault(helpers.fully_qualified_function_name(reducer['function']), reducer)
+    _REDUCER_INDEX = (all_reducers, len(all_reducers), by_id, by_key_name)
+    return _REDUCER_INDEX
+
+
+def find_reducer(reducer_id):
+    '''
+    Return the reducer whose `id` or `string_id` is `reducer_id`, or
+    `None`.
+    '''
+    return _reducer_index()[2].get(reducer_id)
+
+
+def find_reducer_by_key_name(key_name):
+    '''
+    Return the reducer whose KVS keys use `key_name` (e.g.
+    `writing_observer.writing_analysis.reconstruct`), or `None`.
+    '''
+    return _reducer_index()[3].get(key_name)
+
+
 def third_party():
     '''
     Return a list of modules to download from 3rd party repos.
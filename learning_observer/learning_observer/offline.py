@@ -169,6 +169,10 @@ async def process_file(
             print(event)
             raise
 
+    # Write out any reducer state still cached in process
+    if hasattr(pipeline, 'flush'):
+        await pipeline.flush()
+
     return n, source, userid
 
 
@@ -7,8 +7,11 @@ confident using redis.asyncio. It handles a lot of what we do manually inside
 the library.
 '''
 
+import json
+
 import pmss
 import redis.asyncio
+import redis.exceptions
 
 import learning_observer.settings
 from learning_observer.log_event import debug_log
@@ -92,6 +95,84 @@ async def set(key, value, expiry=None):
     return await (await connection()).set(key, value, expiry)
 
 
+async def mset(items, expiry=None, notify_channel=None, hashes=None):
+    '''
+    Set multiple keys in one round trip. `items` is a dictionary. We
+    pipeline individual `SET`s rather than using `MSET`, since `MSET`
+    does not support expiry. The pipeline is not a transaction.
+
+    `hashes` maps more keys to dictionaries of fields, which we store as
+    redis hashes, replacing whatever the keys held before. If there are
+    any, the pipeline is a transaction, so no one sees half a hash.
+
+    If `notify_channel` is given, we also publish the list of keys (as
+    JSON) to that channel, in the same round trip.
+    '''
+    hashes = hashes or {}
+    async with (await connection()).pipeline(transaction=bool(hashes)) as pipeline:
+        for key, value in items.items():
+            pipeline.set(key, value, expiry)
+        for key, fields in hashes.items():
+            pipeline.delete(key)
+            pipeline.hset(key, mapping=fields)
+            if expiry is not None:
+                pipeline.expire(key, expiry)
+        if notify_channel is not None:
+            pipeline.publish(notify_channel, json.dumps(list(items) + list(hashes)))
+        return await pipeline.execute()
+
+
+async def mget_hashes(keys, fields=None):
+    '''
+    Read several hashes in one round trip. For each key, we return a
+    dictionary of field names to values (every field, or those of
+    `fields` which are set), or `None` if the key does not exist.
+
+    Keys which hold plain values instead (e.g. written before a store
+    switched to hashes) give the plain value, at the cost of a second
+    round trip.
+    '''
+    async with (await connection()).pipeline(transaction=False) as pipeline:
+        for key in keys:
+            if fields is None:
+                pipeline.hgetall(key)
+            else:
+                pipeline.hmget(key, fields)
+                pipeline.exists(key)
+        results = await pipeline.execute(raise_on_error=False)
+
+    step = 1 if fields is None else 2
+    values = []
+    plain = []
+    for index in range(len(keys)):
+        result = results[index * step]
+        if isinstance(result, redis.exceptions.ResponseError):
+            if not str(result).startswith('WRONGTYPE'):
+                raise result
+            plain.append(index)
+            values.append(None)
+        elif fields is None:
+            values.append({field.decode('utf-8'): value for field, value in result.items()} or None)
+        elif results[index * step + 1]:
+            values.append({field: value for field, value in zip(fields, result) if value is not None})
+        else:
+            values.append(None)
+    if plain:
+        for index, value in zip(plain, await mget([keys[index] for index in plain])):
+            values[index] = value
+    return values
+
+
+async def subscribe(channel):
+    '''
+    Subscribe to a pub/sub channel. Returns a `PubSub`; iterate over
+    `listen()` for messages.
+    '''
+    pubsub = (await connection()).pubsub()
+    await pubsub.subscribe(channel)
+    return pubsub
+
+
 async def delete(key):
     '''
     Delete a key. Returns a future.
@@ -506,12 +506,12 @@ async def memoize_courseroster_runtime(runtime, course_id):
     In the future, we ought to be able to specify how the values from
     individual nodes are handled: static, dynamic (current), or memoized.
     '''
-    # TODO the async memoization cache here is causing a ton of slowdown
-    # when trying to connect to a remote Redis instance.
-    # @learning_observer.cache.async_memoization()
-    async def course_roster_memoization_layer(c):
+    # Rosters depend on who is asking, so the user is part of the key
+    @learning_observer.cache.async_memoization(ttl=60, stale_ttl=600)
+    async def course_roster_memoization_layer(user_id, c):
         return await courseroster_runtime(runtime, c)
-    return await course_roster_memoization_layer(course_id)
+    user = await auth.get_active_user(runtime.get_request()) or {}
+    return await course_roster_memoization_layer(user.get(constants.USER_ID), course_id)
 
 
 async def courseroster(request, course_id):
@@ -0,0 +1,109 @@
+'''
+Single-flight execution
+
+When several callers ask for the same expensive result at about the
+same time (e.g. a teacher with the same dashboard open in three tabs),
+we'd like to compute it once, and hand the result to everyone.
+
+`SingleFlight` runs one call per key at a time. Callers which arrive
+while a call is running wait for it. Results are also kept for `ttl`
+seconds, so callers which arrive shortly after share them too.
+
+Keys must capture everything which affects the result, including who
+is asking, if the result depends on permissions. We never look inside
+them.
+
+Results are shared, not copied, so callers should not modify them.
+'''
+
+import asyncio
+import time
+
+
+class SingleFlight:
+    '''
+    Runs each distinct call once, sharing the result between concurrent
+    callers, and caching it for `ttl` seconds (0 to only share calls in
+    progress).
+
+    >>> calls = []
+    >>> async def slow_square(x):
+    ...     calls.append(x)
+    ...     await asyncio.sleep(0.01)
+    ...     return x * x
+    >>> async def example():
+    ...     flights = SingleFlight(ttl=60)
+    ...     results = await asyncio.gather(*[flights.run(('square', 3), slow_square, 3) for i in range(5)])
+    ...     results.append(await flights.run(('square', 3), slow_square, 3))
+    ...     flights.forget(('square', 3))
+    ...     results.append(await flights.run(('square', 3), slow_square, 3))
+    ...     return results
+    >>> asyncio.run(example())
+    [9, 9, 9, 9, 9, 9, 9]
+    >>> calls
+    [3, 3]
+
+    If every caller waiting on a call is cancelled, so is the call.
+    Exceptions are passed to every waiting caller, and not cached.
+    '''
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        # Key to [task, number of waiting callers]
+        self._in_flight = {}
+        # Key to (expiry time, result)
+        self._results = {}
+
+    async def run(self, key, function, *args, **kwargs):
+        '''
+        Return `await function(*args, **kwargs)`, unless a call with the
+        same `key` is running, or finished less than `ttl` seconds ago.
+        '''
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                return cached[1]
+            del self._results[key]
+
+        entry = self._in_flight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(function(*args, **kwargs))
+            entry = [task, 0]
+            self._in_flight[key] = entry
+            task.add_done_callback(lambda task: self._finished(key, task))
+        task = entry[0]
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _finished(self, key, task):
+        '''
+        Called when a call finishes. Cache the result, if there is one.
+        '''
+        entry = self._in_flight.get(key)
+        if entry is None or entry[0] is not task:
+            # We were `forget`-ten, so our result may be out-of-date
+            return
+        del self._in_flight[key]
+        if self.ttl <= 0 or task.cancelled() or task.exception() is not None:
+            return
+        now = time.monotonic()
+        # Drop expired results, so we don't grow without bound
+        for expired in [k for k, (expiry, result) in self._results.items() if expiry <= now]:
+            del self._results[expired]
+        self._results[key] = (now + self.ttl, task.result())
+
+    def forget(self, key):
+        '''
+        Drop any cached result for `key` (e.g. because the data behind it
+        changed). A call in progress keeps running for the callers
+        waiting on it, but new callers start a new one.
+        '''
+        self._results.pop(key, None)
+        self._in_flight.pop(key, None)
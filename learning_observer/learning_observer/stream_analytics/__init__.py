@@ -72,7 +72,7 @@ def init():
 
     # For debugging; this can go away at some point
     srm['org.mitros.mirror'].append({'reducer': async_lambda(
-        lambda metadata: async_lambda(lambda event: event)
+        lambda metadata, **kwargs: async_lambda(lambda event, **kwargs: event)
     )})
 
     reducers = learning_observer.module_loader.reducers()
@@ -82,7 +82,9 @@ def init():
         scope = reducer.get('scope', helpers.Scope([helpers.KeyField.STUDENT]))
         srm[context].append({
             'reducer': function,
-            'scope': scope
+            'scope': scope,
+            'event_types': getattr(function, 'event_types', None),
+            'event_filter': getattr(function, 'event_filter', None)
         })
 
     global REDUCER_MODULES, LAST_UPDATED
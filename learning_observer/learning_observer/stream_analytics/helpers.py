@@ -35,9 +35,13 @@ works.
 
 import copy
 import functools
+import itertools
+
+import pmss
 
 import learning_observer.kvs
-from learning_observer.stream_analytics.fields import KeyStateType, KeyField, EventField, Scope
+import learning_observer.settings
+from learning_observer.stream_analytics.fields import KeyStateType, KeyField, EventField, Scope, ScopeFieldError
 
 from learning_observer.log_event import debug_log
 
@@ -46,6 +50,74 @@ from learning_observer.log_event import debug_log
 import learning_observer.module_loader
 
 
+pmss.register_field(
+    name='reducer_write_behind',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Keep reducer state in process for the length of a websocket '
+                'connection, and write it back to the KVS in batches rather '
+                'than on every event.',
+    default=False
+)
+pmss.register_field(
+    name='reducer_max_staleness_ms',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `reducer_write_behind`, the longest (in milliseconds) '
+                'reducer state may sit in process before being written to the KVS.',
+    default=1000
+)
+pmss.register_field(
+    name='reducer_max_pending_writes',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `reducer_write_behind`, the number of modified keys which '
+                'triggers an immediate write to the KVS.',
+    default=100
+)
+
+
+def reducer_kvs():
+    '''
+    Return the KVS reducers for one connection should share.
+
+    This is always a `WriteBehindKVS`, so that all the writes reducers
+    make for an event go out in one `multiset`. By default, it does not
+    flush on its own or cache reads: the caller should `flush()` after
+    each event. If `reducer_write_behind` is enabled, it also caches
+    state and flushes on a timer. In either case, the caller should
+    `close()` it when the connection ends.
+    '''
+    kvs = learning_observer.kvs.KVS()
+    settings = learning_observer.settings.pmss_settings
+    if not settings.reducer_write_behind(types=['incoming_events']):
+        return learning_observer.kvs.WriteBehindKVS(kvs, max_staleness=None, cache_reads=False)
+    return learning_observer.kvs.WriteBehindKVS(
+        kvs,
+        max_staleness=settings.reducer_max_staleness_ms(types=['incoming_events']) / 1000,
+        max_pending=settings.reducer_max_pending_writes(types=['incoming_events'])
+    )
+
+
+def accepts_event(event_types, event_filter, event):
+    '''
+    Check an event against a reducer's declared `event_types` and
+    `event_filter` (see `kvs_pipeline`). Either may be `None`, which
+    accepts everything.
+
+    >>> event = {'client': {'event': 'keystroke'}}
+    >>> accepts_event(None, None, event)
+    True
+    >>> accepts_event(frozenset(['google_docs_save']), None, event)
+    False
+    >>> accepts_event(None, lambda e: e['client']['event'] != 'visibility', event)
+    True
+    '''
+    if event_types is not None:
+        if event.get('client', {}).get('event') not in event_types:
+            return False
+    if event_filter is not None and not event_filter(event):
+        return False
+    return True
+
+
 def fully_qualified_function_name(func):
     '''
     Takes a function. Return a fully-qualified string with a name for
@@ -181,11 +253,84 @@ def make_key(func, key_dict, state_type):
     return ",".join(key_list)
 
 
+class KeyTemplate:
+    '''
+    The parts of `make_key` which only depend on the reducer, its scope,
+    and the state type, worked out once. Making a key is then a single
+    string join.
+
+    >>> import math
+    >>> template = KeyTemplate(math.sin, [KeyField.STUDENT, EventField('doc_id')], KeyStateType.INTERNAL)
+    >>> template.make_key({KeyField.STUDENT: 'bob', EventField('doc_id'): 'essay'})
+    'Internal,math.sin,EventField.doc_id:essay,STUDENT:bob'
+    >>> template.make_key({KeyField.STUDENT: 'bob', EventField('doc_id'): 'essay'}) == make_key(
+    ...     math.sin, {KeyField.STUDENT: 'bob', EventField('doc_id'): 'essay'}, KeyStateType.INTERNAL)
+    True
+    '''
+    def __init__(self, func, fields, state_type):
+        assert isinstance(state_type, KeyStateType)
+        self.prefix = "{state},{module}".format(
+            state=state_type.name.capitalize(),
+            module=fully_qualified_function_name(func)
+        )
+        # Same order as `make_key`
+        self.fields = sorted(fields, key=lambda x: x.name)
+        self._labels = [field.name + ":" for field in self.fields]
+
+    def make_key(self, key_dict):
+        '''
+        Make the key for `key_dict`, which must have a value for each of
+        our fields.
+        '''
+        parts = [self.prefix]
+        for field, label in zip(self.fields, self._labels):
+            parts.append(label + str(key_dict[field]))
+        return ",".join(parts)
+
+    def make_keys(self, field_values):
+        '''
+        Make keys for every combination of values, e.g. a whole roster
+        by a set of documents. `field_values` maps each field to a list
+        of values. Keys come back in the order of
+        `itertools.product(*field_values.values())`.
+
+        >>> import math
+        >>> template = KeyTemplate(math.sin, [KeyField.STUDENT, EventField('doc_id')], KeyStateType.INTERNAL)
+        >>> template.make_keys({KeyField.STUDENT: ['ann', 'bob'], EventField('doc_id'): ['essay']})
+        ['Internal,math.sin,EventField.doc_id:essay,STUDENT:ann', 'Internal,math.sin,EventField.doc_id:essay,STUDENT:bob']
+        '''
+        caller_order = list(field_values)
+        if sorted(caller_order, key=lambda x: x.name) != self.fields:
+            raise ScopeFieldError("Expected values for {}, got {}".format(self.fields, caller_order))
+        # Format each value once, rather than once per key
+        segments = {
+            field: [label + str(value) for value in field_values[field]]
+            for field, label in zip(self.fields, self._labels)
+        }
+        # Where each of our fields is in the caller's order
+        positions = [caller_order.index(field) for field in self.fields]
+        keys = []
+        for combination in itertools.product(*(segments[field] for field in caller_order)):
+            keys.append(",".join([self.prefix] + [combination[position] for position in positions]))
+        return keys
+
+
+@functools.lru_cache(maxsize=1024)
+def key_template(func, fields, state_type):
+    '''
+    A cached `KeyTemplate`. `fields` must be hashable, such as a `Scope`.
+    '''
+    return KeyTemplate(func, fields, state_type)
+
+
 def kvs_pipeline(
         null_state=None,
         scope=None,
         module_override=None,
-        qualname_override=None
+        qualname_override=None,
+        event_types=None,
+        event_filter=None,
+        field_layout=False
 ):
     '''
     Closures, anyone?
@@ -199,11 +344,25 @@ def kvs_pipeline(
       happened. This can be important for the aggregator. We're documenting the
       code before we've written it, so please make sure this works before using.
     * `scope` tells us the scope we reduce over. See `fields.Scope`
+    * `event_types` is an optional collection of event types (the
+      `client.event` field, e.g. `google_docs_save`) the reducer acts on.
+    * `event_filter` is an optional predicate, called with the event,
+      which returns `False` if the reducer should ignore that event.
+
+    Events which fail either check are dropped before we touch the KVS.
+    The incoming event pipeline also uses these to avoid calling the
+    reducer at all.
+
+    * `field_layout` lets stores keep the reducer's state one top-level
+      field at a time (see `learning_observer.kvs.register_field_layout`).
+      This suits large states where dashboards read a few fields.
     '''
     if scope is None:
         debug_log("TODO: explicitly specify a scope")
         debug_log("Defaulting to student scope")
         scope = Scope([KeyField.STUDENT])
+    if event_types is not None:
+        event_types = frozenset(event_types)
 
     def decorator(
         func
@@ -230,9 +389,14 @@ def kvs_pipeline(
             setattr(func, '__qualname__', qualname_override)
         if module_override is not None:
             setattr(func, '__module__', module_override)
+        if field_layout:
+            for state_type in KeyStateType:
+                learning_observer.kvs.register_field_layout(make_key(func, {}, state_type) + ',')
+        internal_key_template = KeyTemplate(func, scope, KeyStateType.INTERNAL)
+        external_key_template = KeyTemplate(func, scope, KeyStateType.EXTERNAL)
 
         @functools.wraps(func)
-        async def wrapper_closure(metadata):
+        async def wrapper_closure(metadata, kvs=None):
             '''
             The decorator itself. We create a function that, when called,
             creates an event processing pipeline. It keeps a pointer
@@ -240,8 +404,11 @@ def kvs_pipeline(
             its own KVS. This is the level at which we want consistency,
             want to allow sharding, etc. If two users are connected, each
             will have their own data store connection.
+
+            The caller may pass in a `kvs` (see `reducer_kvs`) so that all
+            reducers on a connection share one cache.
             '''
-            taskkvs = learning_observer.kvs.KVS()
+            taskkvs = kvs if kvs is not None else learning_observer.kvs.KVS()
 
             async def process_event(event, event_fields={}):
                 '''
@@ -257,6 +424,9 @@ def kvs_pipeline(
                 large or private. The internal state needs everything
                 needed to continue reducing the events.
                 '''
+                if not accepts_event(event_types, event_filter, event):
+                    return False
+
                 # TODO: Think through concurrency.
                 #
                 # We could put this inside of a transaction, but we
@@ -312,21 +482,17 @@ def kvs_pipeline(
                     else:
                         raise Exception("Unknown field", field)
 
-                internal_key = make_key(
-                    func,
-                    keydict,
-                    KeyStateType.INTERNAL
-                )
-                external_key = make_key(
-                    func,
-                    keydict,
-                    KeyStateType.EXTERNAL
-                )
+                internal_key = internal_key_template.make_key(keydict)
+                external_key = external_key_template.make_key(keydict)
 
-                internal_state = await taskkvs[internal_key]
+                updates = {}
+                # Reducers may modify their state in place
+                internal_state = await taskkvs.get(internal_key, mutable=True)
                 if internal_state is None:
                     internal_state = copy.deepcopy(null_state)
-                    await taskkvs.set(internal_key, internal_state)
+                    # The reducer may modify this in place, so we write
+                    # a separate copy.
+                    updates[internal_key] = copy.deepcopy(null_state)
 
                 internal_state, external_state = await func(
                     event, internal_state
@@ -335,11 +501,16 @@ def kvs_pipeline(
                 # We would like to give reducers the option to /not/ write
                 # on all events
                 if internal_state is not False:
-                    await taskkvs.set(internal_key, internal_state)
+                    updates[internal_key] = internal_state
                 if external_state is not False:
-                    await taskkvs.set(external_key, external_state)
+                    updates[external_key] = external_state
+                # All of our writes go out together
+                if updates:
+                    await taskkvs.multiset(updates)
                 return external_state
             return process_event
+        wrapper_closure.event_types = event_types
+        wrapper_closure.event_filter = event_filter
         return wrapper_closure
     return decorator
 
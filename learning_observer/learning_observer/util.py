@@ -14,6 +14,7 @@ import dash.development.base_component
 import datetime
 import enum
 import hashlib
+import itertools
 import math
 import numbers
 import re
@@ -270,6 +271,92 @@ async def ensure_async_generator(it):
         raise TypeError(f"Object of type {type(it)} is not iterable")
 
 
+# How many items we group together when passing data in chunks
+DEFAULT_CHUNK_SIZE = 64
+
+
+async def ensure_async_chunks(it, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Like `ensure_async_generator`, but yield lists (chunks) of up to
+    `chunk_size` items, so consumers can handle a batch at a time.
+    Sources which already produce chunks (anything with a `chunks()`
+    method, such as results passed between communication protocol
+    nodes) are passed through, with small chunks combined.
+
+    >>> asyncio.run(async_generator_to_list(ensure_async_chunks(range(5), chunk_size=2)))
+    [[0, 1], [2, 3], [4]]
+    >>> asyncio.run(async_generator_to_list(ensure_async_chunks({'a': 1})))
+    [[{'a': 1}]]
+
+    Other async iterables (e.g. the results of published functions) may
+    take a while to produce each item, so we pass their items on as
+    they arrive, one per chunk, rather than wait to fill a chunk. Use
+    `async_batched` where waiting is fine.
+
+    >>> import time
+    >>> async def slow():
+    ...     for i in range(3):
+    ...         await asyncio.sleep(0.05)
+    ...         yield i
+    >>> async def first_chunk():
+    ...     start = time.monotonic()
+    ...     async for chunk in ensure_async_chunks(slow()):
+    ...         return chunk, time.monotonic() - start < 0.1
+    >>> asyncio.run(first_chunk())
+    ([0], True)
+
+    Chunks may be shared between consumers, so should not be modified.
+    '''
+    chunk_size = max(chunk_size, 1)
+    if isinstance(it, dict):
+        yield [it]
+    elif hasattr(it, 'chunks'):
+        # Pass full chunks through, and combine small ones
+        pending = []
+        async for chunk in it.chunks():
+            if not pending and len(chunk) >= chunk_size:
+                yield chunk
+                continue
+            pending.extend(chunk)
+            if len(pending) >= chunk_size:
+                yield pending
+                pending = []
+        if pending:
+            yield pending
+    elif isinstance(it, collections.abc.AsyncIterable):
+        async for item in it:
+            yield [item]
+    elif isinstance(it, collections.abc.Iterable):
+        iterator = iter(it)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+    else:
+        raise TypeError(f"Object of type {type(it)} is not iterable")
+
+
+async def async_batched(it, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Group the items of the async iterable `it` into lists of
+    `chunk_size` (the last may be shorter). Each chunk waits for all its
+    items, so this is for sources which produce items quickly.
+
+    >>> async def numbers():
+    ...     for i in range(5):
+    ...         yield i
+    >>> asyncio.run(async_generator_to_list(async_batched(numbers(), chunk_size=2)))
+    [[0, 1], [2, 3], [4]]
+    '''
+    chunk = []
+    async for item in it:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 async def async_zip(iterator1, iterator2):
     '''Zip 2 async generators together.
     This functions similar to `zip`
@@ -0,0 +1,202 @@
+'''
+Worker pools
+
+Published functions which block (CPU-bound NLP, synchronous clients)
+shouldn't run in the event loop. Historically, each parallel `map`
+node made its own `ThreadPoolExecutor`, so busy dashboards made and
+tore down threads constantly, with no bound across dashboards.
+
+Instead, we keep named, process-wide pools, created the first time
+they are used, and configured in `creds.yaml`:
+
+```yaml
+worker_pools:
+  default:
+    pool_type: thread
+    max_workers: 16
+  nlp:
+    pool_type: process
+    max_workers: 4
+```
+
+Pools which aren't configured are thread pools of the default size.
+Process pools need functions (and their arguments and results) which
+can be pickled, which means module-level functions.
+
+Published functions can also be limited to a number of calls at once
+across the whole process, and given a timeout, when they are
+published (see `integration.publish_function`):
+
+```python
+@publish_function('wo_bulk_essay_analysis.gpt_essay_prompt', max_concurrency=8)
+```
+
+This keeps many dashboards from stampeding upstream services (GPT,
+LanguageTool) at once. Limits are per process.
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+
+import pmss
+
+import learning_observer.settings
+
+
+DEFAULT_POOL = 'default'
+
+pmss.parser('pool_type', parent='string', choices=['thread', 'process'], transform=None)
+pmss.register_field(
+    name='pool_type',
+    type='pool_type',
+    description='What a worker pool runs functions in:\n'\
+                '`thread`: threads, for functions which block on I/O or '
+                'release the GIL\n'\
+                '`process`: separate processes, for CPU-bound functions',
+    default='thread'
+)
+pmss.register_field(
+    name='max_workers',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='The most threads or processes a worker pool runs. '
+                '0 uses the Python default for the pool type.',
+    default=0
+)
+
+
+# How a published function should be called, by `call` and `map` nodes
+FunctionLimits = collections.namedtuple(
+    'FunctionLimits',
+    ['worker_pool', 'max_concurrency', 'timeout']
+)
+DEFAULT_LIMITS = FunctionLimits(worker_pool=None, max_concurrency=None, timeout=None)
+
+# Function name to `FunctionLimits`
+FUNCTION_LIMITS = {}
+
+# Pool name to executor
+_POOLS = {}
+
+# Function name to (event loop, semaphore). Semaphores belong to a
+# loop, and tests run several.
+_SEMAPHORES = {}
+
+
+def _pool_settings(name):
+    '''
+    The type and size of the pool `name`. We fall back to the defaults
+    if settings are not loaded (e.g. in doctests).
+    '''
+    if learning_observer.settings.pmss_settings is None:
+        return 'thread', 0
+    types = ['worker_pools', name]
+    return (
+        learning_observer.settings.pmss_settings.pool_type(types=types),
+        learning_observer.settings.pmss_settings.max_workers(types=types)
+    )
+
+
+def get_pool(name=None):
+    '''
+    Return the executor for the pool `name`, creating it if needed.
+
+    >>> get_pool() is get_pool(DEFAULT_POOL)
+    True
+    '''
+    if name is None:
+        name = DEFAULT_POOL
+    pool = _POOLS.get(name)
+    if pool is None:
+        pool_type, max_workers = _pool_settings(name)
+        executor = {
+            'thread': concurrent.futures.ThreadPoolExecutor,
+            'process': concurrent.futures.ProcessPoolExecutor
+        }[pool_type]
+        if pool_type == 'thread':
+            pool = executor(max_workers=max_workers or None, thread_name_prefix='lo_{}'.format(name))
+        else:
+            pool = executor(max_workers=max_workers or None)
+        _POOLS[name] = pool
+    return pool
+
+
+def set_function_limits(name, worker_pool=None, max_concurrency=None, timeout=None):
+    '''
+    Set how the published function `name` is called: which pool it
+    runs in (if it isn't a coroutine), the most calls to run at once
+    across the process, and how many seconds a call may take. `None`
+    means the default pool, no limit, and no timeout.
+    '''
+    if max_concurrency is not None and max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1, not {}".format(max_concurrency))
+    FUNCTION_LIMITS[name] = FunctionLimits(
+        worker_pool=worker_pool,
+        max_concurrency=max_concurrency,
+        timeout=timeout
+    )
+    _SEMAPHORES.pop(name, None)
+
+
+def function_limits(name):
+    '''
+    Return the `FunctionLimits` for the published function `name`.
+
+    >>> function_limits('not.a.published.function')
+    FunctionLimits(worker_pool=None, max_concurrency=None, timeout=None)
+    '''
+    return FUNCTION_LIMITS.get(name, DEFAULT_LIMITS)
+
+
+def _semaphore(name, max_concurrency):
+    '''
+    The semaphore limiting calls to `name`, in the running loop.
+    '''
+    loop = asyncio.get_running_loop()
+    entry = _SEMAPHORES.get(name)
+    if entry is None or entry[0] is not loop:
+        entry = (loop, asyncio.Semaphore(max_concurrency))
+        _SEMAPHORES[name] = entry
+    return entry[1]
+
+
+async def call(name, func, *args, is_coroutine=None, in_pool=True):
+    '''
+    Call the published function `func` (published as `name`) with
+    `args`, within its limits. Coroutine functions are awaited, and
+    other functions run in their worker pool (or, if `in_pool` is
+    `False` and no pool was set for them, in the event loop).
+
+    If the call times out, we raise `asyncio.TimeoutError`. If we are
+    cancelled, we cancel the call. A call already running in a worker
+    can't be interrupted, but calls still queued for a worker are
+    dropped.
+
+    >>> set_function_limits('example.add', max_concurrency=2)
+    >>> asyncio.run(call('example.add', lambda x, y: x + y, 1, 2))
+    3
+    '''
+    limits = function_limits(name)
+    if is_coroutine is None:
+        is_coroutine = asyncio.iscoroutinefunction(func)
+
+    async def run():
+        if is_coroutine:
+            return await func(*args)
+        if in_pool or limits.worker_pool is not None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_pool(limits.worker_pool), func, *args)
+        return func(*args)
+
+    async def run_with_timeout():
+        if limits.timeout is None:
+            return await run()
+        try:
+            return await asyncio.wait_for(run(), limits.timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError("{} took more than {} seconds".format(name, limits.timeout))
+
+    if limits.max_concurrency is None:
+        return await run_with_timeout()
+    async with _semaphore(name, limits.max_concurrency):
+        return await run_with_timeout()
@@ -9,7 +9,7 @@ template = """[Task]\n{question}\n\n[Essay]\n{text}"""
 rubric_template = """{task}\n\n[Rubric]\n{rubric}"""
 
 
-@learning_observer.communication_protocol.integration.publish_function('wo_bulk_essay_analysis.gpt_essay_prompt')
+@learning_observer.communication_protocol.integration.publish_function('wo_bulk_essay_analysis.gpt_essay_prompt', max_concurrency=8)
 async def process_student_essay(text, prompt, system_prompt, tags):
     '''
     This method processes text with a prompt through GPT.
@@ -19,7 +19,7 @@ async def process_student_essay(text, prompt, system_prompt, tags):
     copy_tags = tags.copy()
 
     @learning_observer.cache.async_memoization()
-    async def gpt(gpt_prompt):
+    async def gpt(gpt_prompt, system_prompt):
         completion = await lo_gpt.gpt.gpt_responder.chat_completion(gpt_prompt, system_prompt)
         return completion
 
@@ -41,7 +41,7 @@ async def process_student_essay(text, prompt, system_prompt, tags):
 
         output = {
             'text': text,
-            'feedback': await gpt(formatted_prompt),
+            'feedback': await gpt(formatted_prompt, system_prompt),
             'prompt': prompt
         }
     return output
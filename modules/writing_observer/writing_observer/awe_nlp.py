@@ -8,6 +8,7 @@ import functools
 import multiprocessing
 import os
 import pmss
+import re
 import time
 
 from concurrent.futures import ProcessPoolExecutor
@@ -49,6 +50,22 @@ pmss.register_field(
     default='none'
 )
 
+pmss.register_field(
+    name='nlp_worker_processes',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='How many worker processes run the NLP pipeline. Each '
+                'has its own copy of the spacy model. 0 uses one per CPU.',
+    default=0
+)
+pmss.register_field(
+    name='nlp_batch_size',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='The most texts (essays or paragraphs) we send to an NLP '
+                'worker at once. Workers parse each batch with `nlp.pipe`, '
+                'which is faster than parsing texts one by one.',
+    default=8
+)
+
 RUN_MODES = enum.Enum('RUN_MODES', 'MULTIPROCESSING SERIAL')
 
 
@@ -143,7 +160,31 @@ def process_text(text, options=None):
     '''
     This will extract a dictionary of metadata using Paul's AWE Workbench code.
     '''
-    doc = nlp(text)
+    return annotate_doc(nlp(text), text, options)
+
+
+def process_batch(jobs):
+    '''
+    Process a batch of `(text, options)` jobs, parsing the texts
+    together with `nlp.pipe`. For each job, we return its indicators,
+    and its number of words (so `percent` summaries can be weighted when
+    we combine paragraphs). This is what NLP workers run.
+    '''
+    texts = [text for text, options in jobs]
+    results = []
+    for doc, (text, options) in zip(nlp.pipe(texts, batch_size=len(texts)), jobs):
+        results.append({
+            'features_available': annotate_doc(doc, text, options),
+            'words': sum(1 for token in doc if token.is_alpha)
+        })
+    return results
+
+
+def annotate_doc(doc, text, options=None):
+    '''
+    Compute the indicators in `options` (default: all of them) for a
+    parsed `doc` of `text`.
+    '''
     results = {}
 
     if options is None:
@@ -205,38 +246,275 @@ def run_in_fork(func):
         os._exit(0)
 
 
-async def process_texts_parallel(texts, options=None):
+def _init_worker():
     '''
-    This will spin up as many processes as we have cores, and process texts
-    in parallel. Note that we should confirm issues of thread safety. If
-    Python does this right, this should run in forked environments, and we
-    won't run into issues. Otherwise, we'd want to either fork ourselves, or
-    understand how well spacy, etc. do with parallelism.
+    Run once in each NLP worker as it starts. Workers are forked with
+    the model already loaded; we run it once, so the first real batch
+    doesn't pay for any lazy set-up.
+    '''
+    nlp('Warm up.')
+
+
+def _setting(name):
+    return getattr(learning_observer.settings.pmss_settings, name)(types=['modules', 'writing_observer'])
+
+
+def get_executor():
+    '''
+    The pool of NLP worker processes. We start it the first time it's
+    needed, and keep it for the life of the server.
     '''
     global executor
     if executor is None:
-        executor = ProcessPoolExecutor()
+        executor = ProcessPoolExecutor(
+            max_workers=_setting('nlp_worker_processes') or None,
+            initializer=_init_worker
+        )
+    return executor
 
-    loop = asyncio.get_running_loop()
-    result_futures = []
-    for text in texts:
-        processor = functools.partial(process_text, text, options)
-        # forked_processor = functools.partial(run_in_fork, processor)
-        result_futures.append(loop.run_in_executor(executor, processor))
+
+class _Batcher:
+    '''
+    Collects the texts which concurrent callers want processed, and sends
+    them to the workers in batches of up to `nlp_batch_size`. Texts
+    submitted in the same pass of the event loop (e.g. every paragraph
+    which changed across a classroom's essays) are batched together.
+    '''
+    def __init__(self):
+        self._pending = []
+        self._flush_scheduled = False
+
+    async def submit(self, text, options, mode=RUN_MODES.MULTIPROCESSING):
+        '''
+        Process `text`. Returns a `process_batch` result.
+        '''
+        if mode == RUN_MODES.SERIAL:
+            return process_batch([(text, options)])[0]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, options, future))
+        if len(self._pending) >= _setting('nlp_batch_size'):
+            self._flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        batch_size = max(1, _setting('nlp_batch_size'))
+        while self._pending:
+            batch, self._pending = self._pending[:batch_size], self._pending[batch_size:]
+            jobs = [(text, options) for text, options, future in batch]
+            result = asyncio.get_running_loop().run_in_executor(get_executor(), process_batch, jobs)
+            result.add_done_callback(functools.partial(self._deliver, [future for text, options, future in batch]))
+
+    @staticmethod
+    def _deliver(futures, result):
+        for i, future in enumerate(futures):
+            if future.done():
+                # The caller was cancelled
+                continue
+            if result.cancelled():
+                future.cancel()
+            elif result.exception() is not None:
+                future.set_exception(result.exception())
+            else:
+                future.set_result(result.result()[i])
+
+
+batcher = _Batcher()
+
+
+async def process_texts_parallel(texts, options=None):
+    '''
+    Process texts in our NLP worker processes, in batches (see
+    `_Batcher`). Results are in the same order as `texts`.
+    '''
+    results = await asyncio.gather(*(batcher.submit(text, options) for text in texts))
 
     annotated = []
-    for text, result_future in zip(texts, result_futures):
-        try:
-            annotations = await result_future
-            annotations['text'] = text
-        except Exception:
-            raise
-            annotations = "Error"
+    for text, result in zip(texts, results):
+        annotations = result['features_available']
+        annotations['text'] = text
         annotated.append(annotations)
 
     return annotated
 
 
+# Indicators which depend on the whole document (content segmentation,
+# paragraph counts), or whose `percent` summaries aren't over words, so
+# we can't combine them from paragraphs. We compute these over the full
+# text. Everything else is computed (and cached) a paragraph at a time.
+#
+# Paragraphs are split on newlines, which AWE counts as introductory
+# transitions (see `nlp_indicators`), so transition counts which
+# include those are also computed over the full text.
+DOCUMENT_LEVEL_INDICATORS = {
+    'transition_words',
+    'introductory_transition_words',
+    'statements_of_opinion',
+    'statements_of_fact',
+    'main_idea_sentences',
+    'supporting_idea_sentences',
+    'supporting_detail_sentences',
+    'direct_speech_verbs',
+    'paragraphs',
+    'explicit_claims',
+    'social_awareness'
+}
+
+
+def split_paragraphs(text):
+    '''
+    Split `text` into paragraphs, returning `(offset, paragraph)` pairs.
+    Blank lines are dropped.
+
+    >>> split_paragraphs('One.\\n\\nTwo.\\n')
+    [(0, 'One.'), (6, 'Two.')]
+    '''
+    return [
+        (match.start(), match.group())
+        for match in re.finditer(r'[^\n]+', text)
+        if match.group().strip()
+    ]
+
+
+def _merge_metrics(summary_type, metrics, weights):
+    '''
+    Combine the summary metrics for each paragraph into one for the
+    document: `total`s and `counts` add up, and `percent`s are averaged,
+    weighted by each paragraph's words.
+    '''
+    if summary_type == 'percent':
+        total_weight = sum(weights)
+        if total_weight == 0:
+            return 0
+        return sum(m * w for m, w in zip(metrics, weights)) / total_weight
+    if summary_type == 'counts':
+        # AWE may give these to us as a JSON string
+        is_json = any(isinstance(m, str) for m in metrics)
+        counts = {}
+        for metric in metrics:
+            if isinstance(metric, str):
+                metric = json.loads(metric)
+            for key, count in (metric or {}).items():
+                counts[key] = counts.get(key, 0) + count
+        return json.dumps(counts) if is_json else counts
+    return sum(metrics)
+
+
+def combine_paragraph_features(paragraphs, feature_ids):
+    '''
+    Combine per-paragraph indicators into document-level ones.
+    `paragraphs` is a list of `(offset, cache entry)`, where each cache
+    entry comes from `process_batch`. Offsets are rebased from the
+    paragraph to the document.
+
+    >>> words = {
+    ...     'name': 'academic_language', 'label': 'Academic Language', 'type': 'Token',
+    ...     'summary_type': 'percent'
+    ... }
+    >>> first = {'words': 3, 'features_available': {'academic_language': dict(
+    ...     words, metric=100, offsets=[[0, 4]], text=['essay'])}}
+    >>> second = {'words': 1, 'features_available': {'academic_language': dict(
+    ...     words, metric=0, offsets=[], text=[])}}
+    >>> combined = combine_paragraph_features([(0, first), (10, second), (20, first)], ['academic_language'])
+    >>> combined['academic_language']['metric'], combined['academic_language']['offsets']
+    (85.71428571428571, [[0, 4], [20, 4]])
+    >>> combined['academic_language']['text']
+    ['essay']
+    '''
+    combined = {}
+    for feature_id in feature_ids:
+        (id, label, infoType, select, filterInfo, summaryType, category) = writing_observer.nlp_indicators.INDICATORS[feature_id]
+        pieces = [(offset, entry['features_available'][feature_id], entry['words']) for offset, entry in paragraphs]
+        offsets = [
+            [start + offset, length]
+            for offset, indicator, words in pieces
+            for start, length in indicator['offsets']
+        ]
+        if infoType == 'Token':
+            # These are unique lemmas
+            text = list(dict.fromkeys(t for offset, indicator, words in pieces for t in indicator['text']))
+        else:
+            text = [t for offset, indicator, words in pieces for t in indicator['text']]
+        combined[feature_id] = {
+            'metric': _merge_metrics(
+                summaryType,
+                [indicator['metric'] for offset, indicator, words in pieces],
+                [words for offset, indicator, words in pieces]
+            ),
+            'offsets': offsets,
+            'text': text,
+            'label': label,
+            'type': infoType,
+            'name': id,
+            'summary_type': summaryType
+        }
+    return combined
+
+
+async def annotate_text_incrementally(cache, text, features, mode=RUN_MODES.MULTIPROCESSING):
+    '''
+    Compute `features` for `text`, a paragraph at a time. Each
+    paragraph's indicators are cached under a hash of the paragraph, so
+    when a student edits one paragraph, only that paragraph is parsed
+    again. Indicators in `DOCUMENT_LEVEL_INDICATORS` are still computed
+    over the whole text. Features which aren't indicators (see
+    `nlp_indicators.INDICATORS`) are skipped, as in `annotate_doc`.
+    '''
+    features = set(features).intersection(writing_observer.nlp_indicators.INDICATORS)
+    document_features = features.intersection(DOCUMENT_LEVEL_INDICATORS)
+    paragraph_features = features - document_features
+
+    # Start the whole text first, so it's batched with the paragraphs
+    document_task = None
+    if document_features:
+        document_task = asyncio.ensure_future(batcher.submit(text, list(document_features), mode))
+
+    annotated = {}
+    if paragraph_features:
+        annotated.update(await _annotate_paragraphs(cache, text, paragraph_features, mode))
+    if document_task is not None:
+        annotated.update((await document_task)['features_available'])
+    return annotated
+
+
+async def _annotate_paragraphs(cache, text, paragraph_features, mode):
+    '''
+    Compute `paragraph_features` for each paragraph of `text`, using
+    cached paragraphs where we can, and combine them.
+    '''
+    paragraphs = split_paragraphs(text)
+    keys = [
+        'NLP_PARAGRAPH_CACHE_' + learning_observer.util.secure_hash(paragraph.encode('utf-8'))
+        for offset, paragraph in paragraphs
+    ]
+    entries = await cache.multiget(keys)
+    submitted = {}
+    for i, ((offset, paragraph), entry) in enumerate(zip(paragraphs, entries)):
+        if entry is None:
+            entry = {'features_available': {}, 'words': 0}
+            entries[i] = entry
+        missing = paragraph_features - set(entry['features_available'])
+        if missing:
+            submitted[i] = batcher.submit(paragraph, list(missing), mode)
+
+    updates = {}
+    for i, processed in zip(submitted, await asyncio.gather(*submitted.values())):
+        entries[i]['features_available'].update(processed['features_available'])
+        entries[i]['words'] = processed['words']
+        updates[keys[i]] = entries[i]
+    if updates:
+        await cache.multiset(updates)
+
+    return combine_paragraph_features(
+        [(offset, entry) for (offset, paragraph), entry in zip(paragraphs, entries)],
+        paragraph_features
+    )
+
+
 async def get_latest_cache_data_for_text(cache, text_hash):
     """
     Cache Helper Function: Returns latest cache for the text hash or initializes key-value pair for that hash if it does not already exist in the cache.
@@ -269,6 +547,46 @@ async def check_available_features_in_cache(cache, text_hash, requested_features
     return found_features, writing
 
 
+# Text hash to `(features, future, start time)` for the features this
+# process is computing for that text. The future gets the features, or
+# `None` if computing them failed.
+RUNNING_FEATURES = {}
+
+
+async def wait_for_other_process(cache, text_hash, sleep_interval, wait_time_for_running_features):
+    """
+    Wait for another process to finish computing features for a text,
+    and return the updated cache entry, or `None` if it didn't finish
+    within `wait_time_for_running_features` of starting.
+
+    We check the entry starting every `sleep_interval` seconds and
+    backing off. If the KVS has change notifications, we also check as
+    soon as it changes. We still check on the timer in case a
+    notification is lost (e.g. redis pub/sub drops messages while
+    reconnecting).
+    """
+    watch = cache.watch([text_hash]) if cache.change_notifications else None
+    delay = sleep_interval
+    try:
+        while True:
+            # We watch before reading, so we can't miss the update
+            new_cache = await cache[text_hash]
+            if new_cache is None or new_cache.get('stop_time') != "running":
+                return new_cache
+            elapsed = (timeparse(timestamp()) - timeparse(new_cache['start_time'])).total_seconds()
+            remaining = wait_time_for_running_features - elapsed
+            if remaining <= 0:
+                return None
+            if watch is not None:
+                await watch.wait(timeout=min(delay, remaining))
+            else:
+                await asyncio.sleep(min(delay, remaining))
+            delay = delay * 2
+    finally:
+        if watch is not None:
+            watch.close()
+
+
 async def check_and_wait_for_running_features(writing, requested_features, found_features, cache, sleep_interval, wait_time_for_running_features, text_hash):
     """
     Check if some options are a subset of running_features: features that are needed but are already running
@@ -276,36 +594,49 @@ async def check_and_wait_for_running_features(writing, requested_features, found
     :param requested_features: The set of requested features.
     :param found_features: The found features.
     :param cache: The cache object.
-    :param sleep_interval: The time interval in seconds to wait between recurring calls to cache.
+    :param sleep_interval: If the KVS can't notify us of changes, the initial time in seconds to wait between checks of the cache.
     :param wait_time_for_running_features: The time in seconds to wait for features already running.
     :param text_hash: The hash of the text.
     :return: A tuple containing the unfound features, found features, and the updated writing data.
+
+    If this process is computing them, we wait on its future. Otherwise,
+    we check the cache for another process computing them, and wait for
+    it to update the cache (see `wait_for_other_process`).
     """
+    unfound_features = requested_features - found_features
     text_cache_data = await get_latest_cache_data_for_text(cache, text_hash)  # Get latest cache
+
+    # We check this after our last `await` (unless we wait), so if it's
+    # not running here, we register before anyone else can check
+    if text_hash in RUNNING_FEATURES:
+        running_features, future, start = RUNNING_FEATURES[text_hash]
+        needed_running_features = unfound_features.intersection(running_features)
+        if needed_running_features:
+            remaining = wait_time_for_running_features - (time.monotonic() - start)
+            try:
+                annotated_text = await asyncio.wait_for(asyncio.shield(future), max(remaining, 0))
+            except asyncio.TimeoutError:
+                annotated_text = None
+            if annotated_text is not None:
+                computed = needed_running_features.intersection(annotated_text)
+                writing.update({feature: annotated_text[feature] for feature in computed})
+                found_features = found_features.union(computed)
+        return unfound_features, found_features, writing
+
     running_features = set(json.loads(text_cache_data['running_features'])) if 'running_features' in text_cache_data else set()
-    run_successful = False
-    unfound_features = requested_features - found_features
     needed_running_features = set()  # Features that are needed but are already processing
-    if running_features:
+    if running_features and text_cache_data.get('stop_time') == "running":
         needed_running_features = unfound_features.intersection(running_features)
-    # Recursively check if features have finished processing at a regular interval of sleep_interval
     if len(needed_running_features) > 0:
-        while True:
-            new_cache = await cache[text_hash]
-            if new_cache['stop_time'] != "running":
-                run_successful = True
-                break
-            if (timeparse(timestamp()) - timeparse(new_cache['start_time'])).total_seconds() > wait_time_for_running_features:
-                break
-            await asyncio.sleep(sleep_interval)
-        if run_successful:
-            # running_features will be available in features_available after they finish running.
-            writing.update(text_cache_data['features_available'])
+        new_cache = await wait_for_other_process(cache, text_hash, sleep_interval, wait_time_for_running_features)
+        features_available = (new_cache or {}).get('features_available', {})
+        if needed_running_features.issubset(features_available):
+            writing.update({feature: features_available[feature] for feature in needed_running_features})
             found_features = found_features.union(needed_running_features)
     return unfound_features, found_features, writing
 
 
-async def process_and_cache_missing_features(unfound_features, found_features, requested_features, cache, text_hash, writing):
+async def process_and_cache_missing_features(unfound_features, found_features, requested_features, cache, text_hash, writing, mode=RUN_MODES.MULTIPROCESSING):
     """
     Cache Helper: Add not found options to running_features and update cache.
     :param unfound_features: The unfound features.
@@ -314,25 +645,37 @@ async def process_and_cache_missing_features(unfound_features, found_features, r
     :param cache: The cache object.
     :param text_hash: The hash of the text.
     :param writing: The writing data.
+    :param mode: Whether to use the NLP workers, or process in this process.
     :return: The updated writing data.
+
+    While we run, other requests in this process wait on our entry in
+    `RUNNING_FEATURES`, and other processes on the cache entry.
     """
     unfound_features = requested_features - found_features
     running_features = unfound_features
-    temp_cache_dict = {'running_features': json.dumps(list(running_features)),
-                       'start_time': timestamp(),
-                       'stop_time': "running"}
-    
-    text_cache_data = await get_latest_cache_data_for_text(cache, text_hash)  # Get latest cache
-    text_cache_data.update(temp_cache_dict)
-    text_cache_data.setdefault('features_available', dict())
-    await cache.set(text_hash, text_cache_data)
-    
-    annotated_text = process_text(writing.get("text", ""), list(unfound_features))
-    text_cache_data['running_features'] = json.dumps([])
-    text_cache_data['stop_time'] = timestamp()
-    text_cache_data['features_available'].update(annotated_text)
-    writing.update(annotated_text)
-    await cache.set(text_hash, text_cache_data)
+    future = asyncio.get_running_loop().create_future()
+    RUNNING_FEATURES[text_hash] = (running_features, future, time.monotonic())
+    annotated_text = None
+    try:
+        temp_cache_dict = {'running_features': json.dumps(list(running_features)),
+                           'start_time': timestamp(),
+                           'stop_time': "running"}
+
+        text_cache_data = await get_latest_cache_data_for_text(cache, text_hash)  # Get latest cache
+        text_cache_data.update(temp_cache_dict)
+        text_cache_data.setdefault('features_available', dict())
+        await cache.set(text_hash, text_cache_data)
+
+        annotated_text = await annotate_text_incrementally(cache, writing.get("text", ""), unfound_features, mode)
+        text_cache_data['running_features'] = json.dumps([])
+        text_cache_data['stop_time'] = timestamp()
+        text_cache_data['features_available'].update(annotated_text)
+        writing.update(annotated_text)
+        await cache.set(text_hash, text_cache_data)
+    finally:
+        future.set_result(annotated_text)
+        if RUNNING_FEATURES.get(text_hash, (None, None, None))[1] is future:
+            del RUNNING_FEATURES[text_hash]
     return writing
 
 
@@ -349,31 +692,34 @@ async def process_writings_with_caching(writing_data, options=None, mode=RUN_MOD
         a. Wait for running_features to finish.
         b. Update the cache
         c. Add intersection of running_features and Options to results
+        Waiting doesn't poll: we await the job's future if it runs in this
+        process, or a KVS change notification if it runs in another
+        (see `check_and_wait_for_running_features`).
     5. Check if additional features are required.
         * Yes:
         a. Collect options not covered till now and add to running_features.
-        b. Once finished, update cache and return results.
+        b. Compute them a paragraph at a time, reusing cached paragraphs
+           (see `annotate_text_incrementally`).
+        c. Once finished, update cache and return results.
 
     param writing_data: The writing data.
     :param options: The list of additional features (optional).
     :param mode: The run mode (default: RUN_MODES.MULTIPROCESSING).
-    :param sleep_interval: Time in seconds to wait between recurring calls to cache to check if features have finished running, defaults to 1.
+    :param sleep_interval: If the KVS can't notify us of changes, the initial time in seconds between checks of the cache for features running in another process, defaults to 1.
     :param wait_time_for_running_features: The time in seconds to wait for features already running (default: 60).
     :return: The results list.
+
+    Writings are processed concurrently, so the texts they need parsed
+    are sent to the NLP workers in batches, and are yielded as they
+    finish (not necessarily in order).
     '''
-    results = []
     cache = learning_observer.kvs.KVS()
     requested_features = set(options if options else [])
-    processor = {
-        RUN_MODES.MULTIPROCESSING: process_texts_parallel,
-        RUN_MODES.SERIAL: process_texts_serial
-    }
 
-    async for writing in writing_data:
+    async def process_writing(writing):
         text = writing.get('text', '')
         if len(text) == 0:
-            yield writing
-            continue
+            return writing
 
         # Creating text hash and setting defaults
         text_hash = 'NLP_CACHE_' + learning_observer.util.secure_hash(text.encode('utf-8'))
@@ -382,18 +728,28 @@ async def process_writings_with_caching(writing_data, options=None, mode=RUN_MOD
         found_features, writing = await check_available_features_in_cache(cache, text_hash, requested_features, writing)
         # If all options were found
         if found_features == requested_features:
-            yield writing
-            continue
+            return writing
 
         # Check if some options are a subset of running_features: features that are needed but are already running
         unfound_features, found_features, writing = await check_and_wait_for_running_features(writing, requested_features, found_features, cache, sleep_interval, wait_time_for_running_features, text_hash)
         # If all options are found
         if found_features == requested_features:
-            yield writing
-            continue
+            return writing
 
         # Add not found options to running_features and update cache
-        yield await process_and_cache_missing_features(unfound_features, found_features, requested_features, cache, text_hash, writing)
+        return await process_and_cache_missing_features(unfound_features, found_features, requested_features, cache, text_hash, writing, mode)
+
+    # We start every writing at once, so the texts which need
+    # processing are batched together, and yield them as they finish
+    tasks = []
+    try:
+        async for writing in writing_data:
+            tasks.append(asyncio.ensure_future(process_writing(writing)))
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 if __name__ == '__main__':
@@ -1,15 +1,17 @@
+import asyncio
+
 import pmss
 
-import learning_observer.cache
 import learning_observer.communication_protocol.integration
 import learning_observer.prestartup
 import learning_observer.settings
 
 from learning_observer.log_event import debug_log
 
+import writing_observer.languagetool_client
+
 from awe_languagetool import languagetoolClient
 
-client = None
 DEFAULT_PORT = 8081
 lt_started = False
 # TODO fill this in
@@ -36,6 +38,36 @@ pmss.register_field(
     type=pmss.pmsstypes.TYPES.port,
     default=DEFAULT_PORT
 )
+pmss.register_field(
+    name='languagetool_max_concurrency',
+    description='The most requests we send to LanguageTool at once, across '\
+                'all of the dashboards this process serves.',
+    type=pmss.pmsstypes.TYPES.integer,
+    default=8
+)
+pmss.register_field(
+    name='languagetool_cache_size',
+    description='How many sentences each process keeps LanguageTool '\
+                'results for. Texts are checked a sentence at a time, so '\
+                'unchanged sentences are not checked again.',
+    type=pmss.pmsstypes.TYPES.integer,
+    default=writing_observer.languagetool_client.DEFAULT_CACHE_SIZE
+)
+pmss.register_field(
+    name='languagetool_cache_ttl',
+    description='How many seconds LanguageTool results for a sentence are '\
+                'kept. 0 keeps them until they are evicted.',
+    type=pmss.pmsstypes.TYPES.integer,
+    default=writing_observer.languagetool_client.DEFAULT_CACHE_TTL
+)
+pmss.register_field(
+    name='languagetool_stub',
+    description='Instead of connecting to LanguageTool, return fake, '\
+                'deterministic results after a short delay. This is for '\
+                'development and benchmarks.',
+    type=pmss.pmsstypes.TYPES.boolean,
+    default=False
+)
 
 
 @learning_observer.prestartup.register_startup_check
@@ -50,16 +82,29 @@ def check_languagetool_running():
     if learning_observer.settings.module_setting('writing_observer', 'use_languagetool'):
         host = learning_observer.settings.module_setting('writing_observer', 'languagetool_host')
         port = learning_observer.settings.module_setting('writing_observer', 'languagetool_port')
+        max_concurrency = learning_observer.settings.module_setting('writing_observer', 'languagetool_max_concurrency')
         # TODO LanguageTool Client also accepts a full server url, we ought to fetch that from pmss
 
-        global client, lt_started
-        try:
-            client = languagetoolClient.languagetoolClient(port=port, host=host)
-            lt_started = True
-        except RuntimeError as e:
-            raise learning_observer.prestartup.StartupCheck(
-                f'Unable to start LanguageTool Client.\n{e}'
-            ) from e
+        global lt_started
+        if learning_observer.settings.module_setting('writing_observer', 'languagetool_stub'):
+            debug_log('WARNING:: Using stub LanguageTool results.')
+            client = writing_observer.languagetool_client.StubClient()
+            source = 'stub'
+        else:
+            try:
+                client = languagetoolClient.languagetoolClient(port=port, host=host)
+            except RuntimeError as e:
+                raise learning_observer.prestartup.StartupCheck(
+                    f'Unable to start LanguageTool Client.\n{e}'
+                ) from e
+            source = f'{host}:{port}'
+        writing_observer.languagetool_client.set_client(
+            client, source,
+            max_concurrency=max_concurrency,
+            cache_size=learning_observer.settings.module_setting('writing_observer', 'languagetool_cache_size'),
+            cache_ttl=learning_observer.settings.module_setting('writing_observer', 'languagetool_cache_ttl')
+        )
+        lt_started = True
     else:
         debug_log('WARNING:: We are not configured to try and use to LanguageTool. '\
             'Set `modules.writing_observer.use_languagetool: true` in `creds.yaml` '\
@@ -72,15 +117,27 @@ async def process_texts(texts):
     This method processes the text through Language Tool and returns
     the output.
 
-    We use a closure to allow the system to initialize the memoization KVS.
+    Texts are checked concurrently, a sentence at a time, reusing
+    the results for unchanged sentences (see
+    `writing_observer.languagetool_client`). They are yielded as they
+    finish, not necessarily in order.
     '''
-    @learning_observer.cache.async_memoization()
-    async def process_text(text):
-        return await client.summarizeText(text)
-
-    async for t in texts:
+    async def process_text(t):
         text = t.get('text', '')
-        text_data = await process_text(text) if lt_started else STUB_LANGUAGETOOL_OUTPUT
+        if lt_started:
+            text_data = await writing_observer.languagetool_client.summarize_text(text)
+        else:
+            text_data = dict(STUB_LANGUAGETOOL_OUTPUT)
         text_data['text'] = text
         text_data['provenance'] = t['provenance']
-        yield text_data
+        return text_data
+
+    tasks = []
+    try:
+        async for t in texts:
+            tasks.append(asyncio.ensure_future(process_text(t)))
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,292 @@
+'''
+LanguageTool client layer
+
+Checking a whole essay with LanguageTool on every dashboard refresh is
+slow, and almost all of the essay is unchanged since the last
+refresh. Instead, we:
+
+* Split each text into sentences (conservatively: see
+  `split_sentences`), and check (and cache) each sentence separately, so an edit only re-checks the sentences it
+  touched. Identical sentences (in this text, or another student's)
+  share a check. A class has thousands of sentences, so they get their
+  own bounded cache (`SentenceCache`), rather than crowding rosters
+  and GPT results out of `learning_observer.cache`.
+* Check all of a text's sentences, and all of the texts in a query,
+  concurrently, bounded across the process by
+  `languagetool_max_concurrency` (see `learning_observer.worker_pools`).
+  LanguageTool's `/v2/check` takes a single text per request, so this
+  takes the place of batching requests.
+* Combine the sentence summaries into a summary of the whole text,
+  with the fields dashboards read (see `combine_summaries`). Rules
+  which look across sentences (such as repeated sentence starts)
+  won't fire, which we accept for the speed.
+
+`StubClient` stands in for a LanguageTool server, with deterministic
+results and a simulated latency, for development and benchmarks (see
+`scripts/benchmark_languagetool.py`).
+'''
+
+import asyncio
+import collections
+import itertools
+import re
+import time
+
+import learning_observer.single_flight
+import learning_observer.worker_pools
+
+# The name we limit calls to LanguageTool under
+CHECK_FUNCTION = 'writing_observer.languagetool.check'
+
+# A sentence may end with `.`, `!`, or `?` (maybe followed by closing
+# quotes or brackets) and whitespace, and does end at a line break. We
+# keep the whitespace with the sentence, so the sentences add up to the
+# text.
+SENTENCE_END = re.compile(r'(?<=[.!?])["\'”’)\]]*\s+|\n+')
+
+# A period which ends one of these doesn't end a sentence: common
+# abbreviations, and single letters (initials, "U.S.", "e.g.").
+ABBREVIATION = re.compile(r'\b(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|etc|No|Fig|\w(?:\.\w)*)\.$', re.IGNORECASE)
+
+OPENING_PUNCTUATION = '"\'“‘(['
+
+DEFAULT_CACHE_SIZE = 20000
+DEFAULT_CACHE_TTL = 3600
+
+
+class SentenceCache:
+    '''
+    An in-process LRU of sentence summaries, holding at most `size`
+    sentences, each for `ttl` seconds (0 until evicted). Concurrent
+    requests for the same sentence share one check. Summaries are
+    shared, so callers should not modify them.
+
+    >>> calls = []
+    >>> async def check(sentence):
+    ...     calls.append(sentence)
+    ...     await asyncio.sleep(0.01)
+    ...     return {'length': len(sentence)}
+    >>> cache = SentenceCache(size=2)
+    >>> async def example():
+    ...     results = await asyncio.gather(*[cache.get(('stub', s), check, s) for s in ['a', 'bb', 'a']])
+    ...     results.append(await cache.get(('stub', 'ccc'), check, 'ccc'))
+    ...     results.append(await cache.get(('stub', 'a'), check, 'a'))
+    ...     return results
+    >>> asyncio.run(example())
+    [{'length': 1}, {'length': 2}, {'length': 1}, {'length': 3}, {'length': 1}]
+    >>> calls
+    ['a', 'bb', 'ccc', 'a']
+    >>> dict(cache.stats)
+    {'miss': 5}
+    '''
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # Key to (expiry time or `None`, summary), least recently used first
+        self._entries = collections.OrderedDict()
+        self._flights = learning_observer.single_flight.SingleFlight()
+        self.stats = collections.Counter()
+
+    async def get(self, key, check, sentence):
+        '''
+        Return the summary for `key`, calling `check(sentence)` if we
+        don't have it.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None and (entry[0] is None or time.monotonic() < entry[0]):
+            self._entries.move_to_end(key)
+            self.stats['hit'] += 1
+            return entry[1]
+        self.stats['miss'] += 1
+        return await self._flights.run(key, self._fill, key, check, sentence)
+
+    async def _fill(self, key, check, sentence):
+        summary = await check(sentence)
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expiry, summary)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return summary
+
+    def clear(self):
+        self._entries.clear()
+        self.stats.clear()
+
+
+client = None
+# Which server `client` talks to. This is part of each cache key, so
+# results from different servers (or the stub) are never mixed up.
+source = None
+cache = SentenceCache()
+
+
+def set_client(new_client, new_source, max_concurrency=None, cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL):
+    '''
+    Use `new_client` (anything with an async `summarizeText(text)`)
+    for checks, with at most `max_concurrency` checks at once, and a
+    fresh cache of `cache_size` sentences, each kept for `cache_ttl`
+    seconds.
+    '''
+    global client, source, cache
+    client = new_client
+    source = new_source
+    cache = SentenceCache(size=cache_size, ttl=cache_ttl)
+    learning_observer.worker_pools.set_function_limits(CHECK_FUNCTION, max_concurrency=max_concurrency)
+
+
+def split_sentences(text):
+    '''
+    Split `text` into sentences. Joining the sentences gives back
+    `text`.
+
+    Checking a piece which isn't a whole sentence gives false errors
+    (e.g. a lowercase sentence start), so we only split after `.`, `!`,
+    or `?` where the next word is capitalized, and the period doesn't
+    end an abbreviation. If in doubt, we don't split, which only costs
+    caching.
+
+    >>> split_sentences('One fish.  Two fish?\\n\\nRed "fish." blue')
+    ['One fish.  ', 'Two fish?\\n\\n', 'Red "fish." blue']
+    >>> split_sentences('Pets, e.g. the U.S. Army dog, see Dr. Smith. Then they rest.')
+    ['Pets, e.g. the U.S. Army dog, see Dr. Smith. ', 'Then they rest.']
+    >>> split_sentences('')
+    []
+    '''
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if '\n' not in match.group() and not _starts_sentence(text, match):
+            continue
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+def _starts_sentence(text, match):
+    '''
+    Whether the `SENTENCE_END` `match` (which isn't a line break) really
+    ends a sentence.
+    '''
+    position = match.end()
+    while position < len(text) and text[position] in OPENING_PUNCTUATION:
+        position += 1
+    if position < len(text) and not text[position].isupper():
+        return False
+    return not ABBREVIATION.search(text, max(match.start() - 8, 0), match.start())
+
+
+def combine_summaries(pieces):
+    '''
+    Combine the summaries of consecutive pieces of a text into a
+    summary of the whole text. `pieces` is a list of (offset of the
+    piece in the text, summary of the piece).
+
+    We only combine the fields dashboards read: `matches` (moved to
+    be relative to the text), and the `category_counts`,
+    `subcategory_counts`, and `wordcounts['tokens']` counts, which add
+    up. Anything else `summarizeText` returns can't be assumed to add
+    up over sentences (e.g. ratios), so we drop it.
+
+    >>> combine_summaries([
+    ...     (0, {'matches': [{'offset': 4, 'length': 3}], 'category_counts': {'Grammar': 1}, 'wordcounts': {'tokens': 4, 'ratio': 0.5}}),
+    ...     (20, {'matches': [{'offset': 0, 'length': 1}], 'category_counts': {'Grammar': 1, 'Style': 1}, 'wordcounts': {'tokens': 5}, 'other': 1})
+    ... ])
+    {'matches': [{'offset': 4, 'length': 3}, {'offset': 20, 'length': 1}], 'category_counts': {'Grammar': 2, 'Style': 1}, 'subcategory_counts': {}, 'wordcounts': {'tokens': 9}}
+    '''
+    total = {'matches': [], 'category_counts': {}, 'subcategory_counts': {}, 'wordcounts': {'tokens': 0}}
+    for offset, summary in pieces:
+        for match in summary.get('matches', []):
+            match = dict(match)
+            match['offset'] += offset
+            total['matches'].append(match)
+        for field in ['category_counts', 'subcategory_counts']:
+            counts = total[field]
+            for name, count in summary.get(field, {}).items():
+                counts[name] = counts.get(name, 0) + count
+        total['wordcounts']['tokens'] += summary.get('wordcounts', {}).get('tokens', 0)
+    return total
+
+
+async def check_sentence(sentence):
+    '''
+    Check one sentence with LanguageTool, within the concurrency limit.
+    '''
+    return await learning_observer.worker_pools.call(CHECK_FUNCTION, client.summarizeText, sentence, is_coroutine=True)
+
+
+async def summarize_text(text):
+    '''
+    Check `text` a sentence at a time, reusing the results for
+    sentences we've already checked, and return the summary of the
+    whole text.
+
+    Abbreviations don't break sentences, so we find the same errors as
+    checking the whole text:
+
+    >>> stub = StubClient(latency=0, per_character=0)
+    >>> set_client(stub, 'doctest')
+    >>> text = 'We wrote it, e.g. the U.S. and Dr. smith did. i agree.'
+    >>> whole = asyncio.run(stub.summarizeText(text))
+    >>> asyncio.run(summarize_text(text))['matches'] == whole['matches']
+    True
+    '''
+    sentences = split_sentences(text)
+    summaries = await asyncio.gather(*[cache.get((source, sentence), check_sentence, sentence) for sentence in sentences])
+    offsets = itertools.accumulate([0] + [len(sentence) for sentence in sentences])
+    return combine_summaries(zip(offsets, summaries))
+
+
+class StubClient:
+    '''
+    A stand-in for `awe_languagetool`'s client. Checks take `latency`
+    seconds, plus `per_character` seconds per character, and flag a
+    lowercase `i`, repeated words, and a text starting in lowercase
+    (as when a sentence is cut in the wrong place), so results are
+    deterministic but not empty. `requests` counts the checks.
+
+    >>> summary = asyncio.run(StubClient(latency=0).summarizeText('Then i went to to school.'))
+    >>> [(m['offset'], m['label'], m['detail']) for m in summary['matches']]
+    [(5, 'Capitalization', 'First person singular caps'), (12, 'Grammar', 'Repeated words')]
+    >>> summary['category_counts'], summary['wordcounts']
+    ({'Capitalization': 1, 'Grammar': 1}, {'tokens': 6})
+    '''
+    RULES = [
+        (re.compile(r'\bi\b'), ('Capitalization', 'First person singular caps'), 'Use a capital "I".'),
+        (re.compile(r'\b(\w+)\s+\1\b', re.IGNORECASE), ('Grammar', 'Repeated words'), 'This word is repeated.'),
+        (re.compile(r'\A[a-z]+'), ('Capitalization', 'Sentence start'), 'Start a sentence with a capital letter.'),
+    ]
+
+    def __init__(self, latency=0.05, per_character=0.0001):
+        self.latency = latency
+        self.per_character = per_character
+        self.requests = 0
+
+    async def summarizeText(self, text):
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.per_character * len(text))
+        matches = []
+        for pattern, (category, subcategory), message in self.RULES:
+            for found in pattern.finditer(text):
+                matches.append({
+                    'offset': found.start(),
+                    'length': found.end() - found.start(),
+                    'label': category,
+                    'detail': subcategory,
+                    'message': message,
+                    'shortMessage': subcategory
+                })
+        matches.sort(key=lambda match: match['offset'])
+        summary = {
+            'matches': matches,
+            'category_counts': {},
+            'subcategory_counts': {},
+            'wordcounts': {'tokens': len(re.findall(r'\w+', text))}
+        }
+        for match in matches:
+            summary['category_counts'][match['label']] = summary['category_counts'].get(match['label'], 0) + 1
+            subcategory = '{}: {}'.format(match['label'], match['detail'])
+            summary['subcategory_counts'][subcategory] = summary['subcategory_counts'].get(subcategory, 0) + 1
+        return summary
@@ -7,7 +7,12 @@ new.
 See: `http://features.jsomers.net/how-i-reverse-engineered-google-docs/`
 '''
 
+import array
+import base64
+import itertools
 import json
+import sys
+import zlib
 
 """
 The placeholder character is used to fill gaps in the document, particularly
@@ -25,6 +30,13 @@ doc._text leaving only the character 'a'.
 """
 PLACEHOLDER = '\x00'
 
+# Tag for compactly encoded edit metadata. See `encode_edit_metadata`.
+DELTA_ENCODING = 'delta-zlib-base64'
+
+# Target size, in characters, of the chunks `google_text_rope` keeps
+# the document in.
+ROPE_CHUNK_SIZE = 512
+
 
 class google_text(object):
     '''
@@ -89,23 +101,24 @@ class google_text(object):
             errors_found.append("Mismatching lengths")
         return errors_found
 
-    def from_json(json_rep):
+    @classmethod
+    def from_json(cls, json_rep):
         '''
         Class method to deserialize from JSON
 
         For null objects, it will create a new Google Doc.
         '''
-        new_object = google_text.__new__(google_text)
+        new_object = cls.__new__(cls)
         if json_rep is None:
             json_rep = {}
         new_object._text = json_rep.get('text', '')
         new_object._position = json_rep.get('position', 0)
-        new_object._edit_metadata = json_rep.get('edit_metadata', {})
+        new_object._edit_metadata = decode_edit_metadata(json_rep.get('edit_metadata', {}))
 
         if 'tabs' in json_rep and json_rep['tabs']:
             new_object._tabs = {}
             for tab_id, tab_data in json_rep['tabs'].items():
-                new_object._tabs[tab_id] = google_text.from_json(tab_data)
+                new_object._tabs[tab_id] = cls.from_json(tab_data)
         else:
             new_object._tabs = {}
 
@@ -120,6 +133,23 @@ class google_text(object):
         '''
         self._text = text
 
+    def splice(self, start, end, s):
+        '''
+        Replace the text between `start` and `end` with `s`. These are
+        (0-based) Python slice indexes, and this is exactly:
+
+        `text[:start] + s + text[end:]`
+
+        All edit commands go through here, so alternative storage
+        (see `google_text_rope`) only needs to reimplement this, `len`,
+        and `_text`.
+        '''
+        self.update("{start}{insert}{end}".format(
+            start=self._text[:start],
+            insert=s,
+            end=self._text[end:]
+        ))
+
     def len(self):
         '''
         Length of the string
@@ -140,7 +170,7 @@ class google_text(object):
 
         Side effect: Update Deane arrays.
         '''
-        self._edit_metadata['length'].append(len(self._text))
+        self._edit_metadata['length'].append(self.len())
         self._edit_metadata['cursor'].append(p)
         self._position = p
 
@@ -164,16 +194,248 @@ class google_text(object):
         '''
         This serializes to JSON.
         '''
+        return self.to_json()
+
+    def to_json(self, edit_metadata_encoding='list', horizon=0):
+        '''
+        Serialize to JSON, optionally with compact edit metadata. See
+        `encode_edit_metadata` for the options. `from_json` reads
+        either form.
+        '''
+        edit_metadata = self._edit_metadata
+        if edit_metadata_encoding != 'list' or horizon:
+            edit_metadata = encode_edit_metadata(edit_metadata, edit_metadata_encoding, horizon)
         result = {
             'text': self._text,
             'position': self._position,
-            'edit_metadata': self._edit_metadata
+            'edit_metadata': edit_metadata
         }
         if self._tabs:
-            result['tabs'] = {tab_id: tab.json for tab_id, tab in self._tabs.items()}
+            result['tabs'] = {
+                tab_id: tab.to_json(edit_metadata_encoding, horizon)
+                for tab_id, tab in self._tabs.items()
+            }
         return result
 
 
+class google_text_rope(google_text):
+    '''
+    A `google_text` which keeps the document as a list of short chunks
+    (a shallow rope) rather than as one string.
+
+    With a plain string, every insert or delete copies the whole
+    document, so replaying a long history is quadratic. Here, an edit
+    only rebuilds the chunk(s) it touches. Edits tend to be near each
+    other, so we remember where the last one was to find the next
+    chunk quickly.
+
+    The text, and the JSON, are identical to `google_text`. We only
+    join the chunks back into a string when `_text` is read (e.g. to
+    serialize), and cache that until the next edit.
+
+    The `reconstruct` reducer builds a model from the stored text for
+    each event, and serializes it afterwards, which is linear in the
+    length of the document either way. So the rope speeds up events
+    with many edits (and offline replays), but an event with a single
+    keystroke costs about the same as with `google_text`.
+    '''
+    @property
+    def _text(self):
+        if self._flat is None:
+            self._flat = "".join(self._chunks)
+        return self._flat
+
+    @_text.setter
+    def _text(self, text):
+        self._chunks = [
+            text[i:i + ROPE_CHUNK_SIZE] for i in range(0, len(text), ROPE_CHUNK_SIZE)
+        ] or [""]
+        self._length = len(text)
+        self._flat = text
+        self._hint = (0, 0)
+
+    def len(self):
+        '''
+        Length of the string
+        '''
+        return self._length
+
+    def _locate(self, index):
+        '''
+        Find the chunk containing `index`. Returns the chunk number and the
+        offset of its first character. An index on a boundary belongs to
+        the later chunk, except at the end of the document.
+        '''
+        chunks = self._chunks
+        i, start = self._hint
+        if i >= len(chunks):
+            i, start = 0, 0
+        while i > 0 and start > index:
+            i -= 1
+            start -= len(chunks[i])
+        while i < len(chunks) - 1 and start + len(chunks[i]) <= index:
+            start += len(chunks[i])
+            i += 1
+        return i, start
+
+    def _slice(self, start, end):
+        '''
+        Return `text[start:end]`, for `0 <= start <= end <= len`
+        '''
+        i, offset = self._locate(start)
+        parts = []
+        while start < end:
+            chunk = self._chunks[i]
+            parts.append(chunk[start - offset:end - offset])
+            offset += len(chunk)
+            start = offset
+            i += 1
+        return "".join(parts)
+
+    def splice(self, start, end, s):
+        '''
+        Replace the text between `start` and `end` with `s`. See
+        `google_text.splice`.
+        '''
+        # Normalize negative and out-of-range indexes the way Python's
+        # slicing does
+        start, end, _ = slice(start, end).indices(self._length)
+        # `text[:start] + s + text[end:]` with `end < start` repeats the
+        # text in between. Odd, but we want identical results.
+        if end < start:
+            s = s + self._slice(end, start)
+            end = start
+        if not s and start == end:
+            return
+
+        chunks = self._chunks
+        i, istart = self._locate(start)
+        j, jstart = i, istart
+        while j < len(chunks) - 1 and jstart + len(chunks[j]) < end:
+            jstart += len(chunks[j])
+            j += 1
+
+        merged = chunks[i][:start - istart] + s + chunks[j][end - jstart:]
+        if len(merged) > 2 * ROPE_CHUNK_SIZE:
+            pieces = [
+                merged[k:k + ROPE_CHUNK_SIZE] for k in range(0, len(merged), ROPE_CHUNK_SIZE)
+            ]
+        elif merged or j - i + 1 == len(chunks):
+            pieces = [merged]
+        else:
+            pieces = []
+        chunks[i:j + 1] = pieces
+
+        self._length += len(s) - (end - start)
+        self._flat = None
+        # Chunks before `i` did not change, so chunk `i` still starts at `istart`
+        self._hint = (i, istart) if i < len(chunks) else (0, 0)
+
+
+def _pack_deltas(values):
+    '''
+    Delta-encode a list of integers, and pack it as compressed, base64
+    encoded little-endian 32-bit integers.
+
+    >>> _pack_deltas([])
+    ''
+    >>> _unpack_deltas(_pack_deltas([5, 6, 7, 3, 100000]))
+    [5, 6, 7, 3, 100000]
+    '''
+    if not values:
+        return ''
+    deltas = array.array('i', [b - a for a, b in zip(itertools.chain([0], values), values)])
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    return base64.b64encode(zlib.compress(deltas.tobytes())).decode('ascii')
+
+
+def _unpack_deltas(packed):
+    '''
+    Inverse of `_pack_deltas`
+    '''
+    if not packed:
+        return []
+    deltas = array.array('i')
+    deltas.frombytes(zlib.decompress(base64.b64decode(packed)))
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    return list(itertools.accumulate(deltas))
+
+
+def downsample_edit_metadata(edit_metadata, horizon):
+    '''
+    Bound the size of the Deane arrays. The most recent `horizon` edits
+    are kept as they are. Once there are more than twice that many,
+    every other older edit is dropped. Repeated over a session, older
+    history gets progressively sparser, and the arrays stay under
+    `2 * horizon` entries or so.
+
+    >>> downsample_edit_metadata({'cursor': [1, 2, 3, 4, 5], 'length': [1, 2, 3, 4, 5]}, 2)
+    {'cursor': [1, 3, 4, 5], 'length': [1, 3, 4, 5]}
+    '''
+    count = len(edit_metadata['cursor'])
+    if not horizon or count <= 2 * horizon:
+        return edit_metadata
+    split = count - horizon
+    return {
+        key: edit_metadata[key][:split:2] + edit_metadata[key][split:]
+        for key in ('cursor', 'length')
+    }
+
+
+def encode_edit_metadata(edit_metadata, encoding='list', horizon=0):
+    '''
+    Serialize the Deane arrays (`cursor` and `length`).
+
+    These grow by one entry per edit, so for long sessions, they are
+    most of the size of the reconstructed document. With `encoding`
+    set to `delta`, each array is stored as a compressed string of
+    deltas (see `_pack_deltas`), which is much smaller. If `horizon`
+    is set, we also downsample old edits (see `downsample_edit_metadata`).
+
+    >>> encoded = encode_edit_metadata({'cursor': [2, 3], 'length': [1, 2]}, 'delta')
+    >>> encoded['encoding'] == DELTA_ENCODING
+    True
+    >>> decode_edit_metadata(encoded)
+    {'cursor': [2, 3], 'length': [1, 2]}
+    '''
+    edit_metadata = downsample_edit_metadata(edit_metadata, horizon)
+    if encoding == 'list':
+        return edit_metadata
+    if encoding != 'delta':
+        raise ValueError("Unknown edit metadata encoding: {}".format(encoding))
+    return {
+        'encoding': DELTA_ENCODING,
+        'cursor': _pack_deltas(edit_metadata['cursor']),
+        'length': _pack_deltas(edit_metadata['length'])
+    }
+
+
+def decode_edit_metadata(edit_metadata):
+    '''
+    Return the Deane arrays from serialized edit metadata, as lists,
+    whichever way they were encoded. Consumers of `reconstruct` state
+    should use this rather than reading `edit_metadata` directly.
+
+    >>> decode_edit_metadata({'cursor': [2], 'length': [1]})
+    {'cursor': [2], 'length': [1]}
+    '''
+    if edit_metadata.get('encoding') != DELTA_ENCODING:
+        return edit_metadata
+    return {
+        'cursor': _unpack_deltas(edit_metadata['cursor']),
+        'length': _unpack_deltas(edit_metadata['length'])
+    }
+
+
+# Document models we can reconstruct into. These produce identical text.
+TEXT_MODELS = {
+    'string': google_text,
+    'rope': google_text_rope
+}
+
+
 def get_parsed_text(self):
     '''
     Returns the text ignoring the normal placeholders
@@ -220,16 +482,12 @@ def insert(doc, ty, ibi, s):
     * `s` is the string to insert
     '''
     # The index of the next character after the last character of the text
-    nextchar_index = len(doc._text) + 1
+    nextchar_index = doc.len() + 1
     # If the insert index is greater than nextchar_index, insert placeholders to fill the gap
     # This occurs when the document has undergone modifications before the logger has been initialized
     if ibi > nextchar_index:
         insert(doc, ty, nextchar_index, PLACEHOLDER * (ibi - nextchar_index))
-    doc.update("{start}{insert}{end}".format(
-        start=doc._text[0:ibi - 1],
-        insert=s,
-        end=doc._text[ibi - 1:]
-    ))
+    doc.splice(ibi - 1, ibi - 1, s)
 
     doc.position = ibi + len(s)
 
@@ -244,17 +502,14 @@ def delete(doc, ty, si, ei):
     * `ei` is the end
     '''
     # Index of the last character in the text. `si` and `ei` shouldn't go beyond that
-    lastchar_index = len(doc._text)
+    lastchar_index = doc.len()
     # If the deletion indexes are greater than nextchar_index, insert placeholders to fill the gap
     # This occurs when the document has undergone modifications before the logger has been initialized
     if si > lastchar_index:
         insert(doc, ty, lastchar_index + 1, PLACEHOLDER * (si - lastchar_index))
     if ei > lastchar_index:
         insert(doc, ty, lastchar_index + 1, PLACEHOLDER * (ei - lastchar_index))
-    doc.update("{start}{end}".format(
-        start=doc._text[0:si - 1],
-        end=doc._text[ei:]
-    ))
+    doc.splice(si - 1, ei, "")
 
     doc.position = si
 
@@ -266,7 +521,7 @@ def replace(doc, ty, snapshot):
 
         # The index of the next character after the last
         # character of the text
-        nextchar_index = len(doc._text) + 1
+        nextchar_index = doc.len() + 1
         if 'ty' in entry and entry['ty'] == 'is':
 
             s = entry['s']
@@ -289,11 +544,7 @@ def replace(doc, ty, snapshot):
                        nextchar_index,
                        PLACEHOLDER * (ibi - nextchar_index))
 
-            doc.update("{start}{insert}{end}".format(
-                start=doc._text[0:ibi - 1],
-                insert=s,
-                end=doc._text[ibi + sl - 1:]
-            ))
+            doc.splice(ibi - 1, ibi + sl - 1, s)
 
     return doc
 
@@ -338,7 +589,7 @@ def nm(doc, nmc, nmr, **kwargs):
     else:
         # Ensure the tab exists
         if target_tab not in doc._tabs:
-            doc._tabs[target_tab] = google_text()
+            doc._tabs[target_tab] = type(doc)()
 
         # Apply the command to the sub-document
         doc._tabs[target_tab] = dispatch_command(doc._tabs[target_tab], nmc)
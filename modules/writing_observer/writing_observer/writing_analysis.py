@@ -43,6 +43,39 @@ pmss.register_field(
     default=60
 )
 
+pmss.parser('reconstruct_text_model', parent='string', choices=list(writing_observer.reconstruct_doc.TEXT_MODELS), transform=None)
+pmss.register_field(
+    name='reconstruct_text_model',
+    type='reconstruct_text_model',
+    description='How the `reconstruct` reducer holds document text while '\
+        'applying edits. `string` rebuilds the text on each edit; `rope` '\
+        'keeps it in chunks, which is faster for long documents and '\
+        'histories. Both produce identical results. The reducer still '\
+        'loads and serializes the whole text on every event, so `rope` '\
+        'helps events with many edits (long bundles, `document_history`), '\
+        'not the cost per keystroke.',
+    default='string'
+)
+
+pmss.parser('reconstruct_edit_metadata_encoding', parent='string', choices=['list', 'delta'], transform=None)
+pmss.register_field(
+    name='reconstruct_edit_metadata_encoding',
+    type='reconstruct_edit_metadata_encoding',
+    description='How the `reconstruct` reducer stores Deane graph data '\
+        '(cursor and length arrays). `list` stores JSON lists; `delta` '\
+        'stores compressed, delta-encoded strings, which are much smaller '\
+        'for long sessions. Either can be read back.',
+    default='list'
+)
+pmss.register_field(
+    name='reconstruct_edit_metadata_horizon',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='If nonzero, the `reconstruct` reducer keeps this many recent '\
+        'edits of Deane graph data at full resolution, and progressively '\
+        'downsamples older edits.',
+    default=0
+)
+
 # Here's the basic deal:
 #
 # - Our prototype didn't deal with multiple documents
@@ -107,7 +140,7 @@ async def binned_time_on_task(event, internal_state):
     return internal_state, internal_state
 
 
-@kvs_pipeline(scope=gdoc_scope)
+@kvs_pipeline(scope=gdoc_scope, event_types=["google_docs_save", "document_history"], field_layout=True)
 async def reconstruct(event, internal_state):
     '''
     This is a thin layer to route events to `reconstruct_doc` which compiles
@@ -118,8 +151,10 @@ async def reconstruct(event, internal_state):
     if event['client']['event'] not in ["google_docs_save", "document_history"]:
         return False, False
 
-    internal_state = writing_observer.reconstruct_doc.google_text.from_json(
-        json_rep=internal_state)
+    text_model = writing_observer.reconstruct_doc.TEXT_MODELS[
+        learning_observer.settings.module_setting('writing_observer', 'reconstruct_text_model')
+    ]
+    internal_state = text_model.from_json(json_rep=internal_state)
     if event['client']['event'] == "google_docs_save":
         bundles = event['client']['bundles']
         for bundle in bundles:
@@ -131,9 +166,12 @@ async def reconstruct(event, internal_state):
             i[0] for i in event['client']['history']['changelog']
         ]
         internal_state = writing_observer.reconstruct_doc.command_list(
-            writing_observer.reconstruct_doc.google_text(), change_list
+            text_model(), change_list
         )
-    state = internal_state.json
+    state = internal_state.to_json(
+        edit_metadata_encoding=learning_observer.settings.module_setting('writing_observer', 'reconstruct_edit_metadata_encoding'),
+        horizon=learning_observer.settings.module_setting('writing_observer', 'reconstruct_edit_metadata_horizon')
+    )
     if learning_observer.settings.module_setting('writing_observer', 'verbose'):
         print(state)
     return state, state
@@ -164,21 +202,28 @@ async def student_profile(event, internal_state):
     return False, False
 
 
-@kvs_pipeline(scope=gdoc_scope, null_state={})
+@kvs_pipeline(scope=gdoc_scope, null_state={}, event_types=[])
 async def nlp_components(event, internal_state):
     '''HACK the reducers need this method to query data
     '''
     return False, False
 
 
-@kvs_pipeline(scope=gdoc_scope, null_state={})
+@kvs_pipeline(scope=gdoc_scope, null_state={}, event_types=[])
 async def languagetool_process(event, internal_state):
     '''HACK the reducers need this method to query data
     '''
     return False, False
 
 
-@kvs_pipeline(scope=student_scope, null_state={'timestamps': {}, 'last_document': ''})
+# If users switch between document tabs, then the system will
+# send mutliple `visibility` events from both tabs creating
+# more timestamps than we want. We skip those events.
+@kvs_pipeline(
+    scope=student_scope,
+    null_state={'timestamps': {}, 'last_document': ''},
+    event_filter=lambda event: event['client']['event'] not in ['visibility']
+)
 async def document_access_timestamps(event, internal_state):
     '''
     We want to fetch documents around a certian time of day.
@@ -190,12 +235,6 @@ async def document_access_timestamps(event, internal_state):
     NOTE we only keep that latest doc for each timestamp.
     Since we are in milliseconds, this should be okay.
     '''
-    # If users switch between document tabs, then the system will
-    # send mutliple `visibility` events from both tabs creating
-    # more timestamps than we want. We skip those events.
-    if event['client']['event'] in ['visibility']:
-        return False, False
-
     document_id = get_doc_id(event)
     if document_id is not None:
 
@@ -211,7 +250,7 @@ async def document_access_timestamps(event, internal_state):
     return False, False
 
 
-@kvs_pipeline(scope=student_scope, null_state={'tags': {}})
+@kvs_pipeline(scope=student_scope, null_state={'tags': {}}, event_types=["document_history"])
 async def document_tagging(event, internal_state):
     '''
     We would like to be able to group documents together to better work with
@@ -0,0 +1,143 @@
+'''
+Compare the speed of looking up reducers and building KVS keys the
+old way (a scan of `module_loader.reducers()`, and `make_key` for each
+key) with the new way (`module_loader.find_reducer`, and a cached
+`KeyTemplate`'s `make_key` for each key, as `handle_keys` does).
+
+`handle_keys` pairs students with documents record by record, rather
+than taking a cross product, so it can't use `KeyTemplate.make_keys`.
+We time `make_keys` separately, as "bulk", for code which can.
+
+This is what a dashboard does when it runs a DAG: find the reducer
+for each `select`, and make a key for each student and document in a
+class. We use synthetic reducers and rosters, so no modules or
+settings are needed.
+
+We also check both ways give identical keys.
+'''
+
+import argparse
+import time
+
+import learning_observer.module_loader as module_loader
+import learning_observer.stream_analytics.helpers as helpers
+from learning_observer.stream_analytics.fields import KeyStateType, KeyField, EventField, Scope
+
+
+parser = argparse.ArgumentParser(
+    description=__doc__.strip(),
+    formatter_class=argparse.RawTextHelpFormatter
+)
+
+parser.add_argument("--reducers", type=int, default=50, help="Number of registered reducers")
+parser.add_argument("--students", type=int, default=100, help="Students in the roster")
+parser.add_argument("--documents", type=int, default=10, help="Documents per student")
+parser.add_argument("--repeat", type=int, default=5, help="Number of times to run each way")
+
+
+def synthetic_reducers(count):
+    '''
+    Make `count` reducers, each scoped to a student and a document, the
+    way `writing_observer` scopes most of its reducers.
+    '''
+    scope = Scope([KeyField.STUDENT, EventField('doc_id')])
+    reducers = []
+    for i in range(count):
+        def reducer(event, internal_state):
+            return internal_state, internal_state
+        reducer.__module__ = 'benchmark'
+        reducer.__qualname__ = 'reducer_{}'.format(i)
+        reducers.append({
+            'context': 'org.mitros.writing_analytics',
+            'scope': scope,
+            'function': reducer,
+            'id': 'benchmark.reducer_{}'.format(i),
+            'string_id': 'benchmark.reducer_{}'.format(i)
+        })
+    return reducers
+
+
+def old_way(reducer_ids, students, documents):
+    '''
+    Scan the reducer list, and call `make_key` for every key.
+    '''
+    keys = []
+    for reducer_id in reducer_ids:
+        reducer = None
+        for candidate in module_loader.reducers():
+            if candidate.get('id') == reducer_id or candidate.get('string_id') == reducer_id:
+                reducer = candidate
+                break
+        for student in students:
+            for document in documents:
+                keys.append(helpers.make_key(
+                    reducer['function'],
+                    {KeyField.STUDENT: student, EventField('doc_id'): document},
+                    KeyStateType.INTERNAL
+                ))
+    return keys
+
+
+def new_way(reducer_ids, students, documents):
+    '''
+    Use the reducer index, and the reducer's key template for each key.
+    '''
+    keys = []
+    for reducer_id in reducer_ids:
+        reducer = module_loader.find_reducer(reducer_id)
+        template = helpers.key_template(reducer['function'], reducer['scope'], KeyStateType.INTERNAL)
+        for student in students:
+            for document in documents:
+                keys.append(template.make_key({KeyField.STUDENT: student, EventField('doc_id'): document}))
+    return keys
+
+
+def bulk_way(reducer_ids, students, documents):
+    '''
+    Use the reducer index, and make all of a reducer's keys at once.
+    '''
+    keys = []
+    for reducer_id in reducer_ids:
+        reducer = module_loader.find_reducer(reducer_id)
+        template = helpers.key_template(reducer['function'], reducer['scope'], KeyStateType.INTERNAL)
+        keys.extend(template.make_keys({KeyField.STUDENT: students, EventField('doc_id'): documents}))
+    return keys
+
+
+def time_it(function, repeat, *args):
+    '''
+    Return the result of `function(*args)`, and the best time of
+    `repeat` runs.
+    '''
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    args = parser.parse_args()
+    module_loader.REDUCERS = synthetic_reducers(args.reducers)
+    module_loader.LOADED = True
+
+    # A dashboard usually asks for a few reducers, late in the list
+    reducer_ids = [r['id'] for r in module_loader.REDUCERS[-5:]]
+    students = ['student_{}'.format(i) for i in range(args.students)]
+    documents = ['document_{}'.format(i) for i in range(args.documents)]
+
+    old_keys, old_time = time_it(old_way, args.repeat, reducer_ids, students, documents)
+    new_keys, new_time = time_it(new_way, args.repeat, reducer_ids, students, documents)
+    bulk_keys, bulk_time = time_it(bulk_way, args.repeat, reducer_ids, students, documents)
+    if not old_keys == new_keys == bulk_keys:
+        raise Exception("Keys do not match")
+
+    print("{keys} keys, {reducers} reducers".format(keys=len(new_keys), reducers=args.reducers))
+    print("     old: {t:.4f}s".format(t=old_time))
+    print("     new: {t:.4f}s ({s:.1f}x)".format(t=new_time, s=old_time / new_time))
+    print("    bulk: {t:.4f}s ({s:.1f}x)".format(t=bulk_time, s=old_time / bulk_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Compare checking a class's essays with LanguageTool the old way (one
+essay at a time, memoized on the whole text) with the new way
+(`writing_observer.languagetool_client`: every sentence at once, up
+to a limit, cached a sentence at a time).
+
+We refresh three times: with nothing cached, again with no changes,
+and after each student edits one sentence, which is what a dashboard
+sees while a class writes. Checks go to `StubClient`, which takes
+`--latency` seconds per request plus `--per-character` seconds per
+character, so no LanguageTool server is needed. Both ways use their
+default caches, and no `memoization` KVS, as in a default setup.
+
+With nothing cached, the new way sends many small requests, so if
+per-request overhead dominates (try `--latency 0.05`), it is slower.
+
+We also check both ways find the same errors.
+'''
+
+import argparse
+import asyncio
+import random
+import time
+
+import learning_observer.cache
+import writing_observer.languagetool_client as languagetool_client
+
+
+parser = argparse.ArgumentParser(
+    description=__doc__.strip(),
+    formatter_class=argparse.RawTextHelpFormatter
+)
+
+parser.add_argument("--students", type=int, default=30, help="Students in the class")
+parser.add_argument("--sentences", type=int, default=40, help="Sentences per essay")
+parser.add_argument("--max-concurrency", type=int, default=8, help="Most requests to LanguageTool at once")
+parser.add_argument("--latency", type=float, default=0.005, help="Seconds per request")
+parser.add_argument("--per-character", type=float, default=0.00005, help="Seconds per character checked")
+
+WORDS = ['the', 'student', 'wrote', 'a', 'long', 'essay', 'about', 'i', 'think', 'that', 'dogs', 'to', 'cats']
+
+
+def synthetic_essays(students, sentences):
+    random.seed(0)
+    return [
+        [' '.join(random.choice(WORDS) for word in range(12)).capitalize() + '. ' for sentence in range(sentences)]
+        for student in range(students)
+    ]
+
+
+def edit(essays):
+    '''
+    Each student rewrites one of their sentences.
+    '''
+    for student, essay in enumerate(essays):
+        position = random.randrange(len(essay))
+        essay[position] = 'Student {} changed this sentence to to fix it. '.format(student)
+
+
+async def old_way(stub, texts):
+    @learning_observer.cache.async_memoization()
+    async def process_text(text):
+        return await stub.summarizeText(text)
+
+    return [await process_text(text) for text in texts]
+
+
+async def new_way(texts):
+    return await asyncio.gather(*[languagetool_client.summarize_text(text) for text in texts])
+
+
+async def time_it(function, *args):
+    start = time.perf_counter()
+    result = await function(*args)
+    return result, time.perf_counter() - start
+
+
+def errors(summaries):
+    return [
+        (sorted((m['offset'], m['label'], m['detail']) for m in summary['matches']), summary['category_counts'])
+        for summary in summaries
+    ]
+
+
+async def main():
+    args = parser.parse_args()
+    old_stub = languagetool_client.StubClient(latency=args.latency, per_character=args.per_character)
+    new_stub = languagetool_client.StubClient(latency=args.latency, per_character=args.per_character)
+    languagetool_client.set_client(new_stub, 'benchmark', max_concurrency=args.max_concurrency)
+
+    essays = synthetic_essays(args.students, args.sentences)
+    for refresh in ['cold', 'unchanged', 'after edits']:
+        if refresh == 'after edits':
+            edit(essays)
+        texts = [''.join(essay) for essay in essays]
+        old_requests, new_requests = old_stub.requests, new_stub.requests
+        old, old_time = await time_it(old_way, old_stub, texts)
+        new, new_time = await time_it(new_way, texts)
+        if errors(old) != errors(new):
+            raise Exception("Results do not match")
+        print("{refresh}: {students} essays".format(refresh=refresh, students=len(texts)))
+        print("     old: {t:.3f}s, {r} requests".format(t=old_time, r=old_stub.requests - old_requests))
+        print("     new: {t:.3f}s, {r} requests".format(t=new_time, r=new_stub.requests - new_requests))
+        print(" speedup: {s:.1f}x".format(s=old_time / new_time))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,142 @@
+'''
+Compare the speed of the document models in `reconstruct_doc` (plain
+string vs. rope) by replaying Google Docs edits through each.
+
+With `--logfiles`, we replay the `google_docs_save` bundles (and
+`document_history` changelogs) recorded in Learning Observer event
+logs, one document at a time. Without it, we synthesize a long
+writing session: mostly typing, with some deletions and cursor jumps.
+
+By default, each bundle is applied the way the `reconstruct` reducer
+applies an event: the model is rebuilt from the previous JSON state,
+and serialized again afterwards. Both of those take time linear in the
+document, for either model, so per-event cost stays linear in document
+length, and the rope only helps when one event carries many edits.
+`--in-memory` keeps one model for the whole replay instead (as for a
+`document_history` event, or an offline replay), which is where the
+rope avoids the quadratic cost of the string model.
+
+We also check the two models produce identical JSON.
+'''
+
+import argparse
+import json
+import random
+import time
+
+import writing_observer.reconstruct_doc as reconstruct_doc
+
+
+parser = argparse.ArgumentParser(
+    description=__doc__.strip(),
+    formatter_class=argparse.RawTextHelpFormatter
+)
+
+parser.add_argument("--logfiles", "-f", help="The log file(s) to replay (separated by commas)")
+parser.add_argument("--length", type=int, default=20000, help="Length of the synthetic essay, in characters")
+parser.add_argument("--bundle-size", type=int, default=20, help="Commands per synthetic save bundle")
+parser.add_argument("--repeat", type=int, default=3, help="Number of times to replay each document")
+parser.add_argument("--in-memory", action="store_true", help="Keep one model for the whole replay, rather than round-tripping through JSON for each bundle")
+
+
+def load_logged_documents(filenames):
+    '''
+    Return a dictionary of document ID to a list of command lists, one per
+    `google_docs_save` bundle (or `document_history` changelog).
+    '''
+    documents = {}
+    for filename in filenames:
+        with open(filename) as fp:
+            for line in fp:
+                # Study logs have a tab-separated timestamp after the event
+                line = line.split('\t')[0].strip()
+                if not line:
+                    continue
+                event = json.loads(line)
+                client = event.get('client', event)
+                doc_id = client.get('doc_id', 'unknown')
+                if client.get('event') == 'google_docs_save':
+                    for bundle in client.get('bundles', []):
+                        documents.setdefault(doc_id, []).append(bundle['commands'])
+                elif client.get('event') == 'document_history':
+                    changelog = client['history']['changelog']
+                    documents.setdefault(doc_id, []).append([i[0] for i in changelog])
+    return documents
+
+
+def synthetic_document(length, bundle_size):
+    '''
+    Generate save bundles which type out a document of roughly `length`
+    characters.
+    '''
+    rng = random.Random(0)
+    commands = []
+    cursor = 1
+    doc_length = 0
+    while doc_length < length:
+        r = rng.random()
+        if r < 0.9 or doc_length < 10:
+            s = rng.choice("abcdefghijklmnopqrstuvwxyz     .\n")
+            commands.append({'ty': 'is', 'ibi': cursor, 's': s})
+            cursor += 1
+            doc_length += 1
+        elif r < 0.98:
+            commands.append({'ty': 'ds', 'si': cursor - 1, 'ei': cursor - 1})
+            cursor -= 1
+            doc_length -= 1
+        else:
+            cursor = rng.randint(1, doc_length + 1)
+    bundles = [commands[i:i + bundle_size] for i in range(0, len(commands), bundle_size)]
+    return {'synthetic': bundles}
+
+
+def replay(text_model, bundles, in_memory=False):
+    '''
+    Apply each bundle in turn and return the document and the time
+    taken. Unless `in_memory`, we load and serialize the document
+    around each bundle, the way the `reconstruct` reducer does.
+    '''
+    start = time.perf_counter()
+    doc = text_model()
+    for commands in bundles:
+        if not in_memory:
+            doc = text_model.from_json(json_rep=doc.to_json())
+        doc = reconstruct_doc.command_list(doc, commands)
+    doc.json
+    return doc, time.perf_counter() - start
+
+
+def main():
+    args = parser.parse_args()
+    if args.logfiles:
+        documents = load_logged_documents(args.logfiles.split(','))
+    else:
+        documents = synthetic_document(args.length, args.bundle_size)
+
+    totals = {name: 0.0 for name in reconstruct_doc.TEXT_MODELS}
+    for doc_id, bundles in documents.items():
+        results = {}
+        for name, text_model in reconstruct_doc.TEXT_MODELS.items():
+            timings = []
+            for i in range(args.repeat):
+                doc, elapsed = replay(text_model, bundles, args.in_memory)
+                timings.append(elapsed)
+            results[name] = doc.json
+            totals[name] += min(timings)
+            print("{doc_id} {name:>8}: {length} chars, {commands} commands, {t:.4f}s".format(
+                doc_id=doc_id,
+                name=name,
+                length=doc.len(),
+                commands=sum(len(b) for b in bundles),
+                t=min(timings)
+            ))
+        reference = json.dumps(results['string'], sort_keys=True)
+        for name, result in results.items():
+            if json.dumps(result, sort_keys=True) != reference:
+                raise Exception("{name} does not match `string` for {doc_id}".format(name=name, doc_id=doc_id))
+
+    print("Total:", ", ".join("{name} {t:.4f}s".format(name=name, t=t) for name, t in totals.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -31,7 +31,7 @@ learning_observer.settings.load_settings({
         "debug_log_destination": ["console"]
     },
     "kvs": {
-        "type": "stub",
+        "default": {"type": "stub"}
     },
     "config": {
         "run_mode": "dev"